@@ -0,0 +1,161 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import os
+import sys
+import time
+import json
+import logging
+import subprocess
+import numpy as np
+
+sys.path.append('../')
+logging.getLogger('tensorflow').disabled = True
+
+import tensorflow as tf
+from text_harnn import TextHARNN
+from utils import checkmate as cm
+from utils import data_helpers as dh
+from utils import param_parser as parser
+from utils import session_config as sc
+
+args = parser.parameter_parser()
+
+# TensorFlow sizes its thread pools once per process (with the first session), so each thread configuration
+# is measured in its own worker process, which gets its threads through this variable
+WORKER_ENV = "HARNN_AUTOTUNE_THREADS"
+
+
+def thread_candidates():
+    """
+    Returns:
+        <list> The thread counts to try, --autotune-threads or the powers of 2 up to the number of cores
+    """
+    if args.autotune_threads:
+        return sorted(set(args.autotune_threads))
+    cpus = sc.available_cpus()
+    candidates = [1]
+    while candidates[-1] * 2 <= cpus:
+        candidates.append(candidates[-1] * 2)
+    if candidates[-1] != cpus:
+        candidates.append(cpus)
+    return candidates
+
+
+def timeit(sess, fetches, feed_dict, steps):
+    sess.run(fetches, feed_dict)  # Warm up
+    start = time.perf_counter()
+    for _ in range(steps):
+        sess.run(fetches, feed_dict)
+    return (time.perf_counter() - start) / steps
+
+
+def run_worker(intra_op_threads, inter_op_threads):
+    """
+    Measure the training and the inference throughput of TextHARNN with one thread configuration,
+    on random documents of pad_seq_len tokens, for each of the --autotune-batch-sizes.
+
+    Returns:
+        <list> The measurement of each batch size
+    """
+    VOCAB_SIZE, EMBEDDING_SIZE, pretrained_word2vec_matrix = dh.load_word2vec_matrix(args.word2vec_file,
+                                                                                      args.embedding_matrix_file)
+    with tf.Graph().as_default():
+        harnn = TextHARNN(
+            sequence_length=args.pad_seq_len,
+            vocab_size=VOCAB_SIZE,
+            embedding_type=args.embedding_type,
+            embedding_size=EMBEDDING_SIZE,
+            lstm_hidden_size=args.lstm_dim,
+            attention_unit_size=args.attention_dim,
+            fc_hidden_size=args.fc_dim,
+            num_classes_list=args.num_classes_list,
+            total_classes=args.total_classes,
+            l2_reg_lambda=args.l2_lambda,
+            pretrained_embedding=pretrained_word2vec_matrix,
+            lstm_layers=args.lstm_layers,
+            lstm_backend=args.lstm_backend,
+            embedding_dim=args.embedding_dim,
+            embedding_rank=args.embedding_rank,
+            sampled_loss=args.sampled_loss,
+            num_sampled=args.num_sampled)
+        optimizer = tf.train.AdamOptimizer(args.learning_rate)
+        grads, vars = zip(*optimizer.compute_gradients(harnn.train_loss))
+        grads, _ = tf.clip_by_global_norm(grads, clip_norm=args.norm_ratio)
+        train_op = optimizer.apply_gradients(zip(grads, vars), global_step=harnn.global_step)
+
+        session_conf = sc.create_session_config(args, intra_op_threads, inter_op_threads)
+        with tf.Session(config=session_conf) as sess:
+            sess.run(tf.global_variables_initializer())
+            cm.init_frozen_embedding(sess, pretrained_word2vec_matrix)
+
+            rng = np.random.RandomState(0)
+            results = []
+            for batch_size in args.autotune_batch_sizes:
+                feed_dict = {
+                    harnn.input_x: rng.randint(1, VOCAB_SIZE, size=(batch_size, args.pad_seq_len)),
+                    harnn.input_y_local: (rng.rand(batch_size, sum(args.num_classes_list)) < 0.2).astype(np.float32),
+                    harnn.input_y: (rng.rand(batch_size, args.total_classes) < 0.2).astype(np.float32),
+                    harnn.alpha: args.alpha
+                }
+                train_seconds = timeit(sess, train_op, dict(feed_dict, **{
+                    harnn.dropout_keep_prob: args.dropout_rate, harnn.is_training: True}), args.autotune_steps)
+                inference_seconds = timeit(sess, harnn.scores, dict(feed_dict, **{
+                    harnn.dropout_keep_prob: 1.0, harnn.is_training: False}), args.autotune_steps)
+                results.append({
+                    'intra_op_threads': intra_op_threads,
+                    'inter_op_threads': inter_op_threads,
+                    'batch_size': batch_size,
+                    'train_docs_per_second': batch_size / train_seconds,
+                    'inference_docs_per_second': batch_size / inference_seconds
+                })
+    return results
+
+
+def autotune():
+    """
+    Benchmark the training and inference throughput of TextHARNN over the thread counts and batch sizes,
+    and write the fastest configuration of each to --tuned-config, which the later runs pick up
+    (the batch size only with --tuned-batch-size).
+    """
+    logger = dh.logger_fn("tflog", "logs/Autotune-{0}.log".format(time.asctime()))
+    dh.tab_printer(args, logger)
+
+    results = []
+    candidates = thread_candidates()
+    for intra_op_threads in candidates:
+        for inter_op_threads in candidates:
+            env = dict(os.environ, **{WORKER_ENV: "{0},{1}".format(intra_op_threads, inter_op_threads)})
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__)] + sys.argv[1:], env=env,
+                                             cwd=os.path.dirname(os.path.abspath(__file__)))
+            for result in json.loads(output.decode('utf-8').strip().splitlines()[-1]):
+                logger.info("intra {0:>3} inter {1:>3} batch {2:>5}: train {3:>9.1f} docs/s, "
+                            "inference {4:>9.1f} docs/s".format(
+                                result['intra_op_threads'], result['inter_op_threads'], result['batch_size'],
+                                result['train_docs_per_second'], result['inference_docs_per_second']))
+                results.append(result)
+
+    def best(key):
+        result = max(results, key=lambda r: r[key])
+        return {name: result[name] for name in parser.TUNED_PARAMETERS + [key]}
+
+    tuned_config = {
+        'cpu_count': os.cpu_count(),
+        'cpu_affinity': args.cpu_affinity,
+        'train': best('train_docs_per_second'),
+        'inference': best('inference_docs_per_second'),
+        'results': results
+    }
+    with open(args.tuned_config, 'w') as fout:
+        json.dump(tuned_config, fout, indent=2)
+    logger.info("Training: {0}".format(tuned_config['train']))
+    logger.info("Inference: {0}".format(tuned_config['inference']))
+    logger.info("Tuned config written to {0}".format(args.tuned_config))
+
+
+if __name__ == '__main__':
+    if WORKER_ENV in os.environ:
+        threads = [int(i) for i in os.environ[WORKER_ENV].split(',')]
+        print(json.dumps(run_worker(*threads)))
+    else:
+        autotune()
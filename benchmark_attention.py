@@ -0,0 +1,120 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+
+def _masked_softmax(logits, mask):
+    return tf.nn.softmax(logits + tf.expand_dims((mask - 1.0) * 1e9, 1))
+
+
+def map_fn_attention(input_x, W_s1, W_s2, mask):
+    """The former TextHARNN._attention: two nested map_fn over the batch."""
+    attention_matrix = tf.map_fn(
+        fn=lambda x: tf.matmul(W_s2, x),
+        elems=tf.tanh(
+            tf.map_fn(
+                fn=lambda x: tf.matmul(W_s1, tf.transpose(x)),
+                elems=input_x,
+                dtype=tf.float32
+            )
+        )
+    )
+    attention_weight = _masked_softmax(attention_matrix, mask)
+    attention_out = tf.reduce_mean(tf.matmul(attention_weight, input_x), axis=1)
+    return attention_weight, attention_out
+
+
+def batched_attention(input_x, input_projection, W_s2, mask):
+    """The current TextHARNN._attention."""
+    attention_matrix = tf.einsum('ca,bta->bct', W_s2, tf.tanh(input_projection))
+    attention_weight = _masked_softmax(attention_matrix, mask)
+    attention_out = tf.einsum('bt,btd->bd', tf.reduce_mean(attention_weight, axis=1), input_x)
+    return attention_weight, attention_out
+
+
+def build(batch_size, args):
+    """
+    Build both versions of the three attention levels on the same random input.
+    Each level scales the LSTM output by a (random) visual of the previous level, as in TextHARNN.
+
+    Returns:
+        The per-level (map_fn, batched) ops, forward and backward, and the outputs to compare
+    """
+    rng = np.random.RandomState(0)
+    num_units = args.lstm_dim * 2
+    lstm_out = tf.constant(rng.standard_normal((batch_size, args.seq_len, num_units)).astype(np.float32))
+    lengths = rng.randint(1, args.seq_len + 1, size=batch_size)
+    mask = tf.sequence_mask(lengths, args.seq_len, dtype=tf.float32)
+    visuals = [None] + [tf.constant(rng.dirichlet(np.ones(args.seq_len), size=batch_size).astype(np.float32))
+                        for _ in args.num_classes_list[1:]]
+
+    W_s1 = [tf.Variable(tf.truncated_normal([args.attention_dim, num_units], stddev=0.1)) for _ in visuals]
+    W_s2 = [tf.Variable(tf.truncated_normal([num_classes, args.attention_dim], stddev=0.1))
+            for num_classes in args.num_classes_list]
+    projection = tf.split(tf.tensordot(lstm_out, tf.concat(W_s1, axis=0), axes=[[2], [1]]),
+                          len(visuals), axis=2)
+
+    levels = []
+    for level, visual in enumerate(visuals):
+        input_x = lstm_out if visual is None else lstm_out * tf.expand_dims(visual, -1)
+        input_projection = projection[level] if visual is None else projection[level] * tf.expand_dims(visual, -1)
+        reference = map_fn_attention(input_x, W_s1[level], W_s2[level], mask)
+        batched = batched_attention(input_x, input_projection, W_s2[level], mask)
+        variables = [W_s1[level], W_s2[level]]
+        levels.append({
+            'outputs': (reference, batched),
+            'forward': (reference[1], batched[1]),
+            'backward': (tf.gradients(tf.reduce_sum(reference[1]), variables),
+                         tf.gradients(tf.reduce_sum(batched[1]), variables))
+        })
+    return levels
+
+
+def timeit(sess, fetches, repeat):
+    sess.run(fetches)  # Warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        sess.run(fetches)
+    return (time.perf_counter() - start) / repeat * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the map_fn and the batched attention of TextHARNN.")
+    parser.add_argument("--batch-sizes", type=int, nargs="*", default=[32, 64, 128, 256, 512],
+                        help="Batch sizes to measure. (default: 32 64 128 256 512)")
+    parser.add_argument("--seq-len", type=int, default=150, help="Sequence length. (default: 150)")
+    parser.add_argument("--lstm-dim", type=int, default=256, help="Dimensionality of LSTM neurons. (default: 256)")
+    parser.add_argument("--attention-dim", type=int, default=200,
+                        help="Dimensionality of Attention neurons. (default: 200)")
+    parser.add_argument("--num-classes-list", type=int, nargs="*", default=[3, 6, 14],
+                        help="Each number of labels in hierarchical structure. (default: 3 6 14)")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per measurement. (default: 10)")
+    parser.add_argument("--tolerance", type=float, default=1e-4,
+                        help="Max absolute difference allowed between the two versions. (default: 1e-4)")
+    args = parser.parse_args()
+
+    mismatch = False
+    print("{0:>6} {1:>6} {2:>14} {3:>14} {4:>14} {5:>14} {6:>10}".format(
+        "batch", "level", "map_fn fwd ms", "batched fwd ms", "map_fn bwd ms", "batched bwd ms", "max diff"))
+    for batch_size in args.batch_sizes:
+        with tf.Graph().as_default():
+            levels = build(batch_size, args)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                for level, ops in enumerate(levels):
+                    reference, batched = sess.run(ops['outputs'])
+                    diff = max(np.abs(r - b).max() for r, b in zip(reference, batched))
+                    mismatch = mismatch or diff > args.tolerance
+                    times = [timeit(sess, op, args.repeat) for op in ops['forward'] + ops['backward']]
+                    print("{0:>6} {1:>6} {2:>14.2f} {3:>14.2f} {4:>14.2f} {5:>14.2f} {6:>10.2e}".format(
+                        batch_size, level + 1, times[0], times[1], times[2], times[3], diff))
+    return 1 if mismatch else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# The modules each entry point imports before it starts working, and its cold-start budget.
+# The entry scripts themselves parse arguments and prompt at import time, so their import sets are measured.
+ENTRY_POINTS = {
+    'train_harnn': {
+        'modules': ['numpy', 'tensorflow', 'text_harnn', 'utils.async_evaluator', 'utils.checkmate',
+                    'utils.data_helpers', 'utils.metrics', 'utils.param_parser', 'utils.session_config',
+                    'utils.summary_writer', 'utils.tfrecord_helpers'],
+        'budget_seconds': 8.0,
+        'budget_rss_mb': 700
+    },
+    'test_harnn': {
+        'modules': ['numpy', 'tensorflow', 'text_harnn', 'utils.checkmate', 'utils.data_helpers',
+                    'utils.label_decoding', 'utils.metrics', 'utils.param_parser', 'utils.session_config'],
+        'budget_seconds': 8.0,
+        'budget_rss_mb': 700
+    },
+    'visualization': {
+        'modules': ['numpy', 'tensorflow', 'text_harnn', 'utils.checkmate', 'utils.data_helpers',
+                    'utils.param_parser', 'utils.session_config'],
+        'budget_seconds': 8.0,
+        'budget_rss_mb': 700
+    },
+    'export_embedding': {
+        'modules': ['utils.data_helpers', 'utils.param_parser'],
+        'budget_seconds': 1.0,
+        'budget_rss_mb': 150
+    },
+    'evaluation': {
+        'modules': ['numpy', 'sklearn.metrics'],
+        'budget_seconds': 2.0,
+        'budget_rss_mb': 250
+    },
+    # Jobs that only need the helpers (get_label_topk, create_prediction_file...)
+    'data_helpers': {
+        'modules': ['utils.data_helpers'],
+        'budget_seconds': 1.0,
+        'budget_rss_mb': 150
+    }
+}
+
+_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+seconds = time.perf_counter() - start
+heavy = sorted(m for m in ('torch', 'transformers', 'tflearn', 'gensim', 'tensorflow') if m in sys.modules)
+rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+print(json.dumps({{'seconds': seconds, 'rss_mb': rss_mb, 'heavy_modules': heavy}}))
+"""
+
+
+def measure(modules, repeat):
+    """
+    Measure the cold-start import time and the peak RSS of the modules in fresh interpreters.
+
+    Args:
+        modules: <list> The module names
+        repeat: The number of fresh interpreters to start
+    Returns:
+        The best (minimum) measurement
+    """
+    results = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', _PROBE.format(modules=modules)],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    return min(results, key=lambda r: r['seconds'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold-start budget of the HARNN entry points.")
+    parser.add_argument("--entry-points", nargs="*", default=sorted(ENTRY_POINTS),
+                        help="Entry points to measure. (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters per entry point. (default: 3)")
+    args = parser.parse_args()
+
+    failed = []
+    for name in args.entry_points:
+        entry = ENTRY_POINTS[name]
+        result = measure(entry['modules'], args.repeat)
+        ok = result['seconds'] <= entry['budget_seconds'] and result['rss_mb'] <= entry['budget_rss_mb']
+        if not ok:
+            failed.append(name)
+        print("{0:<18} {1:6.2f}s / {2:.1f}s budget | {3:7.1f}MB / {4}MB budget | heavy: {5} | {6}".format(
+            name, result['seconds'], entry['budget_seconds'], result['rss_mb'], entry['budget_rss_mb'],
+            ', '.join(result['heavy_modules']) or '-', 'OK' if ok else 'OVER BUDGET'))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
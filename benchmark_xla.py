@@ -0,0 +1,133 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import os
+import sys
+import time
+import logging
+import tempfile
+import numpy as np
+
+sys.path.append('../')
+logging.getLogger('tensorflow').disabled = True
+
+import tensorflow as tf
+from text_harnn import TextHARNN
+from utils import checkmate as cm
+from utils import data_helpers as dh
+from utils import param_parser as parser
+from utils import session_config as sc
+
+args = parser.parameter_parser()
+logger = dh.logger_fn("tflog", "logs/Benchmark-XLA-{0}.log".format(time.asctime()))
+
+
+def timeit(sess, fetches, feed_dict, steps):
+    sess.run(fetches, feed_dict)  # Warm up (and compile)
+    start = time.perf_counter()
+    for _ in range(steps):
+        sess.run(fetches, feed_dict)
+    return (time.perf_counter() - start) / steps * 1000.0
+
+
+def benchmark_xla():
+    """
+    Compare the HARNN graph with and without XLA auto-clustering (--xla-jit) on CPU.
+    Both sessions run the same graph from the same weights: the inference scores and one training step
+    (the loss and the updated weights) have to agree within --xla-tolerance, then the training and the
+    inference steps are timed on a batch of --batch-size random documents of pad-seq-len tokens.
+
+    Returns:
+        1 if the XLA graph doesn't match the plain graph, else 0
+    """
+    dh.tab_printer(args, logger)
+
+    VOCAB_SIZE, EMBEDDING_SIZE, pretrained_word2vec_matrix = dh.load_word2vec_matrix(args.word2vec_file,
+                                                                                      args.embedding_matrix_file)
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        harnn = TextHARNN(
+            sequence_length=args.pad_seq_len,
+            vocab_size=VOCAB_SIZE,
+            embedding_type=args.embedding_type,
+            embedding_size=EMBEDDING_SIZE,
+            lstm_hidden_size=args.lstm_dim,
+            attention_unit_size=args.attention_dim,
+            fc_hidden_size=args.fc_dim,
+            num_classes_list=args.num_classes_list,
+            total_classes=args.total_classes,
+            l2_reg_lambda=args.l2_lambda,
+            pretrained_embedding=pretrained_word2vec_matrix,
+            lstm_layers=args.lstm_layers,
+            lstm_backend=args.lstm_backend,
+            embedding_dim=args.embedding_dim,
+            embedding_rank=args.embedding_rank,
+            sampled_loss=args.sampled_loss,
+            num_sampled=args.num_sampled)
+        optimizer = tf.train.AdamOptimizer(args.learning_rate)
+        grads, vars = zip(*optimizer.compute_gradients(harnn.train_loss))
+        grads, _ = tf.clip_by_global_norm(grads, clip_norm=args.norm_ratio)
+        train_op = optimizer.apply_gradients(zip(grads, vars), global_step=harnn.global_step)
+        saver = tf.train.Saver(tf.global_variables())
+
+        rng = np.random.RandomState(0)
+        feed_dict = {
+            harnn.input_x: rng.randint(1, VOCAB_SIZE, size=(args.batch_size, args.pad_seq_len)),
+            harnn.input_y_local: (rng.rand(args.batch_size, sum(args.num_classes_list)) < 0.2).astype(np.float32),
+            harnn.input_y: (rng.rand(args.batch_size, args.total_classes) < 0.2).astype(np.float32),
+            harnn.alpha: args.alpha,
+            # No dropout, so both graphs compute the same step
+            harnn.dropout_keep_prob: 1.0
+        }
+        train_feed_dict = dict(feed_dict, **{harnn.is_training: True})
+        inference_feed_dict = dict(feed_dict, **{harnn.is_training: False})
+
+        # The XLA config first: it sets the TF_XLA_FLAGS the first session of the process reads
+        xla_sess = tf.Session(config=sc.create_session_config(args, xla_jit=True))
+        plain_sess = tf.Session(config=sc.create_session_config(args, xla_jit=False))
+        mismatch = False
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            plain_sess.run(tf.global_variables_initializer())
+            checkpoint_file = saver.save(plain_sess, os.path.join(tmp_dir, "model"))
+            saver.restore(xla_sess, checkpoint_file)
+        for sess in (plain_sess, xla_sess):
+            cm.init_frozen_embedding(sess, pretrained_word2vec_matrix)
+
+        # Inference
+        plain_scores, xla_scores = [sess.run(harnn.scores, inference_feed_dict) for sess in (plain_sess, xla_sess)]
+        diff = float(np.abs(plain_scores - xla_scores).max())
+        mismatch = mismatch or diff > args.xla_tolerance
+        logger.info("Inference scores: max diff {0:.2e}".format(diff))
+
+        # One training step from the same weights
+        if args.sampled_loss:
+            # The sampled classes come from a random op, which XLA implements with its own generator
+            logger.info("Training step: not compared with --sampled-loss")
+        else:
+            plain_loss, xla_loss = [sess.run([harnn.train_loss, train_op], train_feed_dict)[0]
+                                    for sess in (plain_sess, xla_sess)]
+            variables = tf.trainable_variables()
+            diff = max(float(np.abs(plain - jit).max())
+                       for plain, jit in zip(plain_sess.run(variables), xla_sess.run(variables)))
+            mismatch = mismatch or diff > args.xla_tolerance or abs(plain_loss - xla_loss) > args.xla_tolerance
+            logger.info("Training step: loss {0:g} vs {1:g}, updated weights max diff {2:.2e}"
+                        .format(plain_loss, xla_loss, diff))
+
+        # Step times
+        times = {}
+        for name, sess in (("plain", plain_sess), ("xla", xla_sess)):
+            times[name] = (timeit(sess, train_op, train_feed_dict, args.benchmark_steps),
+                           timeit(sess, harnn.scores, inference_feed_dict, args.benchmark_steps))
+        for step, index in (("Training", 0), ("Inference", 1)):
+            logger.info("{0} step: {1:.2f} ms plain, {2:.2f} ms XLA, {3:.2f}x".format(
+                step, times['plain'][index], times['xla'][index], times['plain'][index] / times['xla'][index]))
+        plain_sess.close()
+        xla_sess.close()
+
+    if mismatch:
+        logger.info("The XLA graph doesn't match the plain graph within {0:g}".format(args.xla_tolerance))
+    return 1 if mismatch else 0
+
+
+if __name__ == '__main__':
+    sys.exit(benchmark_xla())
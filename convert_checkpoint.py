@@ -0,0 +1,96 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import os
+import sys
+import time
+import logging
+
+sys.path.append('../')
+logging.getLogger('tensorflow').disabled = True
+
+import tensorflow as tf
+from text_harnn import TextHARNN
+from utils import checkmate as cm
+from utils import data_helpers as dh
+from utils import param_parser as parser
+from utils import session_config as sc
+
+args = parser.parameter_parser()
+MODEL = dh.get_model_name()
+logger = dh.logger_fn("tflog", "logs/Convert-{0}.log".format(time.asctime()))
+
+CPT_DIR = 'runs/' + MODEL + '/checkpoints/'
+BEST_CPT_DIR = 'runs/' + MODEL + '/bestcheckpoints/'
+
+
+def convert_checkpoint():
+    """
+    Rebuild the HARNN model with the --lstm-backend (and the other model parameters) of this run
+    and restore the weights of a checkpoint saved by either backend.
+    The test and visualization scripts load the meta graph stored with the checkpoint, so a model trained
+    with one backend is served with the other by converting it into a new run first.
+    """
+    dh.tab_printer(args, logger)
+
+    OPTION = dh._option(pattern=1)
+    if OPTION == 'B':
+        logger.info("Loading best model...")
+        checkpoint_file = cm.get_best_checkpoint(BEST_CPT_DIR, select_maximum_value=True)
+    else:
+        logger.info("Loading latest model...")
+        checkpoint_file = tf.train.latest_checkpoint(CPT_DIR)
+    logger.info(checkpoint_file)
+
+    vocab_map = dh.load_vocab_map('runs/' + MODEL)
+    VOCAB_SIZE, EMBEDDING_SIZE, pretrained_word2vec_matrix = dh.load_word2vec_matrix(args.word2vec_file,
+                                                                                      args.embedding_matrix_file,
+                                                                                      vocab_map)
+    with tf.Graph().as_default():
+        harnn = TextHARNN(
+            sequence_length=args.pad_seq_len,
+            vocab_size=VOCAB_SIZE,
+            embedding_type=args.embedding_type,
+            embedding_size=EMBEDDING_SIZE,
+            lstm_hidden_size=args.lstm_dim,
+            attention_unit_size=args.attention_dim,
+            fc_hidden_size=args.fc_dim,
+            num_classes_list=args.num_classes_list,
+            total_classes=args.total_classes,
+            l2_reg_lambda=args.l2_lambda,
+            pretrained_embedding=pretrained_word2vec_matrix,
+            lstm_layers=args.lstm_layers,
+            lstm_backend=args.lstm_backend,
+            embedding_dim=args.embedding_dim,
+            embedding_rank=args.embedding_rank)
+
+        # The optimizer slots (Adam) of the checkpoint are not needed to serve the model
+        checkpoint_variables = dict(tf.train.list_variables(checkpoint_file))
+        variables = tf.global_variables()
+        missing = [v.op.name for v in variables if v.op.name not in checkpoint_variables]
+        if missing:
+            raise IOError("[Error] The checkpoint doesn't match the model parameters, missing: {0}".format(missing))
+        mismatched = [v.op.name for v in variables
+                      if v.get_shape().as_list() != checkpoint_variables[v.op.name]]
+        if mismatched:
+            raise IOError("[Error] The checkpoint doesn't match the model parameters, shapes differ: {0}"
+                          .format(mismatched))
+
+        out_dir = os.path.abspath(os.path.join(os.path.curdir, "runs", str(int(time.time()))))
+        checkpoint_prefix = os.path.join(out_dir, "checkpoints", "model")
+        os.makedirs(os.path.dirname(checkpoint_prefix))
+        if vocab_map is not None:
+            dh.save_vocab_map(out_dir, vocab_map)
+
+        with tf.Session(config=sc.create_session_config(args)) as sess:
+            saver = tf.train.Saver(variables)
+            saver.restore(sess, checkpoint_file)
+            current_step = sess.run(harnn.global_step)
+            path = saver.save(sess, checkpoint_prefix, global_step=current_step)
+            logger.info("Converted the model to the {0} LSTM backend: {1}".format(args.lstm_backend, path))
+
+    logger.info("Done.")
+
+
+if __name__ == '__main__':
+    convert_checkpoint()
@@ -0,0 +1,25 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import sys
+import logging
+
+sys.path.append('../')
+
+from utils import data_helpers as dh
+from utils import param_parser as parser
+
+args = parser.parameter_parser()
+logger = dh.logger_fn("tflog", "logs/Export-embedding.log")
+
+
+def export_embedding():
+    """Export the BERT input embedding table for memory-mapped loading."""
+    logger.info("Exporting the embedding matrix of {0}...".format(dh.BERT_PATH_ROOT))
+    shape = dh.export_word2vec_matrix(args.embedding_matrix_file)
+    logger.info("Saved {0} float32 matrix to {1}".format(shape, args.embedding_matrix_file))
+    logger.info("All Done.")
+
+
+if __name__ == '__main__':
+    export_embedding()
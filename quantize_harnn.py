@@ -0,0 +1,356 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import os
+import sys
+import time
+import json
+import logging
+import numpy as np
+
+sys.path.append('../')
+logging.getLogger('tensorflow').disabled = True
+
+import tensorflow as tf
+from tensorflow.core.framework import graph_pb2, node_def_pb2
+from text_harnn import level_name
+from utils import checkmate as cm
+from utils import data_helpers as dh
+from utils import param_parser as parser
+from utils import session_config as sc
+from sklearn.metrics import precision_score, recall_score, f1_score, average_precision_score
+
+args = parser.parameter_parser()
+MODEL = dh.get_model_name()
+logger = dh.logger_fn("tflog", "logs/Quantize-{0}.log".format(time.asctime()))
+
+CPT_DIR = 'runs/' + MODEL + '/checkpoints/'
+BEST_CPT_DIR = 'runs/' + MODEL + '/bestcheckpoints/'
+SAVE_DIR = 'output/' + MODEL
+
+OUTPUT_NODE_NAMES = [level_name(level) + "output/scores" for level in range(len(args.num_classes_list))] + \
+                    ["output/scores"]
+LEVEL_NAMES = ["Level-{0}".format(level + 1) for level in range(len(args.num_classes_list))] + ["All"]
+
+# Smaller weights (biases, highway gates...) stay in fp32, they weigh nothing
+MIN_QUANTIZED_ELEMENTS = 1024
+GATHER_OPS = ('Gather', 'GatherV2')
+
+
+def quantize_per_channel(weights, axis):
+    """
+    Symmetric int8 quantization with one scale per channel.
+
+    Args:
+        weights: The float32 weights (rank 2)
+        axis: The channel axis (0: one scale per row, 1: one scale per column)
+    Returns:
+        quantized: The int8 weights
+        scale: The float32 scales, broadcastable to the weights
+    """
+    scale = np.max(np.abs(weights), axis=1 - axis, keepdims=True) / 127.0
+    scale[scale == 0] = 1.0
+    quantized = np.clip(np.round(weights / scale), -127, 127).astype(np.int8)
+    return quantized, scale.astype(np.float32)
+
+
+def _const_node(name, array, device=""):
+    node = node_def_pb2.NodeDef(name=name, op='Const', device=device)
+    node.attr['dtype'].type = tf.as_dtype(array.dtype).as_datatype_enum
+    node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(array))
+    return node
+
+
+def _cast_node(name, input_name, device=""):
+    node = node_def_pb2.NodeDef(name=name, op='Cast', input=[input_name], device=device)
+    node.attr['SrcT'].type = tf.int8.as_datatype_enum
+    node.attr['DstT'].type = tf.float32.as_datatype_enum
+    return node
+
+
+def _mul_node(name, x_name, y_name, device=""):
+    node = node_def_pb2.NodeDef(name=name, op='Mul', input=[x_name, y_name], device=device)
+    node.attr['T'].type = tf.float32.as_datatype_enum
+    return node
+
+
+def _gather_node(name, template, params_name, params_dtype):
+    node = node_def_pb2.NodeDef()
+    node.CopyFrom(template)
+    node.name = name
+    node.input[0] = params_name
+    node.attr['Tparams'].type = params_dtype.as_datatype_enum
+    return node
+
+
+def _input_node_name(input_name):
+    return input_name.lstrip('^').split(':')[0]
+
+
+def find_weights(graph_def):
+    """
+    Find the weights worth quantizing in the frozen graph: the float32 constants of rank 2
+    (the variables become constants when the graph is frozen).
+
+    Args:
+        graph_def: The frozen GraphDef
+    Returns:
+        weights: <dict> The weight name -> the float32 values
+        gathers: <dict> The weight name -> the gather nodes reading rows of it (the embedding tables)
+    """
+    nodes = {node.name: node for node in graph_def.node}
+    weights = {}
+    for node in graph_def.node:
+        if node.op == 'Const' and node.attr['dtype'].type == tf.float32.as_datatype_enum:
+            shape = [dim.size for dim in node.attr['value'].tensor.tensor_shape.dim]
+            if len(shape) == 2 and np.prod(shape) >= MIN_QUANTIZED_ELEMENTS:
+                weights[node.name] = tf.make_ndarray(node.attr['value'].tensor)
+
+    gathers = {}
+    for node in graph_def.node:
+        if node.op in GATHER_OPS:
+            params = _input_node_name(node.input[0])
+            while nodes[params].op == 'Identity':  # The read of the variable
+                params = _input_node_name(nodes[params].input[0])
+            if params in weights:
+                gathers.setdefault(params, []).append(node)
+    return weights, gathers
+
+
+def quantize_graph(graph_def, weight_names):
+    """
+    Rewrite the frozen graph with int8 weights.
+    The tables read by a gather (embedding) are quantized per row and the rows are gathered
+    in int8 and dequantized after the gather, so the fp32 table is gone from the graph and from memory.
+    The other weights (LSTM, attention, FC) are quantized per output channel and dequantized in place
+    (Cast * scale under the name of the former constant, so the consumers are unchanged).
+
+    Args:
+        graph_def: The frozen GraphDef
+        weight_names: The names of the weights to quantize
+    Returns:
+        The quantized GraphDef
+    """
+    weights, gathers = find_weights(graph_def)
+    weight_names = set(weight_names)
+
+    # Gather then dequantize
+    replaced = {}
+    extra_nodes = []
+    for name in weight_names & set(gathers):
+        device = next(node.device for node in graph_def.node if node.name == name)
+        quantized, scale = quantize_per_channel(weights[name], axis=0)
+        extra_nodes.append(_const_node(name + "/quantized", quantized, device))
+        extra_nodes.append(_const_node(name + "/scale", scale, device))
+        for gather in gathers[name]:
+            extra_nodes.append(_gather_node(gather.name + "/quantized", gather, name + "/quantized", tf.int8))
+            extra_nodes.append(_gather_node(gather.name + "/scale", gather, name + "/scale", tf.float32))
+            extra_nodes.append(_cast_node(gather.name + "/dequantize", gather.name + "/quantized", gather.device))
+            replaced[gather.name] = _mul_node(gather.name, gather.name + "/dequantize", gather.name + "/scale",
+                                              gather.device)
+    output_graph_def = graph_pb2.GraphDef()
+    output_graph_def.versions.CopyFrom(graph_def.versions)
+    output_graph_def.library.CopyFrom(graph_def.library)
+    output_graph_def.node.extend(replaced.get(node.name, node) for node in graph_def.node)
+    output_graph_def.node.extend(extra_nodes)
+    # Drop the fp32 tables which are not read anymore
+    output_graph_def = tf.graph_util.extract_sub_graph(output_graph_def, OUTPUT_NODE_NAMES)
+
+    # Dequantize in place (also the tables which are still read by something else than a gather)
+    remaining = {node.name for node in output_graph_def.node} & weight_names
+    graph_def, output_graph_def = output_graph_def, graph_pb2.GraphDef()
+    output_graph_def.versions.CopyFrom(graph_def.versions)
+    output_graph_def.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.name not in remaining:
+            output_graph_def.node.extend([node])
+            continue
+        # The outputs are the rows of the tables and of the attention weights (W_s1 · x), the columns otherwise
+        rows = node.name in gathers or node.name.split('/')[-1] in ('W_s1', 'W_s2')
+        quantized, scale = quantize_per_channel(weights[node.name], axis=0 if rows else 1)
+        output_graph_def.node.extend([
+            _const_node(node.name + "/quantized", quantized, node.device),
+            _const_node(node.name + "/scale", scale, node.device),
+            _cast_node(node.name + "/dequantize", node.name + "/quantized", node.device),
+            _mul_node(node.name, node.name + "/dequantize", node.name + "/scale", node.device)
+        ])
+    return output_graph_def
+
+
+class _Scorer(object):
+    """Runs a frozen (fp32 or quantized) HARNN graph."""
+
+    def __init__(self, graph_def):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.sess = tf.Session(graph=self.graph, config=sc.create_session_config(args))
+        self.outputs = [self.graph.get_tensor_by_name(name + ":0") for name in OUTPUT_NODE_NAMES]
+        self.feeds = {}
+        for name, value in (("dropout_keep_prob", 1.0), ("alpha", args.alpha), ("is_training", False)):
+            try:
+                self.feeds[self.graph.get_tensor_by_name(name + ":0")] = value
+            except KeyError:
+                pass  # Pruned away with the training part of the graph
+        self.input_x = self.graph.get_tensor_by_name("input_x:0")
+
+    def run(self, x_batch):
+        feed_dict = dict(self.feeds)
+        feed_dict[self.input_x] = x_batch
+        return self.sess.run(self.outputs, feed_dict)
+
+    def close(self):
+        self.sess.close()
+
+
+def evaluate(scorer, batches):
+    """
+    Args:
+        scorer: The _Scorer
+        batches: <list> The (x_batch, y_batch_list) batches, y_batch_list following OUTPUT_NODE_NAMES
+    Returns:
+        <list> The precision, recall, F1 (by threshold) and AUPRC of each level
+        The seconds spent scoring per batch
+    """
+    true_labels = [[] for _ in OUTPUT_NODE_NAMES]
+    predicted_scores = [[] for _ in OUTPUT_NODE_NAMES]
+    seconds = 0.0
+    for x_batch, y_batch_list in batches:
+        start = time.perf_counter()
+        batch_scores = scorer.run(x_batch)
+        seconds += time.perf_counter() - start
+        for level, (y_batch, scores) in enumerate(zip(y_batch_list, batch_scores)):
+            true_labels[level].append(y_batch)
+            predicted_scores[level].append(scores)
+
+    metrics = []
+    for y_true, y_score in zip(true_labels, predicted_scores):
+        y_true, y_score = np.concatenate(y_true), np.concatenate(y_score)
+        y_pred = dh.get_onehot_label_threshold(scores=y_score, threshold=args.threshold)
+        metrics.append({
+            'precision': precision_score(y_true=y_true, y_pred=np.array(y_pred), average='micro'),
+            'recall': recall_score(y_true=y_true, y_pred=np.array(y_pred), average='micro'),
+            'f1': f1_score(y_true=y_true, y_pred=np.array(y_pred), average='micro'),
+            'auprc': average_precision_score(y_true=y_true, y_score=y_score, average='micro')
+        })
+    return metrics, seconds / max(len(batches), 1)
+
+
+def load_batches(data_file, vocab_map, max_batches=None):
+    data = dh.load_data_and_labels(data_file, args.num_classes_list, args.total_classes, args.word2vec_file,
+                                   cache_dir=args.data_cache_dir, num_workers=args.num_workers,
+                                   tokenize_mode=args.tokenize_mode)
+    if vocab_map is not None:
+        data = dh.remap_data(data, vocab_map)
+    x, y, y_tuple = dh.pad_data(data, args.pad_seq_len, dynamic=True)
+    batches = []
+    for _, x_batch, y_batch, y_batch_tuple in dh.batch_sampler(x, y, y_tuple, args.batch_size, 1, shuffle=False,
+                                                               prefetch_size=args.prefetch_batches,
+                                                               pad_seq_len=args.pad_seq_len):
+        batches.append((x_batch, list(y_batch_tuple) + [y_batch]))
+        if max_batches is not None and len(batches) >= max_batches:
+            break
+    return batches
+
+
+def calibrate(graph_def, weights, batches):
+    """
+    Calibration: quantize one weight at a time and measure how far the scores move on the calibration batches.
+    The weights which move the scores more than --max-score-deviation stay in fp32.
+
+    Returns:
+        The names of the weights to quantize
+    """
+    reference = _Scorer(graph_def)
+    reference_scores = [reference.run(x_batch) for x_batch, _ in batches]
+    reference.close()
+
+    selected = []
+    for name in sorted(weights):
+        scorer = _Scorer(quantize_graph(graph_def, [name]))
+        deviation = max(float(np.max(np.abs(quantized - fp32)))
+                        for (x_batch, _), expected in zip(batches, reference_scores)
+                        for quantized, fp32 in zip(scorer.run(x_batch), expected))
+        scorer.close()
+        keep = deviation <= args.max_score_deviation
+        logger.info("{0}: {1} int8, max score deviation {2:.5f}{3}".format(
+            name, weights[name].shape, deviation, "" if keep else " -> kept in fp32"))
+        if keep:
+            selected.append(name)
+    return selected
+
+
+def quantize_harnn():
+    """Quantize the HARNN model to int8 and compare it with the fp32 model."""
+    dh.tab_printer(args, logger)
+
+    OPTION = dh._option(pattern=1)
+    if OPTION == 'B':
+        logger.info("Loading best model...")
+        checkpoint_file = cm.get_best_checkpoint(BEST_CPT_DIR, select_maximum_value=True)
+    else:
+        logger.info("Loading latest model...")
+        checkpoint_file = tf.train.latest_checkpoint(CPT_DIR)
+    logger.info(checkpoint_file)
+
+    vocab_map = dh.load_vocab_map('runs/' + MODEL)
+
+    # Freeze the fp32 graph
+    graph = tf.Graph()
+    with graph.as_default():
+        with tf.Session(config=sc.create_session_config(args)) as sess:
+            saver = tf.train.import_meta_graph("{0}.meta".format(checkpoint_file))
+            saver.restore(sess, checkpoint_file)
+            _, _, embedding_matrix = dh.load_word2vec_matrix(args.word2vec_file, args.embedding_matrix_file,
+                                                             vocab_map)
+            cm.init_frozen_embedding(sess, embedding_matrix)
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph_def, OUTPUT_NODE_NAMES)
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, OUTPUT_NODE_NAMES)
+
+    logger.info("Calibrating...")
+    weights, _ = find_weights(graph_def)
+    calibration_batches = load_batches(args.validation_file, vocab_map, max_batches=args.calibration_batches)
+    quantized_names = calibrate(graph_def, weights, calibration_batches)
+    quantized_graph_def = quantize_graph(graph_def, quantized_names)
+
+    fp32_file = os.path.join("graph", "graph-harnn-{0}.pb".format(MODEL))
+    int8_file = os.path.join("graph", "graph-harnn-{0}-int8.pb".format(MODEL))
+    tf.train.write_graph(graph_def, "graph", os.path.basename(fp32_file), as_text=False)
+    tf.train.write_graph(quantized_graph_def, "graph", os.path.basename(int8_file), as_text=False)
+
+    logger.info("Evaluating...")
+    test_batches = load_batches(args.test_file, vocab_map)
+    report = {'checkpoint': checkpoint_file, 'quantized_weights': quantized_names, 'models': {}}
+    for model, model_graph_def, model_file in (('fp32', graph_def, fp32_file),
+                                               ('int8', quantized_graph_def, int8_file)):
+        scorer = _Scorer(model_graph_def)
+        scorer.run(test_batches[0][0])  # Warm up
+        metrics, seconds_per_batch = evaluate(scorer, test_batches)
+        scorer.close()
+        report['models'][model] = {
+            'file': model_file,
+            'size_mb': os.path.getsize(model_file) / 1024.0 / 1024.0,
+            'ms_per_batch': seconds_per_batch * 1000.0,
+            'levels': dict(zip(LEVEL_NAMES, metrics))
+        }
+
+    fp32, int8 = report['models']['fp32'], report['models']['int8']
+    logger.info("Size: fp32 {0:.1f}MB, int8 {1:.1f}MB | Latency: fp32 {2:.1f}ms, int8 {3:.1f}ms per batch"
+                .format(fp32['size_mb'], int8['size_mb'], fp32['ms_per_batch'], int8['ms_per_batch']))
+    for level in LEVEL_NAMES:
+        logger.info("{0}: Precision {1:g} -> {2:g}, Recall {3:g} -> {4:g}, F1 {5:g} -> {6:g}, AUPRC {7:g} -> {8:g}"
+                    .format(level, fp32['levels'][level]['precision'], int8['levels'][level]['precision'],
+                            fp32['levels'][level]['recall'], int8['levels'][level]['recall'],
+                            fp32['levels'][level]['f1'], int8['levels'][level]['f1'],
+                            fp32['levels'][level]['auprc'], int8['levels'][level]['auprc']))
+
+    if not os.path.exists(SAVE_DIR):
+        os.makedirs(SAVE_DIR)
+    with open(os.path.join(SAVE_DIR, "quantization.json"), 'w') as fout:
+        json.dump(report, fout, indent=2)
+
+    logger.info("All Done.")
+
+
+if __name__ == '__main__':
+    quantize_harnn()
@@ -12,10 +12,13 @@ sys.path.append('../')
 logging.getLogger('tensorflow').disabled = True
 
 import tensorflow as tf
+from text_harnn import TextHARNN, level_name
 from utils import checkmate as cm
 from utils import data_helpers as dh
+from utils import label_decoding as ld
+from utils import metrics as mt
 from utils import param_parser as parser
-from sklearn.metrics import precision_score, recall_score, f1_score, roc_auc_score, average_precision_score
+from utils import session_config as sc
 
 args = parser.parameter_parser()
 MODEL = dh.get_model_name()
@@ -35,10 +38,17 @@ def test_harnn():
     logger.info("Loading data...")
     logger.info("Data processing...")
     test_data = dh.load_data_and_labels(args.test_file, args.num_classes_list, args.total_classes,
-                                        args.word2vec_file, data_aug_flag=False)
+                                        args.word2vec_file,
+                                        cache_dir=args.data_cache_dir, num_workers=args.num_workers,
+                                        tokenize_mode=args.tokenize_mode)
+
+    # Apply the vocab map of the run (if its vocab was pruned)
+    vocab_map = dh.load_vocab_map('runs/' + MODEL)
+    if vocab_map is not None:
+        test_data = dh.remap_data(test_data, vocab_map)
 
     logger.info("Data padding...")
-    x_test, y_test, y_test_tuple = dh.pad_data(test_data, args.pad_seq_len)
+    x_test, y_test, y_test_tuple = dh.pad_data(test_data, args.pad_seq_len, dynamic=args.bucket_size > 0)
     y_test_labels = test_data.labels
 
     # Load harnn model
@@ -53,47 +63,98 @@ def test_harnn():
 
     graph = tf.Graph()
     with graph.as_default():
-        session_conf = tf.ConfigProto(
-            allow_soft_placement=args.allow_soft_placement,
-            log_device_placement=args.log_device_placement)
-        session_conf.gpu_options.allow_growth = args.gpu_options_allow_growth
+        session_conf = sc.create_session_config(args)
         sess = tf.Session(config=session_conf)
         with sess.as_default():
-            # Load the saved meta graph and restore variables
-            saver = tf.train.import_meta_graph("{0}.meta".format(checkpoint_file))
+            VOCAB_SIZE, EMBEDDING_SIZE, embedding_matrix = dh.load_word2vec_matrix(
+                args.word2vec_file, args.embedding_matrix_file, vocab_map)
+            if args.gated_inference:
+                # Rebuild the model with the parent gating (same variables) and restore the weights
+                hierarchy = dh.load_hierarchy('runs/' + MODEL)
+                if hierarchy is None:
+                    logger.info("Deriving the label hierarchy from the training data...")
+                    train_data = dh.load_data_and_labels(args.train_file, args.num_classes_list, args.total_classes,
+                                                         args.word2vec_file,
+                                                         cache_dir=args.data_cache_dir, num_workers=args.num_workers,
+                                                         tokenize_mode=args.tokenize_mode)
+                    hierarchy = dh.build_hierarchy(train_data)
+                    dh.save_hierarchy('runs/' + MODEL, hierarchy)
+                harnn = TextHARNN(
+                    sequence_length=args.pad_seq_len,
+                    vocab_size=VOCAB_SIZE,
+                    embedding_type=args.embedding_type,
+                    embedding_size=EMBEDDING_SIZE,
+                    lstm_hidden_size=args.lstm_dim,
+                    attention_unit_size=args.attention_dim,
+                    fc_hidden_size=args.fc_dim,
+                    num_classes_list=args.num_classes_list,
+                    total_classes=args.total_classes,
+                    l2_reg_lambda=args.l2_lambda,
+                    pretrained_embedding=embedding_matrix,
+                    lstm_layers=args.lstm_layers,
+                    lstm_backend=args.lstm_backend,
+                    embedding_dim=args.embedding_dim,
+                    embedding_rank=args.embedding_rank,
+                    hierarchy=hierarchy,
+                    gated_inference=True,
+                    gate_threshold=args.gate_threshold)
+                saver = tf.train.Saver(tf.global_variables())
+            else:
+                # Load the saved meta graph and restore variables
+                saver = tf.train.import_meta_graph("{0}.meta".format(checkpoint_file))
             saver.restore(sess, checkpoint_file)
+            # The frozen embedding (embedding types 2 and 3) is not in the checkpoint
+            cm.init_frozen_embedding(sess, embedding_matrix)
 
             # Get the placeholders from the graph by name
             input_x = graph.get_operation_by_name("input_x").outputs[0]
-            input_y_first = graph.get_operation_by_name("input_y_first").outputs[0]
-            input_y_second = graph.get_operation_by_name("input_y_second").outputs[0]
-            input_y_third = graph.get_operation_by_name("input_y_third").outputs[0]
-            #input_y_fourth = graph.get_operation_by_name("input_y_fourth").outputs[0]
+            input_y_local = graph.get_operation_by_name("input_y_local").outputs[0]
             input_y = graph.get_operation_by_name("input_y").outputs[0]
             dropout_keep_prob = graph.get_operation_by_name("dropout_keep_prob").outputs[0]
             alpha = graph.get_operation_by_name("alpha").outputs[0]
             is_training = graph.get_operation_by_name("is_training").outputs[0]
 
             # Tensors we want to evaluate
-            first_scores = graph.get_operation_by_name("first-output/scores").outputs[0]
-            second_scores = graph.get_operation_by_name("second-output/scores").outputs[0]
-            third_scores = graph.get_operation_by_name("third-output/scores").outputs[0]
-            #fourth_scores = graph.get_operation_by_name("fourth-output/scores").outputs[0]
+            # The scores of all the levels come in one tensor, split by num_classes_list
+            local_scores = graph.get_operation_by_name("output/local_scores").outputs[0]
             scores = graph.get_operation_by_name("output/scores").outputs[0]
-            loss = graph.get_operation_by_name("loss/loss").outputs[0]
-
-            # Split the output nodes name by '|' if you have several output nodes
-            #output_node_names = "first-output/scores|second-output/scores|third-output/scores|fourth-output/scores|output/scores"
-            output_node_names = "first-output/scores|second-output/scores|third-output/scores|output/scores"
+            # The gated graph gives the pruned classes -1e9 logits, its loss is meaningless
+            losses = [] if args.gated_inference else [graph.get_operation_by_name("loss/loss").outputs[0]]
+            level_splits = np.cumsum(args.num_classes_list)[:-1]
+            num_levels = len(args.num_classes_list)
+            # The FLOPs of the class-dependent layers with and without the parent gating
+            class_flops = [harnn.class_flops, harnn.dense_class_flops] if args.gated_inference else []
+            test_class_flops, test_dense_class_flops = 0.0, 0.0
+
+            # The output nodes: the scores of each level and the final scores
+            output_node_names = [level_name(level) + "output/scores" for level in range(num_levels)] + \
+                                ["output/scores"]
+
+            # The dense model of the same checkpoint, to measure what the gating changes
+            dense_sess = None
+            if args.gated_inference and args.gate_check:
+                dense_graph = tf.Graph()
+                with dense_graph.as_default():
+                    dense_sess = tf.Session(config=session_conf)
+                    tf.train.import_meta_graph("{0}.meta".format(checkpoint_file)).restore(dense_sess, checkpoint_file)
+                    cm.init_frozen_embedding(dense_sess, embedding_matrix)
+                dense_scores = dense_graph.get_operation_by_name("output/scores").outputs[0]
+                dense_inputs = [dense_graph.get_operation_by_name(name).outputs[0] for name in
+                                ("input_x", "input_y_local", "input_y", "dropout_keep_prob", "alpha", "is_training")]
+                dense_metrics = mt.StreamingMetrics(threshold=args.threshold, num_bins=args.metrics_bins,
+                                                    exact=args.exact_metrics)
+                max_score_diff, sum_score_diff, num_scores = 0.0, 0.0, 0
 
             # Save the .pb model file
-            output_graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph_def,
-                                                                            output_node_names.split("|"))
-            tf.train.write_graph(output_graph_def, "graph", "graph-harnn-{0}.pb".format(MODEL), as_text=False)
+            output_graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph_def, output_node_names)
+            tf.train.write_graph(output_graph_def, "graph", "graph-harnn-{0}{1}.pb".format(
+                MODEL, "-gated" if args.gated_inference else ""), as_text=False)
 
             # Generate batches for one epoch
-            batches = dh.batch_iter(list(zip(x_test, y_test, y_test_tuple, y_test_labels)),
-                                    args.batch_size, 1, shuffle=False)
+            # Padded per batch, but not bucketed: the predictions have to keep the order of the test data
+            batches = dh.batch_sampler(x_test, y_test, y_test_tuple, args.batch_size, 1, shuffle=False,
+                                       prefetch_size=args.prefetch_batches, pad_seq_len=args.pad_seq_len,
+                                       pad_multiple=args.pad_multiple)
 
             test_counter, test_loss = 0, 0.0
 
@@ -102,76 +163,51 @@ def test_harnn():
             predicted_labels = []
             predicted_scores = []
 
-            # Collect for calculating metrics
-            true_onehot_labels = []
-            predicted_onehot_scores = []
-            predicted_onehot_labels_ts = []
-            predicted_onehot_labels_tk = [[] for _ in range(args.topK)]
-
-            true_onehot_first_labels = []
-            true_onehot_second_labels = []
-            true_onehot_third_labels = []
-            true_onehot_fourth_labels = []
-            predicted_onehot_scores_first = []
-            predicted_onehot_scores_second = []
-            predicted_onehot_scores_third = []
-            predicted_onehot_scores_fourth = []
-            predicted_onehot_labels_first = []
-            predicted_onehot_labels_second = []
-            predicted_onehot_labels_third = []
-            predicted_onehot_labels_fourth = []
-
-            for batch_test in batches:
-                x_batch_test, y_batch_test, y_batch_test_tuple, y_batch_test_labels = zip(*batch_test)
-
-                y_batch_test_first = [i[0] for i in y_batch_test_tuple]
-                y_batch_test_second = [j[1] for j in y_batch_test_tuple]
-                y_batch_test_third = [k[2] for k in y_batch_test_tuple]
-                #y_batch_test_fourth = [t[3] for t in y_batch_test_tuple]
+            # Count for calculating metrics, overall and for each level
+            test_metrics = mt.StreamingMetrics(threshold=args.threshold, num_bins=args.metrics_bins,
+                                               exact=args.exact_metrics)
+            level_metrics = [mt.StreamingMetrics(threshold=args.threshold, num_bins=args.metrics_bins,
+                                                 exact=args.exact_metrics) for _ in range(num_levels)]
+
+            for batch_indices, x_batch_test, y_batch_test, y_batch_test_tuple in batches:
+                y_batch_test_labels = y_test_labels[batch_indices]
 
                 feed_dict = {
                     input_x: x_batch_test,
-                    input_y_first: y_batch_test_first,
-                    input_y_second: y_batch_test_second,
-                    input_y_third: y_batch_test_third,
-                    #input_y_fourth: y_batch_test_fourth,
+                    input_y_local: np.concatenate(y_batch_test_tuple, axis=1),
                     input_y: y_batch_test,
                     dropout_keep_prob: 1.0,
                     alpha: args.alpha,
                     is_training: False
                 }
-                # batch_first_scores, batch_second_scores, batch_third_scores, batch_fourth_scores, batch_scores, cur_loss = \
-                #     sess.run([first_scores, second_scores, third_scores, fourth_scores, scores, loss], feed_dict)
-
-                batch_first_scores, batch_second_scores, batch_third_scores, batch_scores, cur_loss = \
-                    sess.run([first_scores, second_scores, third_scores, scores, loss], feed_dict)
+                batch_local_scores, batch_scores, *batch_rest = \
+                    sess.run([local_scores, scores] + losses + class_flops, feed_dict)
+                if args.gated_inference:
+                    test_class_flops += batch_rest[0]
+                    test_dense_class_flops += batch_rest[1]
+                else:
+                    test_loss = test_loss + batch_rest[0]
+
+                if dense_sess is not None:
+                    batch_dense_scores = dense_sess.run(dense_scores, dict(zip(dense_inputs, [
+                        feed_dict[input_x], feed_dict[input_y_local], feed_dict[input_y], 1.0, args.alpha, False])))
+                    dense_metrics.update(labels=y_batch_test, scores=batch_dense_scores)
+                    score_diff = np.abs(batch_scores - batch_dense_scores)
+                    max_score_diff = max(max_score_diff, float(score_diff.max()))
+                    sum_score_diff += float(score_diff.sum())
+                    num_scores += score_diff.size
 
                 # Prepare for calculating metrics
-                for onehot_labels in y_batch_test:
-                    true_onehot_labels.append(onehot_labels)
-                for onehot_labels in y_batch_test_first:
-                    true_onehot_first_labels.append(onehot_labels)
-                for onehot_labels in y_batch_test_second:
-                    true_onehot_second_labels.append(onehot_labels)
-                for onehot_labels in y_batch_test_third:
-                    true_onehot_third_labels.append(onehot_labels)
-                # for onehot_labels in y_batch_test_fourth:
-                #     true_onehot_fourth_labels.append(onehot_labels)
-
-                for onehot_scores in batch_scores:
-                    predicted_onehot_scores.append(onehot_scores)
-                for onehot_scores in batch_first_scores:
-                    predicted_onehot_scores_first.append(onehot_scores)
-                for onehot_scores in batch_second_scores:
-                    predicted_onehot_scores_second.append(onehot_scores)
-                for onehot_scores in batch_third_scores:
-                    predicted_onehot_scores_third.append(onehot_scores)
-                # for onehot_scores in batch_fourth_scores:
-                #     predicted_onehot_scores_fourth.append(onehot_scores)
-
-                # Get the predicted labels by threshold
+                test_metrics.update(labels=y_batch_test, scores=batch_scores)
+                batch_level_scores = np.split(batch_local_scores, level_splits, axis=1)
+                for metrics, y_batch_level, batch_level_score in zip(level_metrics, y_batch_test_tuple,
+                                                                     batch_level_scores):
+                    metrics.update(labels=y_batch_level, scores=batch_level_score)
+
+                # Get the predictions by threshold
+                batch_predicted_onehot_labels_ts = ld.decode_threshold(scores=batch_scores, threshold=args.threshold)
                 batch_predicted_labels_ts, batch_predicted_scores_ts = \
-                    dh.get_label_threshold(scores=batch_scores, threshold=args.threshold)
+                    ld.predicted_indices(batch_scores, batch_predicted_onehot_labels_ts)
 
                 # Add results to collection
                 for labels in y_batch_test_labels:
@@ -181,108 +217,42 @@ def test_harnn():
                 for values in batch_predicted_scores_ts:
                     predicted_scores.append(values)
 
-                # Get one-hot prediction by threshold
-                batch_predicted_onehot_labels_ts = \
-                    dh.get_onehot_label_threshold(scores=batch_scores, threshold=args.threshold)
-                batch_predicted_onehot_labels_first = \
-                    dh.get_onehot_label_threshold(scores=batch_first_scores, threshold=args.threshold)
-                batch_predicted_onehot_labels_second = \
-                    dh.get_onehot_label_threshold(scores=batch_second_scores, threshold=args.threshold)
-                batch_predicted_onehot_labels_third = \
-                    dh.get_onehot_label_threshold(scores=batch_third_scores, threshold=args.threshold)
-                # batch_predicted_onehot_labels_fourth = \
-                #     dh.get_onehot_label_threshold(scores=batch_fourth_scores, threshold=args.threshold)
-
-                for onehot_labels in batch_predicted_onehot_labels_ts:
-                    predicted_onehot_labels_ts.append(onehot_labels)
-                for onehot_labels in batch_predicted_onehot_labels_first:
-                    predicted_onehot_labels_first.append(onehot_labels)
-                for onehot_labels in batch_predicted_onehot_labels_second:
-                    predicted_onehot_labels_second.append(onehot_labels)
-                for onehot_labels in batch_predicted_onehot_labels_third:
-                    predicted_onehot_labels_third.append(onehot_labels)
-                # for onehot_labels in batch_predicted_onehot_labels_fourth:
-                #     predicted_onehot_labels_fourth.append(onehot_labels)
-
-                # Get one-hot prediction by topK
-                for i in range(args.topK):
-                    batch_predicted_onehot_labels_tk = dh.get_onehot_label_topk(scores=batch_scores, top_num=i + 1)
-
-                    for onehot_labels in batch_predicted_onehot_labels_tk:
-                        predicted_onehot_labels_tk[i].append(onehot_labels)
-
-                test_loss = test_loss + cur_loss
                 test_counter = test_counter + 1
 
-            # Calculate Precision & Recall & F1
-            test_pre_ts = precision_score(y_true=np.array(true_onehot_labels),
-                                          y_pred=np.array(predicted_onehot_labels_ts), average='micro')
-
-            test_pre_first = precision_score(y_true=np.array(true_onehot_first_labels),
-                                             y_pred=np.array(predicted_onehot_labels_first), average='micro')
-            test_pre_second = precision_score(y_true=np.array(true_onehot_second_labels),
-                                              y_pred=np.array(predicted_onehot_labels_second), average='micro')
-            test_pre_third = precision_score(y_true=np.array(true_onehot_third_labels),
-                                             y_pred=np.array(predicted_onehot_labels_third), average='micro')
-            # test_pre_fourth = precision_score(y_true=np.array(true_onehot_fourth_labels),
-            #                                   y_pred=np.array(predicted_onehot_labels_fourth), average='micro')
-
-            test_rec_ts = recall_score(y_true=np.array(true_onehot_labels),
-                                       y_pred=np.array(predicted_onehot_labels_ts), average='micro')
-
-            test_rec_first = recall_score(y_true=np.array(true_onehot_first_labels),
-                                          y_pred=np.array(predicted_onehot_labels_first), average='micro')
-            test_rec_second = recall_score(y_true=np.array(true_onehot_second_labels),
-                                           y_pred=np.array(predicted_onehot_labels_second), average='micro')
-            test_rec_third = recall_score(y_true=np.array(true_onehot_third_labels),
-                                          y_pred=np.array(predicted_onehot_labels_third), average='micro')
-            # test_rec_fourth = recall_score(y_true=np.array(true_onehot_fourth_labels),
-            #                                y_pred=np.array(predicted_onehot_labels_fourth), average='micro')
-
-            test_F1_ts = f1_score(y_true=np.array(true_onehot_labels),
-                                  y_pred=np.array(predicted_onehot_labels_ts), average='micro')
-
-            test_F1_first = f1_score(y_true=np.array(true_onehot_first_labels),
-                                     y_pred=np.array(predicted_onehot_labels_first), average='micro')
-            test_F1_second = f1_score(y_true=np.array(true_onehot_second_labels),
-                                      y_pred=np.array(predicted_onehot_labels_second), average='micro')
-            test_F1_third = f1_score(y_true=np.array(true_onehot_third_labels),
-                                     y_pred=np.array(predicted_onehot_labels_third), average='micro')
-            # test_F1_fourth = f1_score(y_true=np.array(true_onehot_fourth_labels),
-            #                           y_pred=np.array(predicted_onehot_labels_fourth), average='micro')
-
-            # Calculate the average AUC
-            test_auc = roc_auc_score(y_true=np.array(true_onehot_labels),
-                                     y_score=np.array(predicted_onehot_scores), average='micro')
-
-            # Calculate the average PR
-            test_prc = average_precision_score(y_true=np.array(true_onehot_labels),
-                                               y_score=np.array(predicted_onehot_scores), average="micro")
-            test_prc_first = average_precision_score(y_true=np.array(true_onehot_first_labels),
-                                                     y_score=np.array(predicted_onehot_scores_first), average="micro")
-            test_prc_second = average_precision_score(y_true=np.array(true_onehot_second_labels),
-                                                      y_score=np.array(predicted_onehot_scores_second), average="micro")
-            test_prc_third = average_precision_score(y_true=np.array(true_onehot_third_labels),
-                                                     y_score=np.array(predicted_onehot_scores_third), average="micro")
-            # test_prc_fourth = average_precision_score(y_true=np.array(true_onehot_fourth_labels),
-            #                                           y_score=np.array(predicted_onehot_scores_fourth), average="micro")
-
-            test_loss = float(test_loss / test_counter)
-
-            logger.info("All Test Dataset: Loss {0:g} | AUC {1:g} | AUPRC {2:g}"
-                        .format(test_loss, test_auc, test_prc))
+            # Calculate Precision & Recall & F1, the average AUC and the average PR
+            result = test_metrics.result()
+            test_pre_ts, test_rec_ts, test_F1_ts = result['precision'], result['recall'], result['f1']
+            test_auc, test_prc = result['auc'], result['auprc']
+
+            if args.gated_inference:
+                logger.info("All Test Dataset: AUC {0:g} | AUPRC {1:g}".format(test_auc, test_prc))
+            else:
+                test_loss = float(test_loss / test_counter)
+                logger.info("All Test Dataset: Loss {0:g} | AUC {1:g} | AUPRC {2:g}"
+                            .format(test_loss, test_auc, test_prc))
             # Predict by threshold
             logger.info("Predict by threshold: Precision {0:g}, Recall {1:g}, F1 {2:g}"
                         .format(test_pre_ts, test_rec_ts, test_F1_ts))
 
-            logger.info("Predict by threshold in Level-1: Precision {0:g}, Recall {1:g}, F1 {2:g}, AUPRC {3:g}"
-                        .format(test_pre_first, test_rec_first, test_F1_first, test_prc_first))
-            logger.info("Predict by threshold in Level-2: Precision {0:g}, Recall {1:g}, F1 {2:g}, AUPRC {3:g}"
-                        .format(test_pre_second, test_rec_second, test_F1_second, test_prc_second))
-            logger.info("Predict by threshold in Level-3: Precision {0:g}, Recall {1:g}, F1 {2:g}, AUPRC {3:g}"
-                        .format(test_pre_third, test_rec_third, test_F1_third, test_prc_third))
-            # logger.info("Predict by threshold in Level-4: Precision {0:g}, Recall {1:g}, F1 {2:g}, AUPRC {3:g}"
-            #             .format(test_pre_fourth, test_rec_fourth, test_F1_fourth, test_prc_fourth))
+            for level, metrics in enumerate(level_metrics):
+                result = metrics.result()
+                logger.info("Predict by threshold in Level-{0}: Precision {1:g}, Recall {2:g}, F1 {3:g}, AUPRC {4:g}"
+                            .format(level + 1, result['precision'], result['recall'], result['f1'],
+                                    result['auprc']))
+            if args.gated_inference:
+                logger.info("Parent-gated inference (gate threshold {0:g}): {1:.3g} of {2:.3g} class-dependent "
+                            "GFLOPs computed, {3:.1%} saved".format(
+                                args.gate_threshold, test_class_flops / 1e9, test_dense_class_flops / 1e9,
+                                1.0 - test_class_flops / max(test_dense_class_flops, 1.0)))
+            if dense_sess is not None:
+                dense_result = dense_metrics.result()
+                logger.info("Gated vs dense scores: max |diff| {0:.4g}, mean |diff| {1:.4g}".format(
+                    max_score_diff, sum_score_diff / max(num_scores, 1)))
+                logger.info("Dense model: AUC {0:g} | AUPRC {1:g} | Precision {2:g}, Recall {3:g}, F1 {4:g} "
+                            "(gated: AUC {5:g} | AUPRC {6:g} | F1 {7:g})".format(
+                                dense_result['auc'], dense_result['auprc'], dense_result['precision'],
+                                dense_result['recall'], dense_result['f1'], test_auc, test_prc, test_F1_ts))
+                dense_sess.close()
 
             # Save the prediction result
             if not os.path.exists(SAVE_DIR):
@@ -0,0 +1,43 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import unittest
+import numpy as np
+
+from utils import data_helpers as dh
+
+
+class TestRaggedArray(unittest.TestCase):
+    """The rows of _RaggedArray against the lists they were built from."""
+
+    ROWS = [[1, 2], [], [3], [4, 5, 6]]
+
+    def setUp(self):
+        self.ragged = dh._RaggedArray.from_lists(self.ROWS)
+
+    def test_int_index(self):
+        for i in range(-len(self.ROWS), len(self.ROWS)):
+            np.testing.assert_array_equal(self.ragged[i], self.ROWS[i])
+            np.testing.assert_array_equal(self.ragged[np.int64(i)], self.ROWS[i])
+
+    def test_int_index_out_of_range(self):
+        for i in (len(self.ROWS), -len(self.ROWS) - 1):
+            with self.assertRaises(IndexError):
+                self.ragged[i]
+
+    def test_slice_and_gather(self):
+        for index in (slice(1, 3), slice(None, None, 2), [3, 0, 0]):
+            expected = np.array(self.ROWS, dtype=object)[index].tolist()
+            self.assertEqual([row.tolist() for row in self.ragged[index]], expected)
+
+
+class TestDataWord2vec(unittest.TestCase):
+
+    def test_too_many_levels(self):
+        num_classes_list = [1] * (len(dh.LEVEL_LABEL_KEYS) + 1)
+        with self.assertRaises(IOError):
+            dh.data_word2vec("missing.json", num_classes_list, sum(num_classes_list), indexer=None)
+
+
+if __name__ == '__main__':
+    unittest.main()
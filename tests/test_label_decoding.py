@@ -0,0 +1,106 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import heapq
+import unittest
+import numpy as np
+
+from utils import label_decoding as ld
+
+
+# The per-document loops which label_decoding replaces, kept as the reference
+def _loop_onehot_label_threshold(scores, threshold=0.5):
+    predicted_onehot_labels = []
+    for score in np.ndarray.tolist(scores):
+        count = 0
+        onehot_labels_list = [0] * len(score)
+        for index, predict_score in enumerate(score):
+            if predict_score >= threshold:
+                onehot_labels_list[index] = 1
+                count += 1
+        if count == 0:
+            onehot_labels_list[score.index(max(score))] = 1
+        predicted_onehot_labels.append(onehot_labels_list)
+    return predicted_onehot_labels
+
+
+def _loop_onehot_label_topk(scores, top_num=1):
+    predicted_onehot_labels = []
+    for score in np.ndarray.tolist(scores):
+        onehot_labels_list = [0] * len(score)
+        for i in map(score.index, heapq.nlargest(top_num, score)):
+            onehot_labels_list[i] = 1
+        predicted_onehot_labels.append(onehot_labels_list)
+    return predicted_onehot_labels
+
+
+def _loop_label_threshold(scores, threshold=0.5):
+    predicted_labels, predicted_scores = [], []
+    for score in np.ndarray.tolist(scores):
+        index_list = [index for index, predict_score in enumerate(score) if predict_score >= threshold]
+        if not index_list:
+            index_list = [score.index(max(score))]
+        predicted_labels.append(index_list)
+        predicted_scores.append([score[index] for index in index_list])
+    return predicted_labels, predicted_scores
+
+
+def _loop_label_topk(scores, top_num=1):
+    return [np.ndarray.tolist(np.argsort(score)[-top_num:][::-1]) for score in np.ndarray.tolist(scores)]
+
+
+class TestLabelDecoding(unittest.TestCase):
+    """The vectorized decoding against the loops, on tie-free random scores."""
+
+    NUM_CLASSES = [3, 23, 661]
+    TOP_NUMS = [1, 2, 3, 4, 5]
+
+    def _scores(self, num_classes, batch_size=64, seed=0):
+        # Distinct scores (a permutation of a grid), some documents with no score above 0.5
+        rng = np.random.RandomState(seed + num_classes)
+        scores = np.stack([rng.permutation(num_classes) for _ in range(batch_size)]) / float(num_classes)
+        scores[:batch_size // 4] *= 0.4
+        return scores.astype(np.float32)
+
+    def test_decode_threshold(self):
+        for num_classes in self.NUM_CLASSES:
+            scores = self._scores(num_classes)
+            for threshold in (0.3, 0.5, 0.9):
+                np.testing.assert_array_equal(ld.decode_threshold(scores, threshold),
+                                              np.array(_loop_onehot_label_threshold(scores, threshold), dtype=bool))
+
+    def test_decode_topk(self):
+        for num_classes in self.NUM_CLASSES:
+            scores = self._scores(num_classes)
+            predicted = ld.decode_topk(scores, max(self.TOP_NUMS))
+            for top_num in self.TOP_NUMS:
+                np.testing.assert_array_equal(predicted[top_num - 1],
+                                              np.array(_loop_onehot_label_topk(scores, top_num), dtype=bool))
+
+    def test_top_classes(self):
+        for num_classes in self.NUM_CLASSES:
+            scores = self._scores(num_classes)
+            for top_num in self.TOP_NUMS:
+                np.testing.assert_array_equal(ld.top_classes(scores, top_num),
+                                              np.array(_loop_label_topk(scores, top_num)))
+
+    def test_predicted_indices(self):
+        for num_classes in self.NUM_CLASSES:
+            scores = self._scores(num_classes)
+            labels, values = ld.predicted_indices(scores, ld.decode_threshold(scores, 0.5))
+            loop_labels, loop_values = _loop_label_threshold(scores, 0.5)
+            self.assertEqual([row.tolist() for row in labels], loop_labels)
+            self.assertEqual([row.tolist() for row in values], loop_values)
+
+    def test_ties_in_class_order(self):
+        # Equal scores are taken from the lower class, also at the top_num-th place
+        scores = np.array([[0.5, 0.9, 0.5, 0.5, 0.1],
+                           [0.2, 0.2, 0.2, 0.2, 0.2]], dtype=np.float32)
+        np.testing.assert_array_equal(ld.top_classes(scores, 2), [[1, 0], [0, 1]])
+        np.testing.assert_array_equal(ld.top_classes(scores, 3), [[1, 0, 2], [0, 1, 2]])
+        np.testing.assert_array_equal(ld.decode_topk(scores, 3)[2],
+                                      [[True, True, True, False, False], [True, True, True, False, False]])
+
+
+if __name__ == '__main__':
+    unittest.main()
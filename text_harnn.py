@@ -3,58 +3,200 @@ __author__ = 'Randolph'
 
 import tensorflow as tf
 
+LEVEL_NAMES = ['first', 'second', 'third', 'fourth', 'fifth', 'sixth']
+
+
+def level_name(level):
+    """
+    The scope prefix of a hierarchy level.
+    Args:
+        level: The level index (0 for the first level)
+    Returns:
+        "first-", "second-"... ("level7-" past the named levels)
+    """
+    if level < len(LEVEL_NAMES):
+        return LEVEL_NAMES[level] + "-"
+    return "level{0}-".format(level + 1)
+
 
 class TextHARNN(object):
     """A HARNN for text classification."""
 
     def __init__(
             self, sequence_length, vocab_size, embedding_type, embedding_size, lstm_hidden_size, attention_unit_size,
-            fc_hidden_size, num_classes_list, total_classes, l2_reg_lambda=0.0, pretrained_embedding=None):
+            fc_hidden_size, num_classes_list, total_classes, l2_reg_lambda=0.0, pretrained_embedding=None,
+            input_tensors=None, lstm_layers=1, lstm_backend='dynamic', embedding_dim=None, embedding_rank=8,
+            hierarchy=None, gated_inference=False, gate_threshold=0.5, sampled_loss=False, num_sampled=64):
+
+        def _input(dtype, shape, name, default=None):
+            # With a tf.data pipeline the placeholders default to the iterator tensors, feeding still overrides them
+            if default is None:
+                return tf.placeholder(dtype, shape, name=name)
+            return tf.placeholder_with_default(default, shape, name=name)
+
+        num_levels = len(num_classes_list)
+        if (gated_inference or sampled_loss) and total_classes != sum(num_classes_list):
+            raise ValueError("The parent-gated inference and the sampled loss take the global classes as the classes "
+                             "of the levels one after the other, total_classes ({0}) must be sum(num_classes_list) "
+                             "({1})".format(total_classes, sum(num_classes_list)))
+        if input_tensors is None:
+            input_x, input_y, input_y_local = None, None, None
+        else:
+            input_x, input_y, input_y_tuple = input_tensors
+            input_y_local = tf.concat(list(input_y_tuple), axis=1)
 
         # Placeholders for input, output, dropout_prob and training_tag
-        self.input_x = tf.placeholder(tf.int32, [None, sequence_length], name="input_x")
-        self.input_y_first = tf.placeholder(tf.float32, [None, num_classes_list[0]], name="input_y_first")
-        self.input_y_second = tf.placeholder(tf.float32, [None, num_classes_list[1]], name="input_y_second")
-        self.input_y_third = tf.placeholder(tf.float32, [None, num_classes_list[2]], name="input_y_third")
-        #self.input_y_fourth = tf.placeholder(tf.float32, [None, num_classes_list[3]], name="input_y_fourth")
-        self.input_y = tf.placeholder(tf.float32, [None, total_classes], name="input_y")
+        # The time dimension is left open so each batch can be padded to its own longest document only
+        self.input_x = _input(tf.int32, [None, None], "input_x", input_x)
+        # The labels of all the levels, one level after the other: [batch_size, sum(num_classes_list)]
+        if sampled_loss and input_tensors is None:
+            # The sampled classes of the last level are read from the labels at every step,
+            # the inference doesn't have to feed them
+            input_y_local = tf.zeros(tf.stack([tf.shape(self.input_x)[0], sum(num_classes_list)]))
+        self.input_y_local = _input(tf.float32, [None, sum(num_classes_list)], "input_y_local", input_y_local)
+        self.input_y = _input(tf.float32, [None, total_classes], "input_y", input_y)
+        self.input_y_levels = tf.split(self.input_y_local, num_classes_list, axis=1)
         self.dropout_keep_prob = tf.placeholder(tf.float32, name="dropout_keep_prob")
         self.alpha = tf.placeholder(tf.float32, name="alpha")
         self.is_training = tf.placeholder(tf.bool, name="is_training")
 
         self.global_step = tf.Variable(0, trainable=False, name="Global_Step")
 
-        def _attention(input_x, num_classes, name=""):
+        # Documents are padded with id 0 ([PAD]) at the end, padded steps are masked out of the LSTM,
+        # the pooling and the attention softmax
+        self.sequence_lengths = tf.maximum(
+            tf.reduce_sum(tf.cast(tf.not_equal(self.input_x, 0), tf.int32), axis=1), 1, name="sequence_lengths")
+        self.sequence_mask = tf.sequence_mask(self.sequence_lengths, tf.shape(self.input_x)[1], dtype=tf.float32)
+
+        def _masked_softmax(logits, mask):
             """
-            Attention Layer.
+            Softmax over the last (time) axis which ignores the padded steps.
             Args:
-                input_x: [batch_size, sequence_length, lstm_hidden_size * 2]
+                logits: [batch_size, num_classes, sequence_length]
+                mask: [batch_size, sequence_length]
+            """
+            return tf.nn.softmax(logits + tf.expand_dims((mask - 1.0) * 1e9, 1))
+
+        def _attention_weights(num_units, num_classes, name=""):
+            """
+            The variables of the Attention Layer, created up front so the W_s1 of all levels can be fused.
+            Args:
+                num_units: The size of the attention input (lstm_hidden_size * 2)
                 num_classes: The number of i th level classes
                 name: Scope name
             Returns:
-                attention_matrix: [batch_size, num_classes, sequence_length]
-                attention_weight: [batch_size, num_classes, sequence_length]
-                attention_out: [batch_size, lstm_hidden_size * 2]
+                W_s1: [attention_unit_size, num_units]
+                W_s2: [num_classes, attention_unit_size]
             """
-            num_units = input_x.get_shape().as_list()[-1]
             with tf.name_scope(name + "attention"):
                 W_s1 = tf.Variable(tf.truncated_normal(shape=[attention_unit_size, num_units],
                                                        stddev=0.1, dtype=tf.float32), name="W_s1")
                 W_s2 = tf.Variable(tf.truncated_normal(shape=[num_classes, attention_unit_size],
                                                        stddev=0.1, dtype=tf.float32), name="W_s2")
-                attention_matrix = tf.map_fn(
-                    fn=lambda x: tf.matmul(W_s2, x),
-                    elems=tf.tanh(
-                        tf.map_fn(
-                            fn=lambda x: tf.matmul(W_s1, tf.transpose(x)),
-                            elems=input_x,
-                            dtype=tf.float32
-                        )
-                    )
-                )
-                attention_weight = tf.nn.softmax(attention_matrix, name="attention")
-                attention_out = tf.matmul(attention_weight, input_x)
-                attention_out = tf.reduce_mean(attention_out, axis=1)
+            return W_s1, W_s2
+
+        def _gate(parent_scores, hierarchy_matrix, name=""):
+            """
+            Parent gating: the classes of a level are only computed for the children of the parents
+            whose score reaches gate_threshold.
+            Args:
+                parent_scores: [batch_size, num_parent_classes]
+                hierarchy_matrix: The bool matrix [num_parent_classes, num_classes]
+                name: Scope name
+            Returns:
+                candidates: The classes which survive for some document of the batch, [num_candidates]
+                candidate_mask: [batch_size, num_candidates], 1 where the candidate survives for the document
+                class_mask: [batch_size, num_classes], the same for all the classes
+            """
+            with tf.name_scope(name + "gate"):
+                parents = tf.cast(parent_scores >= gate_threshold, tf.float32)
+                class_mask = tf.cast(tf.matmul(parents, tf.constant(hierarchy_matrix, dtype=tf.float32)) > 0,
+                                     tf.float32)
+                candidates = tf.reshape(tf.where(tf.reduce_any(class_mask > 0, axis=0)), [-1])
+                candidate_mask = tf.gather(class_mask, candidates, axis=1)
+            return candidates, candidate_mask, class_mask
+
+        def _scatter_classes(values, candidates, num_classes):
+            """
+            Returns:
+                The [batch_size, num_candidates] values put back at their classes, [batch_size, num_classes]
+            """
+            shape = tf.stack([tf.constant(num_classes, dtype=tf.int64), tf.cast(tf.shape(values)[0], tf.int64)])
+            return tf.transpose(tf.scatter_nd(tf.expand_dims(candidates, -1), tf.transpose(values), shape))
+
+        def _class_mean(values, candidate_mask=None):
+            """
+            Mean over the classes axis (1) of values. With a candidate mask the mean is over the classes
+            which survive for each document: the attention weights and the visuals (softmax rows) keep summing
+            to 1 over the time steps. This approximates the dense mean, which also averages the rows of the pruned
+            classes, see --gate-check for the score deviation.
+            """
+            if candidate_mask is None:
+                return tf.reduce_mean(values, axis=1)
+            candidate_mask = tf.expand_dims(candidate_mask, -1)
+            return tf.reduce_sum(values * candidate_mask, axis=1) / tf.maximum(
+                tf.reduce_sum(candidate_mask, axis=1), 1.0)
+
+        def _sampled_classes(labels, extra_candidates):
+            """
+            The candidate classes of the sampled loss: the positives of the batch, the extra candidates
+            and num_sampled uniformly sampled classes.
+            Args:
+                labels: [batch_size, num_classes]
+                extra_candidates: [num_classes] bool, the other classes always in (or None)
+            Returns:
+                candidates: The candidate classes, [num_candidates]
+                class_weights: [num_candidates], the weights of the mean of a per-class value over all the classes
+                    estimated from the candidates: 1 / num_classes for the positives and the extra candidates,
+                    which are always in, the other classes are a uniform sample of the rest and stand for all of it
+            """
+            num_classes = labels.get_shape().as_list()[-1]
+            fixed = tf.reduce_any(labels > 0, axis=0)
+            if extra_candidates is not None:
+                fixed = tf.logical_or(fixed, extra_candidates)
+            sampled = tf.random.uniform([num_sampled], maxval=num_classes, dtype=tf.int64)
+            sampled = tf.logical_and(tf.logical_not(fixed), tf.scatter_nd(
+                tf.expand_dims(sampled, -1), tf.ones([num_sampled]), [num_classes]) > 0)
+            candidates = tf.reshape(tf.where(tf.logical_or(fixed, sampled)), [-1])
+            num_fixed = tf.reduce_sum(tf.cast(fixed, tf.float32))
+            num_rest = tf.maximum(tf.reduce_sum(tf.cast(sampled, tf.float32)), 1.0)
+            class_weights = tf.where(fixed, tf.fill([num_classes], 1.0 / num_classes),
+                                     tf.fill([num_classes], (num_classes - num_fixed) / (num_rest * num_classes)))
+            return candidates, tf.gather(class_weights, candidates)
+
+        def _attention(input_x, input_projection, W_s2, mask, name="", gate=None, sampled=None):
+            """
+            Attention Layer, batched over the whole batch (no map_fn).
+            Args:
+                input_x: [batch_size, sequence_length, lstm_hidden_size * 2]
+                input_projection: W_s1 · input_x, [batch_size, sequence_length, attention_unit_size]
+                W_s2: [num_classes, attention_unit_size]
+                mask: [batch_size, sequence_length]
+                name: Scope name
+                gate: The (candidates, candidate_mask, class_mask) of _gate, None to compute all the classes
+                sampled: The (classes, class_weights) of _sampled_classes, None to compute all the classes
+            Returns:
+                attention_weight: [batch_size, num_classes (num_candidates with a gate or sampled classes),
+                    sequence_length]
+                attention_out: [batch_size, lstm_hidden_size * 2]
+            """
+            # Re-enter the scope of the variables
+            with tf.name_scope(name + "attention/"):
+                candidate_mask = None
+                if gate is not None:
+                    W_s2 = tf.gather(W_s2, gate[0])
+                    candidate_mask = gate[1]
+                if sampled is not None:
+                    W_s2 = tf.gather(W_s2, sampled[0])
+                # shape of attention_matrix: [batch_size, num_classes, sequence_length]
+                attention_matrix = tf.einsum('ca,bta->bct', W_s2, tf.tanh(input_projection))
+                attention_weight = tf.identity(_masked_softmax(attention_matrix, mask), name="attention")
+                # mean_c(weight_c · x) == mean_c(weight_c) · x, one contraction instead of num_classes
+                if sampled is not None:
+                    class_mean = tf.einsum('bct,c->bt', attention_weight, sampled[1])
+                else:
+                    class_mean = _class_mean(attention_weight, candidate_mask)
+                attention_out = tf.einsum('bt,btd->bd', class_mean, input_x)
             return attention_weight, attention_out
 
         def _fc_layer(input_x, name=""):
@@ -75,14 +217,21 @@ class TextHARNN(object):
                 fc_out = tf.nn.relu(fc)
             return fc_out
 
-        def _local_layer(input_x, input_att_weight, num_classes, name=""):
+        # The input and the weights of each output layer, for the sampled loss
+        output_layers = {}
+
+        def _local_layer(input_x, input_att_weight, num_classes, mask, name="", gate=None, sampled=None):
             """
             Local Layer
             Args:
                 input_x: [batch_size, fc_hidden_size]
-                input_att_weight: [batch_size, num_classes, sequence_length]
+                input_att_weight: [batch_size, num_classes (num_candidates with a gate or sampled classes),
+                    sequence_length]
                 num_classes: Number of classes
+                mask: [batch_size, sequence_length]
                 name: Scope name
+                gate: The (candidates, candidate_mask, class_mask) of _gate, None to compute all the classes
+                sampled: The (classes, class_weights) of the attention, None for all the classes
             Returns:
                 logits: [batch_size, num_classes]
                 scores: [batch_size, num_classes]
@@ -93,13 +242,29 @@ class TextHARNN(object):
                 W = tf.Variable(tf.truncated_normal(shape=[num_units, num_classes],
                                                     stddev=0.1, dtype=tf.float32), name="W")
                 b = tf.Variable(tf.constant(value=0.1, shape=[num_classes], dtype=tf.float32), name="b")
-                logits = tf.nn.xw_plus_b(input_x, W, b, name="logits")
-                scores = tf.sigmoid(logits, name="scores")
+                output_layers[name] = (input_x, W, b)
+                if gate is None:
+                    logits = tf.nn.xw_plus_b(input_x, W, b, name="logits")
+                    scores = tf.sigmoid(logits, name="scores")
+                else:
+                    # Only the columns of the candidates, the pruned classes get a score of 0
+                    candidates, candidate_mask, class_mask = gate
+                    logits = tf.nn.xw_plus_b(input_x, tf.gather(W, candidates, axis=1), tf.gather(b, candidates))
+                    scores = tf.sigmoid(logits) * candidate_mask
 
                 # shape of visual: [batch_size, sequence_length]
-                visual = tf.multiply(input_att_weight, tf.expand_dims(scores, -1))
-                visual = tf.nn.softmax(visual)
-                visual = tf.reduce_mean(visual, axis=1, name="visual")
+                visual_scores = scores if sampled is None else tf.gather(scores, sampled[0], axis=1)
+                visual = tf.multiply(input_att_weight, tf.expand_dims(visual_scores, -1))
+                visual = _masked_softmax(visual, mask)
+                if sampled is not None:
+                    visual = tf.einsum('bct,c->bt', visual, sampled[1], name="visual")
+                elif gate is None:
+                    visual = tf.reduce_mean(visual, axis=1, name="visual")
+                else:
+                    visual = tf.identity(_class_mean(visual, candidate_mask), name="visual")
+                    logits = tf.add(_scatter_classes(logits, candidates, num_classes), (class_mask - 1.0) * 1e9,
+                                    name="logits")
+                    scores = tf.identity(_scatter_classes(scores, candidates, num_classes), name="scores")
             return logits, scores, visual
 
         def _linear(input_, output_size, scope="SimpleLinear"):
@@ -159,13 +324,60 @@ class TextHARNN(object):
                 if embedding_type == 1:
                     self.embedding = tf.Variable(pretrained_embedding, trainable=True,
                                                  dtype=tf.float32, name="embedding")
+                if embedding_type in (2, 3):
+                    # The pretrained table is frozen: fed once through a placeholder (not stored in the graph),
+                    # in no collection (not saved, not trained, not regularized), see cm.init_frozen_embedding
+                    frozen_embedding_init = tf.placeholder(tf.float32, [vocab_size, embedding_size],
+                                                           name="frozen_embedding_init")
+                    self.embedding = tf.Variable(frozen_embedding_init, trainable=False, collections=[],
+                                                 name="frozen_embedding")
             self.embedded_sentence = tf.nn.embedding_lookup(self.embedding, self.input_x)
+            if pretrained_embedding is not None and embedding_type == 2:
+                # Learn a projection of the frozen vectors to embedding_dim
+                W_projection = tf.Variable(tf.truncated_normal(shape=[embedding_size, embedding_dim],
+                                                               stddev=embedding_size ** -0.5, dtype=tf.float32),
+                                           name="W_projection")
+                self.embedded_sentence = tf.tensordot(self.embedded_sentence, W_projection, axes=[[2], [0]])
+            if pretrained_embedding is not None and embedding_type == 3:
+                # Learn a low-rank delta A · B of the frozen table, A starts at zero so training starts
+                # from the pretrained vectors
+                A_delta = tf.Variable(tf.zeros(shape=[vocab_size, embedding_rank], dtype=tf.float32), name="A_delta")
+                B_delta = tf.Variable(tf.truncated_normal(shape=[embedding_rank, embedding_size],
+                                                          stddev=0.01, dtype=tf.float32), name="B_delta")
+                self.embedded_sentence = self.embedded_sentence + tf.tensordot(
+                    tf.nn.embedding_lookup(A_delta, self.input_x), B_delta, axes=[[2], [0]])
             # Average Vectors
             # [batch_size, embedding_size]
             self.embedded_sentence_average = tf.reduce_mean(self.embedded_sentence, axis=1)
 
-        # Bi-LSTM Layer
-        with tf.name_scope("Bi-lstm"):
+        def _bi_lstm_layer(input_x, sequence_lengths, layer=0):
+            """
+            Bi-LSTM Layer.
+            Both backends create the same variables ({scope}/fw/lstm_cell/kernel, bias, same for bw),
+            so a checkpoint of one backend restores into the other (see convert_checkpoint.py).
+            Args:
+                input_x: [batch_size, sequence_length, input_size]
+                sequence_lengths: [batch_size]
+                layer: The layer index
+            Returns:
+                [batch_size, sequence_length, lstm_hidden_size * 2], zeros at the padded steps
+            """
+            scope = "bidirectional_rnn" if layer == 0 else "bidirectional_rnn_{0}".format(layer)
+            if lstm_backend == 'fused':
+                # One fused block LSTM kernel per direction instead of a while-loop of small ops per step
+                with tf.variable_scope(scope):
+                    inputs = tf.transpose(input_x, [1, 0, 2])  # Time-major
+                    with tf.variable_scope("fw"):
+                        outputs_fw, _ = tf.contrib.rnn.LSTMBlockFusedCell(lstm_hidden_size, name="lstm_cell")(
+                            inputs, dtype=tf.float32, sequence_length=sequence_lengths)
+                    with tf.variable_scope("bw"):
+                        inputs_reversed = tf.reverse_sequence(inputs, sequence_lengths, seq_axis=0, batch_axis=1)
+                        outputs_bw, _ = tf.contrib.rnn.LSTMBlockFusedCell(lstm_hidden_size, name="lstm_cell")(
+                            inputs_reversed, dtype=tf.float32, sequence_length=sequence_lengths)
+                        outputs_bw = tf.reverse_sequence(outputs_bw, sequence_lengths, seq_axis=0, batch_axis=1)
+                    outputs = tf.transpose(tf.concat([outputs_fw, outputs_bw], axis=2), [1, 0, 2])
+                return tf.nn.dropout(outputs, self.dropout_keep_prob)
+
             lstm_fw_cell = tf.nn.rnn_cell.LSTMCell(lstm_hidden_size)  # forward direction cell
             lstm_bw_cell = tf.nn.rnn_cell.LSTMCell(lstm_hidden_size)  # backward direction cell
             if self.dropout_keep_prob is not None:
@@ -178,52 +390,81 @@ class TextHARNN(object):
 
             # shape of `state`: tuple -> (outputs_state_fw, output_state_bw)
             # shape of `outputs_state_fw`: tuple -> (c, h) c: memory cell; h: hidden state
-            outputs, state = tf.nn.bidirectional_dynamic_rnn(lstm_fw_cell, lstm_bw_cell,
-                                                             self.embedded_sentence, dtype=tf.float32)
-            # Concat output
-            self.lstm_out = tf.concat(outputs, axis=2)  # [batch_size, sequence_length, lstm_hidden_size * 2]
-            self.lstm_out_pool = tf.reduce_mean(self.lstm_out, axis=1)  # [batch_size, lstm_hidden_size * 2]
-
-        # First Level
-        self.first_att_weight, self.first_att_out = _attention(self.lstm_out, num_classes_list[0], name="first-")
-        self.first_local_input = tf.concat([self.lstm_out_pool, self.first_att_out], axis=1)
-        self.first_local_fc_out = _fc_layer(self.first_local_input, name="first-local-")
-        self.first_logits, self.first_scores, self.first_visual = _local_layer(
-            self.first_local_fc_out, self.first_att_weight, num_classes_list[0], name="first-")
-
-        # Second Level
-        self.second_att_input = tf.multiply(self.lstm_out, tf.expand_dims(self.first_visual, -1))
-        self.second_att_weight, self.second_att_out = _attention(
-            self.second_att_input, num_classes_list[1], name="second-")
-        self.second_local_input = tf.concat([self.lstm_out_pool, self.second_att_out], axis=1)
-        self.second_local_fc_out = _fc_layer(self.second_local_input, name="second-local-")
-        self.second_logits, self.second_scores, self.second_visual = _local_layer(
-            self.second_local_fc_out, self.second_att_weight, num_classes_list[1], name="second-")
-
-        # Third Level
-        self.third_att_input = tf.multiply(self.lstm_out, tf.expand_dims(self.second_visual, -1))
-        self.third_att_weight, self.third_att_out = _attention(
-            self.third_att_input, num_classes_list[2], name="third-")
-        self.third_local_input = tf.concat([self.lstm_out_pool, self.third_att_out], axis=1)
-        self.third_local_fc_out = _fc_layer(self.third_local_input, name="third-local-")
-        self.third_logits, self.third_scores, self.third_visual = _local_layer(
-            self.third_local_fc_out, self.third_att_weight, num_classes_list[2], name="third-")
-
-        # Fourth Level
-        # self.fourth_att_input = tf.multiply(self.lstm_out, tf.expand_dims(self.third_visual, -1))
-        # self.fourth_att_weight, self.fourth_att_out = _attention(
-        #     self.fourth_att_input, num_classes_list[3], name="fourth-")
-        # self.fourth_local_input = tf.concat([self.lstm_out_pool, self.fourth_att_out], axis=1)
-        # self.fourth_local_fc_out = _fc_layer(self.fourth_local_input, name="fourth-local-")
-        # self.fourth_logits, self.fourth_scores, self.fourth_visual = _local_layer(
-        #     self.fourth_local_fc_out, self.fourth_att_weight, num_classes_list[3], name="fourth-")
+            outputs, state = tf.nn.bidirectional_dynamic_rnn(lstm_fw_cell, lstm_bw_cell, input_x,
+                                                             sequence_length=sequence_lengths, dtype=tf.float32,
+                                                             scope=scope)
+            # Concat output (the outputs of the padded steps are zeros)
+            return tf.concat(outputs, axis=2)
+
+        # Bi-LSTM Layer
+        with tf.name_scope("Bi-lstm"):
+            self.lstm_out = self.embedded_sentence
+            for layer in range(lstm_layers):
+                # [batch_size, sequence_length, lstm_hidden_size * 2]
+                self.lstm_out = _bi_lstm_layer(self.lstm_out, self.sequence_lengths, layer)
+            # Mean over the real steps only, [batch_size, lstm_hidden_size * 2]
+            self.lstm_out_pool = tf.reduce_sum(self.lstm_out, axis=1) / tf.expand_dims(
+                tf.cast(self.sequence_lengths, tf.float32), -1)
+
+        # Attention Projection
+        # The input of level i is lstm_out scaled per step by the visual of level i - 1, and
+        # W_s1 · (lstm_out * v) == (W_s1 · lstm_out) * v, so the W_s1 projections of all levels are one matmul
+        num_units = self.lstm_out.get_shape().as_list()[-1]
+        attention_weights = [_attention_weights(num_units, num_classes, name=level_name(level))
+                             for level, num_classes in enumerate(num_classes_list)]
+        with tf.name_scope("attention-projection"):
+            W_s1 = tf.concat([W for W, _ in attention_weights], axis=0)
+            # [batch_size, sequence_length, attention_unit_size * num_levels]
+            self.attention_projection = tf.tensordot(self.lstm_out, W_s1, axes=[[2], [1]])
+            projections = tf.split(self.attention_projection, num_levels, axis=2)
+
+        # Hierarchical Levels
+        # Parent-gated inference: the levels after the first only compute the children of the surviving parents
+        self.att_weights, self.local_fc_outs, self.level_logits, self.level_scores, self.level_visuals = \
+            [], [], [], [], []
+        gates = []
+        # With the sampled loss, the training steps compute the attention of the last level for its sampled classes
+        # only, the mean over the classes is estimated from them (the evaluation computes all the classes)
+        siblings, last_candidates, last_sampled = None, None, None
+        if sampled_loss:
+            with tf.name_scope("sampled-classes"):
+                if hierarchy is not None and num_levels > 1:
+                    # The children of the positive parents
+                    siblings = tf.reduce_any(tf.matmul(self.input_y_levels[-2], tf.constant(
+                        hierarchy[-1], dtype=tf.float32)) > 0, axis=0)
+                last_candidates, last_class_weights = _sampled_classes(self.input_y_levels[-1], siblings)
+                last_sampled = tf.cond(
+                    self.is_training, lambda: (last_candidates, last_class_weights),
+                    lambda: (tf.range(num_classes_list[-1], dtype=tf.int64),
+                             tf.fill([num_classes_list[-1]], 1.0 / num_classes_list[-1])))
+        for level, num_classes in enumerate(num_classes_list):
+            name = level_name(level)
+            gate, sampled = None, None
+            if gated_inference and level > 0:
+                gate = _gate(self.level_scores[-1], hierarchy[level - 1], name=name)
+            elif sampled_loss and level == num_levels - 1:
+                sampled = last_sampled
+            att_input, att_projection = self.lstm_out, projections[level]
+            if level > 0:
+                previous_visual = tf.expand_dims(self.level_visuals[-1], -1)
+                att_input = tf.multiply(self.lstm_out, previous_visual)
+                att_projection = att_projection * previous_visual
+            att_weight, att_out = _attention(att_input, att_projection, attention_weights[level][1],
+                                             self.sequence_mask, name=name, gate=gate, sampled=sampled)
+            local_input = tf.concat([self.lstm_out_pool, att_out], axis=1)
+            local_fc_out = _fc_layer(local_input, name=name + "local-")
+            logits, scores, visual = _local_layer(local_fc_out, att_weight, num_classes, self.sequence_mask,
+                                                  name=name, gate=gate, sampled=sampled)
+            gates.append(gate)
+            self.att_weights.append(att_weight)
+            self.local_fc_outs.append(local_fc_out)
+            self.level_logits.append(logits)
+            self.level_scores.append(scores)
+            self.level_visuals.append(visual)
 
         # Concat
-        # shape of ham_out: [batch_size, fc_hidden_size * 4]
-        # self.ham_out = tf.concat([self.first_local_fc_out, self.second_local_fc_out,
-        #                           self.third_local_fc_out, self.fourth_local_fc_out], axis=1)
-        self.ham_out = tf.concat([self.first_local_fc_out, self.second_local_fc_out,
-                                  self.third_local_fc_out], axis=1)
+        # shape of ham_out: [batch_size, fc_hidden_size * num_levels]
+        self.ham_out = tf.concat(self.local_fc_outs, axis=1)
         # Fully Connected Layer
         self.fc_out = _fc_layer(self.ham_out)
 
@@ -241,14 +482,46 @@ class TextHARNN(object):
             W = tf.Variable(tf.truncated_normal(shape=[num_units, total_classes],
                                                 stddev=0.1, dtype=tf.float32), name="W")
             b = tf.Variable(tf.constant(value=0.1, shape=[total_classes], dtype=tf.float32), name="b")
-            self.global_logits = tf.nn.xw_plus_b(self.h_drop, W, b, name="logits")
-            self.global_scores = tf.sigmoid(self.global_logits, name="scores")
+            output_layers["global-"] = (self.h_drop, W, b)
+            if not gated_inference:
+                self.global_logits = tf.nn.xw_plus_b(self.h_drop, W, b, name="logits")
+                self.global_scores = tf.sigmoid(self.global_logits, name="scores")
+                global_candidates = None
+            else:
+                # The global classes are the classes of the levels one after the other
+                global_mask = tf.concat([tf.ones_like(self.level_scores[0])] + [gate[2] for gate in gates[1:]],
+                                        axis=1)
+                global_candidates = tf.reshape(tf.where(tf.reduce_any(global_mask > 0, axis=0)), [-1])
+                global_logits = tf.nn.xw_plus_b(self.h_drop, tf.gather(W, global_candidates, axis=1),
+                                                tf.gather(b, global_candidates))
+                global_scores = tf.sigmoid(global_logits) * tf.gather(global_mask, global_candidates, axis=1)
+                self.global_logits = tf.add(_scatter_classes(global_logits, global_candidates, total_classes),
+                                            (global_mask - 1.0) * 1e9, name="logits")
+                self.global_scores = tf.identity(_scatter_classes(global_scores, global_candidates, total_classes),
+                                                 name="scores")
+
+        # The FLOPs of the class-dependent layers (W_s2 attention, the visual, the local and global outputs),
+        # what the parent gating saves
+        with tf.name_scope("class-flops"):
+            batch_size = tf.cast(tf.shape(self.input_x)[0], tf.float32)
+            seq_len = tf.cast(tf.shape(self.input_x)[1], tf.float32)
+            level_class_flops = batch_size * (2.0 * seq_len * attention_unit_size + 6.0 * seq_len +
+                                              2.0 * fc_hidden_size)
+            global_class_flops = batch_size * 2.0 * fc_hidden_size
+            self.dense_class_flops = tf.identity(
+                level_class_flops * sum(num_classes_list) + global_class_flops * total_classes,
+                name="dense_class_flops")
+            if not gated_inference:
+                self.class_flops = tf.identity(self.dense_class_flops, name="class_flops")
+            else:
+                num_candidates = [tf.cast(tf.size(gate[0]), tf.float32) for gate in gates[1:]]
+                self.class_flops = tf.identity(
+                    level_class_flops * tf.add_n([tf.constant(float(num_classes_list[0]))] + num_candidates) +
+                    global_class_flops * tf.cast(tf.size(global_candidates), tf.float32), name="class_flops")
 
         with tf.name_scope("output"):
-            # self.local_scores = tf.concat([self.first_scores, self.second_scores,
-            #                                self.third_scores, self.fourth_scores], axis=1)
-            self.local_scores = tf.concat([self.first_scores, self.second_scores,
-                                           self.third_scores], axis=1)
+            # The scores of all the levels, one level after the other, fetched at once by the drivers
+            self.local_scores = tf.concat(self.level_scores, axis=1, name="local_scores")
             self.scores = tf.add(self.alpha * self.global_scores, (1 - self.alpha) * self.local_scores, name="scores")
 
         # Calculate mean cross-entropy loss, L2 loss
@@ -259,12 +532,9 @@ class TextHARNN(object):
                 return losses
 
             # Local Loss
-            losses_1 = cal_loss(labels=self.input_y_first, logits=self.first_logits, name="first_")
-            losses_2 = cal_loss(labels=self.input_y_second, logits=self.second_logits, name="second_")
-            losses_3 = cal_loss(labels=self.input_y_third, logits=self.third_logits, name="third_")
-            #losses_4 = cal_loss(labels=self.input_y_fourth, logits=self.fourth_logits, name="fourth_")
-            #local_losses = tf.add_n([losses_1, losses_2, losses_3, losses_4], name="local_losses")
-            local_losses = tf.add_n([losses_1, losses_2, losses_3], name="local_losses")
+            level_losses = [cal_loss(labels=labels, logits=logits, name=level_name(level).replace("-", "_"))
+                            for level, (labels, logits) in enumerate(zip(self.input_y_levels, self.level_logits))]
+            local_losses = tf.add_n(level_losses, name="local_losses")
 
             # Global Loss
             global_losses = cal_loss(labels=self.input_y, logits=self.global_logits, name="global_")
@@ -272,4 +542,47 @@ class TextHARNN(object):
             # L2 Loss
             l2_losses = tf.add_n([tf.nn.l2_loss(tf.cast(v, tf.float32)) for v in tf.trainable_variables()],
                                  name="l2_losses") * l2_reg_lambda
-            self.loss = tf.add_n([local_losses, global_losses, l2_losses], name="loss")
\ No newline at end of file
+            # The dense loss over every class, for the evaluation (and the training without sampled loss)
+            self.loss = tf.add_n([local_losses, global_losses, l2_losses], name="loss")
+
+            def cal_sampled_loss(labels, output_layer, candidates, class_weights, name):
+                """
+                The loss over the candidate classes of _sampled_classes only,
+                so the output layer is computed for these columns only.
+                Each candidate column is weighted by num_classes * its class weight (1 for the positives and the extra
+                candidates, the number of the other classes it stands for otherwise), so the loss estimates
+                the dense loss over all the classes and the negatives keep their weight in the logits.
+                Args:
+                    labels: [batch_size, num_classes]
+                    output_layer: The (input_x, W, b) of the output layer
+                    candidates: The candidate classes, [num_candidates]
+                    class_weights: The class weights of the candidates, [num_candidates]
+                    name: The loss name
+                """
+                input_x, W, b = output_layer
+                num_classes = labels.get_shape().as_list()[-1]
+                logits = tf.nn.xw_plus_b(input_x, tf.gather(W, candidates, axis=1), tf.gather(b, candidates))
+                losses = tf.nn.sigmoid_cross_entropy_with_logits(labels=tf.gather(labels, candidates, axis=1),
+                                                                 logits=logits) * (class_weights * num_classes)
+                return tf.reduce_mean(tf.reduce_sum(losses, axis=1), name=name + "losses")
+
+            if not sampled_loss:
+                self.train_loss = self.loss
+            else:
+                # The last level and the global head (the largest label spaces) are trained on sampled classes,
+                # plus the siblings (the children of the positive parents) with a hierarchy.
+                # The last level uses the classes of its attention
+                last_name = level_name(num_levels - 1)
+                sampled_last_losses = cal_sampled_loss(self.input_y_levels[-1], output_layers[last_name],
+                                                       last_candidates, last_class_weights,
+                                                       name=last_name.replace("-", "_") + "sampled_")
+                # Every class of the upper levels, the last level classes are sampled
+                global_extra = tf.concat([tf.ones([sum(num_classes_list[:-1])], dtype=tf.bool),
+                                          siblings if siblings is not None else
+                                          tf.zeros([num_classes_list[-1]], dtype=tf.bool)], axis=0)
+                sampled_global_candidates, sampled_global_weights = _sampled_classes(self.input_y, global_extra)
+                sampled_global_losses = cal_sampled_loss(self.input_y, output_layers["global-"],
+                                                         sampled_global_candidates, sampled_global_weights,
+                                                         name="global_sampled_")
+                self.train_loss = tf.add_n(level_losses[:-1] + [sampled_last_losses, sampled_global_losses,
+                                                                l2_losses], name="train_loss")
\ No newline at end of file
@@ -9,17 +9,23 @@ os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
 import sys
 import time
 import logging
+import itertools
 
 sys.path.append('../')
 logging.getLogger('tensorflow').disabled = True
 
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.client import timeline
 from text_harnn import TextHARNN
+from utils import async_evaluator as ae
 from utils import checkmate as cm
 from utils import data_helpers as dh
+from utils import metrics as mt
 from utils import param_parser as parser
-from sklearn.metrics import precision_score, recall_score, f1_score, roc_auc_score, average_precision_score
+from utils import session_config as sc
+from utils import summary_writer as sw
+from utils import tfrecord_helpers as th
 
 args = parser.parameter_parser()
 OPTION = dh._option(pattern=0)
@@ -31,35 +37,81 @@ def train_harnn():
     # Print parameters used for the model
     dh.tab_printer(args, logger)
 
+    # Output directory for models and summaries
+    out_dir = dh.get_out_dir(OPTION, logger)
+
     # Load sentences, labels, and training parameters
     #print('第31行')
     logger.info("Loading data...")
     logger.info("Data processing...")
     #print('第34行')
     train_data = dh.load_data_and_labels(args.train_file, args.num_classes_list, args.total_classes,
-                                         args.word2vec_file, data_aug_flag=False)
+                                         args.word2vec_file,
+                                         cache_dir=args.data_cache_dir, num_workers=args.num_workers,
+                                         tokenize_mode=args.tokenize_mode)
 
 
     val_data = dh.load_data_and_labels(args.validation_file, args.num_classes_list, args.total_classes,
-                                       args.word2vec_file, data_aug_flag=False)
+                                       args.word2vec_file,
+                                       cache_dir=args.data_cache_dir, num_workers=args.num_workers,
+                                       tokenize_mode=args.tokenize_mode)
     #print('第41行')
+    # Prune the vocab to the tokens of the training data, a restored run keeps the map it was trained with
+    vocab_map = dh.load_vocab_map(out_dir) if OPTION == 'R' else None
+    if OPTION == 'T' and args.prune_vocab:
+        vocab_map = dh.build_vocab_map(train_data)
+        dh.save_vocab_map(out_dir, vocab_map)
+    if vocab_map is not None:
+        logger.info("Vocab pruned to {0} tokens.".format(len(vocab_map)))
+        train_data = dh.remap_data(train_data, vocab_map)
+        val_data = dh.remap_data(val_data, vocab_map)
+
+    # The label hierarchy, for the sibling negatives of the sampled loss and the parent-gated inference of test_harnn
+    hierarchy = dh.load_hierarchy(out_dir) if OPTION == 'R' else None
+    if hierarchy is None:
+        hierarchy = dh.build_hierarchy(train_data)
+        dh.save_hierarchy(out_dir, hierarchy)
+
     logger.info("Data padding...")
-    x_train, y_train, y_train_tuple = dh.pad_data(train_data, args.pad_seq_len)
-    x_val, y_val, y_val_tuple = dh.pad_data(val_data, args.pad_seq_len)
+    x_train, y_train, y_train_tuple = dh.pad_data(train_data, args.pad_seq_len, dynamic=args.bucket_size > 0)
+    x_val, y_val, y_val_tuple = dh.pad_data(val_data, args.pad_seq_len, dynamic=args.bucket_size > 0)
+    val_subset = None
+    if args.val_subset_size > 0:
+        subset_indices = dh.stratified_subset(y_val_tuple, args.val_subset_size, seed=args.seed)
+        val_subset = (x_val[subset_indices], y_val[subset_indices],
+                      tuple(y_level[subset_indices] for y_level in y_val_tuple))
+        logger.info("Validation subset: {0} of {1} documents.".format(len(subset_indices), len(x_val)))
     #print('第45行')
     # Build vocabulary
-    VOCAB_SIZE, EMBEDDING_SIZE, pretrained_word2vec_matrix = dh.load_word2vec_matrix(args.word2vec_file)
+    VOCAB_SIZE, EMBEDDING_SIZE, pretrained_word2vec_matrix = dh.load_word2vec_matrix(args.word2vec_file,
+                                                                                      args.embedding_matrix_file,
+                                                                                      vocab_map)
     print("from train_harnn line 48, VOCAB_SIZE: ",VOCAB_SIZE," EMBEDDING_SIZE: ", EMBEDDING_SIZE)
 
 
     # Build a graph and harnn object
     with tf.Graph().as_default():
-        session_conf = tf.ConfigProto(
-            allow_soft_placement=args.allow_soft_placement,
-            log_device_placement=args.log_device_placement)
-        session_conf.gpu_options.allow_growth = args.gpu_options_allow_growth
+        session_conf = sc.create_session_config(args)
         sess = tf.Session(config=session_conf)
         with sess.as_default():
+            input_tensors = None
+            if args.xla_jit and args.bucket_size > 0 and args.pad_multiple == 1:
+                logger.warning("XLA compiles the graph again for each padded length, "
+                               "consider --pad-multiple with --bucket-size.")
+            if args.use_tfrecord:
+                if args.data_aug_prob > 0:
+                    logger.warning("The data augmentation is not applied to the TFRecord input pipeline.")
+                tfrecord_file = th.get_tfrecord_file(args.train_file, args.pad_seq_len, args.tfrecord_dir,
+                                                     args.num_classes_list, args.total_classes,
+                                                     tokenize_mode=args.tokenize_mode, vocab_map=vocab_map)
+                if not os.path.isfile(tfrecord_file):
+                    logger.info("Writing {0}...".format(tfrecord_file))
+                    th.write_tfrecord(tfrecord_file, x_train, y_train, y_train_tuple, args.pad_seq_len)
+                dataset = th.make_dataset(tfrecord_file, args.pad_seq_len, args.num_classes_list, args.total_classes,
+                                          args.batch_size, args.epochs, shuffle_buffer=args.shuffle_buffer,
+                                          prefetch_size=max(args.prefetch_batches, 1))
+                input_tensors = th.make_input_tensors(dataset)
+
             harnn = TextHARNN(
                 sequence_length=args.pad_seq_len,
                 vocab_size=VOCAB_SIZE,
@@ -71,7 +123,15 @@ def train_harnn():
                 num_classes_list=args.num_classes_list,
                 total_classes=args.total_classes,
                 l2_reg_lambda=args.l2_lambda,
-                pretrained_embedding=pretrained_word2vec_matrix) ## swappped to BERT embedding
+                pretrained_embedding=pretrained_word2vec_matrix, ## swappped to BERT embedding
+                input_tensors=input_tensors,
+                lstm_layers=args.lstm_layers,
+                lstm_backend=args.lstm_backend,
+                embedding_dim=args.embedding_dim,
+                embedding_rank=args.embedding_rank,
+                hierarchy=hierarchy,
+                sampled_loss=args.sampled_loss,
+                num_sampled=args.num_sampled)
 
             # Define training procedure
             with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
@@ -79,11 +139,12 @@ def train_harnn():
                                                            global_step=harnn.global_step, decay_steps=args.decay_steps,
                                                            decay_rate=args.decay_rate, staircase=True)
                 optimizer = tf.train.AdamOptimizer(learning_rate)
-                grads, vars = zip(*optimizer.compute_gradients(harnn.loss))
-                grads, _ = tf.clip_by_global_norm(grads, clip_norm=args.norm_ratio)
+                grads, vars = zip(*optimizer.compute_gradients(harnn.train_loss))
+                grads, grad_norm = tf.clip_by_global_norm(grads, clip_norm=args.norm_ratio)
                 train_op = optimizer.apply_gradients(zip(grads, vars), global_step=harnn.global_step, name="train_op")
 
-            # Keep track of gradient values and sparsity (optional)
+            # Keep track of gradient values and sparsity, a pass over every gradient (the embedding one included),
+            # so only fetched every histogram_steps steps
             grad_summaries = []
             for g, v in zip(grads, vars):
                 if g is not None:
@@ -91,28 +152,35 @@ def train_harnn():
                     sparsity_summary = tf.summary.scalar("{0}/grad/sparsity".format(v.name), tf.nn.zero_fraction(g))
                     grad_summaries.append(grad_hist_summary)
                     grad_summaries.append(sparsity_summary)
-            grad_summaries_merged = tf.summary.merge(grad_summaries)
+            histogram_summary_op = tf.summary.merge(grad_summaries)
 
-            # Output directory for models and summaries
-            out_dir = dh.get_out_dir(OPTION, logger)
             checkpoint_dir = os.path.abspath(os.path.join(out_dir, "checkpoints"))
             best_checkpoint_dir = os.path.abspath(os.path.join(out_dir, "bestcheckpoints"))
 
             # Summaries for loss
             loss_summary = tf.summary.scalar("loss", harnn.loss)
+            # The training steps don't compute the dense loss with the sampled loss
+            train_loss_summary = tf.summary.scalar("train_loss", harnn.train_loss) if args.sampled_loss \
+                else loss_summary
 
-            # Train summaries
-            train_summary_op = tf.summary.merge([loss_summary, grad_summaries_merged])
+            # Train summaries, the cheap scalars are fetched every summary_steps steps
+            scalar_summary_op = tf.summary.merge([train_loss_summary, tf.summary.scalar("grad_norm", grad_norm),
+                                                  tf.summary.scalar("learning_rate", learning_rate)])
             train_summary_dir = os.path.join(out_dir, "summaries", "train")
-            train_summary_writer = tf.summary.FileWriter(train_summary_dir, sess.graph)
+            train_summary_writer = sw.AsyncSummaryWriter(train_summary_dir, sess.graph)
 
             # Validation summaries
             validation_summary_op = tf.summary.merge([loss_summary])
             validation_summary_dir = os.path.join(out_dir, "summaries", "validation")
-            validation_summary_writer = tf.summary.FileWriter(validation_summary_dir, sess.graph)
+            validation_summary_writer = sw.AsyncSummaryWriter(validation_summary_dir, sess.graph)
+            if val_subset is not None:
+                validation_subset_summary_dir = os.path.join(out_dir, "summaries", "validation_subset")
+                validation_subset_summary_writer = sw.AsyncSummaryWriter(validation_subset_summary_dir)
 
             saver = tf.train.Saver(tf.global_variables(), max_to_keep=args.num_checkpoints)
             best_saver = cm.BestCheckpointSaver(save_dir=best_checkpoint_dir, num_to_keep=3, maximize=True)
+            # The variables the best checkpoints save, also those of the asynchronous evaluation snapshots
+            snapshot_variables = tf.global_variables()
 
             if OPTION == 'R':
                 # Load harnn model
@@ -123,12 +191,14 @@ def train_harnn():
                 # Load the saved meta graph and restore variables
                 saver = tf.train.import_meta_graph("{0}.meta".format(checkpoint_file))
                 saver.restore(sess, checkpoint_file)
+                cm.init_frozen_embedding(sess, pretrained_word2vec_matrix)
             if OPTION == 'T':
                 #print('第122行')
                 if not os.path.exists(checkpoint_dir):
                     os.makedirs(checkpoint_dir)
                 sess.run(tf.global_variables_initializer())
                 sess.run(tf.local_variables_initializer())
+                cm.init_frozen_embedding(sess, pretrained_word2vec_matrix)
 
                 # Save the embedding visualization
                 saver.save(sess, os.path.join(out_dir, "embedding", "embedding.ckpt"))
@@ -136,86 +206,74 @@ def train_harnn():
             current_step = sess.run(harnn.global_step)
 
             def train_step(x_batch, y_batch, y_batch_tuple):
-                """A single training step"""
-                y_batch_first = [i[0] for i in y_batch_tuple]
-                y_batch_second = [j[1] for j in y_batch_tuple]
-                y_batch_third = [k[2] for k in y_batch_tuple]
-                #y_batch_fourth = [t[3] for t in y_batch_tuple]
-
+                """
+                A single training step (the batch is None when it comes from the tf.data pipeline).
+                Returns the global step after the step.
+                """
                 feed_dict = {
-                    harnn.input_x: x_batch,
-                    harnn.input_y_first: y_batch_first,
-                    harnn.input_y_second: y_batch_second,
-                    harnn.input_y_third: y_batch_third,
-                    #harnn.input_y_fourth: y_batch_fourth,
-                    harnn.input_y: y_batch,
                     harnn.dropout_keep_prob: args.dropout_rate,
                     harnn.alpha: args.alpha,
                     harnn.is_training: True
                 }
-                _, step, summaries, loss = sess.run(
-                    [train_op, harnn.global_step, train_summary_op, harnn.loss], feed_dict)
+                if x_batch is not None:
+                    feed_dict.update({
+                        harnn.input_x: x_batch,
+                        harnn.input_y_local: np.concatenate(y_batch_tuple, axis=1),
+                        harnn.input_y: y_batch
+                    })
+
+                # Trace the step every profile_steps steps, the timeline shows how input and compute overlap
+                next_step = current_step + 1
+                run_options, run_metadata = None, None
+                if args.profile_steps and next_step % args.profile_steps == 0:
+                    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+                    run_metadata = tf.RunMetadata()
+
+                fetches = [train_op, harnn.global_step, harnn.train_loss]
+                if args.summary_steps and next_step % args.summary_steps == 0:
+                    fetches.append(scalar_summary_op)
+                if args.histogram_steps and next_step % args.histogram_steps == 0:
+                    fetches.append(histogram_summary_op)
+                _, step, loss, *summaries = sess.run(fetches, feed_dict, options=run_options,
+                                                     run_metadata=run_metadata)
                 logger.info("step {0}: loss {1:g}".format(step, loss))
-                train_summary_writer.add_summary(summaries, step)
-
-            def validation_step(x_val, y_val, y_val_tuple, writer=None):
-                """Evaluates model on a validation set"""
-                batches_validation = dh.batch_iter(
-                    list(zip(x_val, y_val, y_val_tuple)), args.batch_size, 1)
-
-                # Predict classes by threshold or topk ('ts': threshold; 'tk': topk)
+                for summary in summaries:
+                    train_summary_writer.add_summary(summary, step)
+
+                if run_metadata is not None:
+                    train_summary_writer.add_run_metadata(run_metadata, "step{0}".format(step), step)
+                    profile_dir = os.path.join(out_dir, "profile")
+                    if not os.path.exists(profile_dir):
+                        os.makedirs(profile_dir)
+                    with open(os.path.join(profile_dir, "timeline-{0}.json".format(step)), 'w') as f:
+                        f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+                return step
+
+            def validation_step(x_val, y_val, y_val_tuple, writer=None, session=sess):
+                """Evaluates model on a validation set (with the weights of session)"""
+                batches_validation = dh.batch_sampler(x_val, y_val, y_val_tuple, args.batch_size, 1, shuffle=False,
+                                                      prefetch_size=args.prefetch_batches,
+                                                      pad_seq_len=args.pad_seq_len, bucket_size=args.bucket_size,
+                                                      pad_multiple=args.pad_multiple)
+
+                # Predict classes by threshold or topk ('ts': threshold; 'tk': topk), counted batch by batch
                 eval_counter, eval_loss = 0, 0.0
+                eval_metrics = mt.StreamingMetrics(threshold=args.threshold, top_num=args.topK,
+                                                   num_bins=args.metrics_bins, exact=args.exact_metrics)
 
-                eval_pre_tk = [0.0] * args.topK
-                eval_rec_tk = [0.0] * args.topK
-                eval_F1_tk = [0.0] * args.topK
-
-                true_onehot_labels = []
-                predicted_onehot_scores = []
-                predicted_onehot_labels_ts = []
-                predicted_onehot_labels_tk = [[] for _ in range(args.topK)]
-
-                for batch_validation in batches_validation:
-                    x_batch_val, y_batch_val, y_batch_val_tuple = zip(*batch_validation)
-
-                    y_batch_val_first = [i[0] for i in y_batch_val_tuple]
-                    y_batch_val_second = [j[1] for j in y_batch_val_tuple]
-                    y_batch_val_third = [k[2] for k in y_batch_val_tuple]
-                    #y_batch_val_fourth = [t[3] for t in y_batch_val_tuple]
-
+                for _, x_batch_val, y_batch_val, y_batch_val_tuple in batches_validation:
                     feed_dict = {
                         harnn.input_x: x_batch_val,
-                        harnn.input_y_first: y_batch_val_first,
-                        harnn.input_y_second: y_batch_val_second,
-                        harnn.input_y_third: y_batch_val_third,
-                        #harnn.input_y_fourth: y_batch_val_fourth,
+                        harnn.input_y_local: np.concatenate(y_batch_val_tuple, axis=1),
                         harnn.input_y: y_batch_val,
                         harnn.dropout_keep_prob: 1.0,
                         harnn.alpha: args.alpha,
                         harnn.is_training: False
                     }
-                    step, summaries, scores, cur_loss = sess.run(
+                    step, summaries, scores, cur_loss = session.run(
                         [harnn.global_step, validation_summary_op, harnn.scores, harnn.loss], feed_dict)
 
-                    # Prepare for calculating metrics
-                    for onehot_labels in y_batch_val:
-                        true_onehot_labels.append(onehot_labels)
-                    for onehot_scores in scores:
-                        predicted_onehot_scores.append(onehot_scores)
-
-                    # Predict by threshold
-                    batch_predicted_onehot_labels_ts = \
-                        dh.get_onehot_label_threshold(scores=scores, threshold=args.threshold)
-
-                    for onehot_labels in batch_predicted_onehot_labels_ts:
-                        predicted_onehot_labels_ts.append(onehot_labels)
-
-                    # Predict by topK
-                    for top_num in range(args.topK):
-                        batch_predicted_onehot_labels_tk = dh.get_onehot_label_topk(scores=scores, top_num=top_num+1)
-
-                        for onehot_labels in batch_predicted_onehot_labels_tk:
-                            predicted_onehot_labels_tk[top_num].append(onehot_labels)
+                    eval_metrics.update(labels=y_batch_val, scores=scores)
 
                     eval_loss = eval_loss + cur_loss
                     eval_counter = eval_counter + 1
@@ -225,65 +283,86 @@ def train_harnn():
 
                 eval_loss = float(eval_loss / eval_counter)
 
-                # Calculate Precision & Recall & F1
-                eval_pre_ts = precision_score(y_true=np.array(true_onehot_labels),
-                                              y_pred=np.array(predicted_onehot_labels_ts), average='micro')
-                eval_rec_ts = recall_score(y_true=np.array(true_onehot_labels),
-                                           y_pred=np.array(predicted_onehot_labels_ts), average='micro')
-                eval_F1_ts = f1_score(y_true=np.array(true_onehot_labels),
-                                      y_pred=np.array(predicted_onehot_labels_ts), average='micro')
-                # Calculate the average AUC
-                eval_auc = roc_auc_score(y_true=np.array(true_onehot_labels),
-                                         y_score=np.array(predicted_onehot_scores), average='micro')
-                # Calculate the average PR
-                eval_prc = average_precision_score(y_true=np.array(true_onehot_labels),
-                                                   y_score=np.array(predicted_onehot_scores), average='micro')
-
-                for top_num in range(args.topK):
-                    eval_pre_tk[top_num] = precision_score(y_true=np.array(true_onehot_labels),
-                                                           y_pred=np.array(predicted_onehot_labels_tk[top_num]),
-                                                           average='micro')
-                    eval_rec_tk[top_num] = recall_score(y_true=np.array(true_onehot_labels),
-                                                        y_pred=np.array(predicted_onehot_labels_tk[top_num]),
-                                                        average='micro')
-                    eval_F1_tk[top_num] = f1_score(y_true=np.array(true_onehot_labels),
-                                                   y_pred=np.array(predicted_onehot_labels_tk[top_num]),
-                                                   average='micro')
+                # Calculate Precision & Recall & F1, the average AUC and the average PR
+                result = eval_metrics.result()
+                eval_pre_ts, eval_rec_ts, eval_F1_ts = result['precision'], result['recall'], result['f1']
+                eval_auc, eval_prc = result['auc'], result['auprc']
+                eval_pre_tk, eval_rec_tk, eval_F1_tk = result['precision_tk'], result['recall_tk'], result['f1_tk']
 
                 return eval_loss, eval_auc, eval_prc, eval_rec_ts, eval_pre_ts, eval_F1_ts, \
                        eval_rec_tk, eval_pre_tk, eval_F1_tk
 
+            best_subset_prc = float('-inf')
+
+            def evaluate(session, step, full_pass=False):
+                """
+                Validates the weights of session at step and keeps them if they are among the best.
+                With the validation subset, the full validation set is evaluated (and the best checkpoints
+                ranked on it) only for full_pass or when the subset AUPRC improves.
+                """
+                nonlocal best_subset_prc
+                if val_subset is not None and not full_pass:
+                    subset_loss, subset_auc, subset_prc, *_ = \
+                        validation_step(*val_subset, writer=validation_subset_summary_writer, session=session)
+                    logger.info("\nValidation subset: Loss {0:g} | AUC {1:g} | AUPRC {2:g}"
+                                .format(subset_loss, subset_auc, subset_prc))
+                    if not subset_prc > best_subset_prc:
+                        return
+                    best_subset_prc = subset_prc
+
+                logger.info("\nEvaluation:")
+                eval_loss, eval_auc, eval_prc, \
+                eval_rec_ts, eval_pre_ts, eval_F1_ts, eval_rec_tk, eval_pre_tk, eval_F1_tk = \
+                    validation_step(x_val, y_val, y_val_tuple, writer=validation_summary_writer, session=session)
+
+                logger.info("All Validation set: Loss {0:g} | AUC {1:g} | AUPRC {2:g}"
+                            .format(eval_loss, eval_auc, eval_prc))
+
+                # Predict by threshold
+                logger.info("Predict by threshold: Precision {0:g}, Recall {1:g}, F1 {2:g}"
+                            .format(eval_pre_ts, eval_rec_ts, eval_F1_ts))
+
+                # Predict by topK
+                logger.info("Predict by topK:")
+                for top_num in range(args.topK):
+                    logger.info("Top{0}: Precision {1:g}, Recall {2:g}, F1 {3:g}"
+                                .format(top_num+1, eval_pre_tk[top_num], eval_rec_tk[top_num], eval_F1_tk[top_num]))
+                best_saver.handle(eval_prc, session, step)
+
+            # With --async-eval the evaluation steps only snapshot the weights, a background session evaluates them
+            evaluator = None
+            if args.async_eval:
+                evaluator = ae.AsyncEvaluator(snapshot_variables, evaluate, config=session_conf,
+                                              init_fn=lambda session: cm.init_frozen_embedding(
+                                                  session, pretrained_word2vec_matrix))
+
             # Generate batches
-            batches_train = dh.batch_iter(
-                list(zip(x_train, y_train, y_train_tuple)), args.batch_size, args.epochs)
+            if args.use_tfrecord:
+                # The batches come from the tf.data pipeline, which raises OutOfRangeError after the last epoch
+                batches_train = itertools.repeat((None, None, None))
+            else:
+                batches_train = ((x, y, y_tuple) for _, x, y, y_tuple in dh.batch_sampler(
+                    x_train, y_train, y_train_tuple, args.batch_size, args.epochs, prefetch_size=args.prefetch_batches,
+                    seed=args.seed, pad_seq_len=args.pad_seq_len, bucket_size=args.bucket_size,
+                    aug_prob=args.data_aug_prob, aug_drop_rate=args.data_aug_drop_rate,
+                    pad_multiple=args.pad_multiple))
 
             num_batches_per_epoch = int((len(x_train) - 1) / args.batch_size) + 1
 
             # Training loop. For each batch...
-            for batch_train in batches_train:
-                x_batch_train, y_batch_train, y_batch_train_tuple = zip(*batch_train)
-                train_step(x_batch_train, y_batch_train, y_batch_train_tuple)
-                current_step = tf.train.global_step(sess, harnn.global_step)
-
-                if current_step % args.evaluate_steps == 0:
-                    logger.info("\nEvaluation:")
-                    eval_loss, eval_auc, eval_prc, \
-                    eval_rec_ts, eval_pre_ts, eval_F1_ts, eval_rec_tk, eval_pre_tk, eval_F1_tk = \
-                        validation_step(x_val, y_val, y_val_tuple, writer=validation_summary_writer)
-
-                    logger.info("All Validation set: Loss {0:g} | AUC {1:g} | AUPRC {2:g}"
-                                .format(eval_loss, eval_auc, eval_prc))
-
-                    # Predict by threshold
-                    logger.info("Predict by threshold: Precision {0:g}, Recall {1:g}, F1 {2:g}"
-                                .format(eval_pre_ts, eval_rec_ts, eval_F1_ts))
-
-                    # Predict by topK
-                    logger.info("Predict by topK:")
-                    for top_num in range(args.topK):
-                        logger.info("Top{0}: Precision {1:g}, Recall {2:g}, F1 {3:g}"
-                                    .format(top_num+1, eval_pre_tk[top_num], eval_rec_tk[top_num], eval_F1_tk[top_num]))
-                    best_saver.handle(eval_prc, sess, current_step)
+            for x_batch_train, y_batch_train, y_batch_train_tuple in batches_train:
+                try:
+                    current_step = train_step(x_batch_train, y_batch_train, y_batch_train_tuple)
+                except tf.errors.OutOfRangeError:
+                    break
+
+                # With the validation subset, the full validation set is also evaluated at the end of each epoch
+                epoch_end = val_subset is not None and current_step % num_batches_per_epoch == 0
+                if current_step % args.evaluate_steps == 0 or epoch_end:
+                    if evaluator is not None:
+                        evaluator.submit(sess, current_step, epoch_end)
+                    else:
+                        evaluate(sess, current_step, epoch_end)
                 if current_step % args.checkpoint_steps == 0:
                     checkpoint_prefix = os.path.join(checkpoint_dir, "model")
                     path = saver.save(sess, checkpoint_prefix, global_step=current_step)
@@ -292,6 +371,13 @@ def train_harnn():
                     current_epoch = current_step // num_batches_per_epoch
                     logger.info("Epoch {0} has finished!".format(current_epoch))
 
+            if evaluator is not None:
+                evaluator.close()
+            train_summary_writer.close()
+            validation_summary_writer.close()
+            if val_subset is not None:
+                validation_subset_summary_writer.close()
+
     logger.info("All Done.")
 
 
@@ -0,0 +1,76 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import queue
+import threading
+import tensorflow as tf
+
+
+class AsyncEvaluator(object):
+    """
+    Evaluates snapshots of the model weights in a background thread, on its own session of the training graph.
+    submit copies the variables out of the training session (one sess.run), the thread loads the copy into
+    the evaluation session and calls evaluate_fn on it, so training goes on while a snapshot is scored and
+    the evaluation session saves exactly the weights of the snapshot step.
+    When max_pending snapshots are already waiting, submit waits for a free slot instead of dropping one,
+    so every evaluation step is still evaluated, in order.
+    """
+
+    def __init__(self, variables, evaluate_fn, init_fn=None, config=None, max_pending=1):
+        """
+        Args:
+            variables: The variables of the snapshots, all of one graph
+            evaluate_fn: Called with the evaluation session, the step and the arguments of each snapshot
+            init_fn: Called once with the evaluation session, for the state out of the snapshots (default: None)
+            config: The ConfigProto of the evaluation session (default: None)
+            max_pending: The number of snapshots waiting before submit blocks (default: 1)
+        """
+        self._variables = list(variables)
+        self._evaluate_fn = evaluate_fn
+        self._sess = tf.Session(graph=self._variables[0].graph, config=config)
+        if init_fn is not None:
+            init_fn(self._sess)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="async-evaluator")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                step, values, evaluate_args = item
+                # Variable.load feeds the initializer, no new op is added to the graph from this thread
+                for variable, value in zip(self._variables, values):
+                    variable.load(value, self._sess)
+                self._evaluate_fn(self._sess, step, *evaluate_args)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            raise IOError("[Error] The asynchronous evaluation failed: {0}".format(self._error))
+
+    def submit(self, sess, step, *evaluate_args):
+        """
+        Snapshot the variables and queue their evaluation.
+
+        Args:
+            sess: The training session
+            step: The global step of the snapshot
+            *evaluate_args: The other arguments of evaluate_fn
+        """
+        self._check()
+        self._queue.put((step, sess.run(self._variables), evaluate_args))
+
+    def close(self):
+        """Evaluate the pending snapshots and close the evaluation session."""
+        self._queue.put(None)
+        self._thread.join()
+        self._sess.close()
+        self._check()
@@ -138,3 +138,21 @@ def get_best_checkpoint(best_checkpoint_dir, select_maximum_value=True):
                                 reverse=select_maximum_value)
     ]
     return os.path.join(os.path.abspath(best_checkpoint_dir),  best_checkpoints[0])
+
+
+def init_frozen_embedding(sess, embedding_matrix):
+    """
+    Feeds the pretrained table into the frozen embedding of the HARNN model
+    (embedding_type 2 and 3). The frozen embedding is not saved in the checkpoints,
+    so it has to be fed after the initialization or the restore of the other variables.
+    Does nothing for the other embedding types.
+    Args:
+        sess: The session of the model graph
+        embedding_matrix: The pretrained embedding matrix
+    """
+    try:
+        initializer = sess.graph.get_operation_by_name("embedding/frozen_embedding/Assign")
+    except KeyError:
+        return
+    frozen_embedding_init = sess.graph.get_operation_by_name("embedding/frozen_embedding_init").outputs[0]
+    sess.run(initializer, feed_dict={frozen_embedding_init: np.asarray(embedding_matrix, dtype=np.float32)})
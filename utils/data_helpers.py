@@ -6,20 +6,35 @@ warnings.filterwarnings('ignore')
 
 import os
 import time
-import heapq
-import gensim
+import hashlib
 import logging
 import json
-import tensorflow as tf
+import pickle
+import queue
+import threading
+import multiprocessing
+import numpy as np
 
 from collections import OrderedDict
-from pylab import *
 from texttable import Texttable
-from gensim.models import word2vec
-from tflearn.data_utils import pad_sequences
 
-import torch
-from transformers import BertTokenizer,BertModel
+# torch, transformers and tflearn are heavy, they are imported on first use only.
+from utils import lazy_resources as lr
+from utils import tokenization as tk
+from utils import label_decoding as ld
+
+BERT_PATH_ROOT = "./data/chinese-roberta-wwm-ext-large"
+EMBEDDING_MATRIX_FILE = os.path.join(BERT_PATH_ROOT, "embedding_matrix.npy")
+
+# Bump whenever the layout of the cached _Data changes, so that stale caches are rebuilt.
+DATA_CACHE_VERSION = 3
+
+# The token ids kept by the vocab pruning (vocab_map[new id] = BERT id), saved with the run
+VOCAB_MAP_FILE = "vocab_map.npy"
+
+# The parent -> child matrices of the label hierarchy, saved with the run
+HIERARCHY_FILE = "hierarchy.npz"
+
 
 def _option(pattern):
     """
@@ -77,11 +92,14 @@ def tab_printer(args, logger):
         logger: The logger
     """
     args = vars(args)
-    keys = sorted(args.keys())
+    tuned_overrides = args.get('tuned_overrides', {})
+    keys = sorted(k for k in args.keys() if k != 'tuned_overrides')
     t = Texttable()
     t.add_rows([[k.replace("_", " ").capitalize(), args[k]] for k in keys])
     t.add_rows([["Parameter", "Value"]])
     logger.info('\n' + t.draw())
+    for name, (default, value) in sorted(tuned_overrides.items()):
+        logger.info("Tuned config: {0} = {1} (default: {2})".format(name, value, default))
 
 
 def get_out_dir(option, logger):
@@ -144,7 +162,7 @@ def create_prediction_file(output_file, data_id, all_labels, all_predict_labels,
         data_size = len(all_predict_labels)
         for i in range(data_size):
             predict_labels = [int(i) for i in all_predict_labels[i]]
-            predict_scores = [round(i, 4) for i in all_predict_scores[i]]
+            predict_scores = [round(float(i), 4) for i in all_predict_scores[i]]
             labels = [int(i) for i in all_labels[i]]
             data_record = OrderedDict([
                 ('id', data_id[i]),
@@ -164,42 +182,25 @@ def get_onehot_label_threshold(scores, threshold=0.5):
         scores: The all classes predicted scores provided by network
         threshold: The threshold (default: 0.5)
     Returns:
-        predicted_onehot_labels: The predicted labels (onehot)
-    """
-    predicted_onehot_labels = []
-    scores = np.ndarray.tolist(scores)
-    for score in scores:
-        count = 0
-        onehot_labels_list = [0] * len(score)
-        for index, predict_score in enumerate(score):
-            if predict_score >= threshold:
-                onehot_labels_list[index] = 1
-                count += 1
-        if count == 0:
-            max_score_index = score.index(max(score))
-            onehot_labels_list[max_score_index] = 1
-        predicted_onehot_labels.append(onehot_labels_list)
-    return predicted_onehot_labels
+        predicted_onehot_labels: The predicted labels (onehot), int [batch_size, num_classes]
+    """
+    return ld.decode_threshold(scores, threshold).astype(np.int32)
 
 
 def get_onehot_label_topk(scores, top_num=1):
     """
     Get the predicted onehot labels based on the topK number.
+    Equal scores are taken in the class order. See label_decoding.decode_topk for all the topK numbers at once.
 
     Args:
         scores: The all classes predicted scores provided by network
         top_num: The max topK number (default: 5)
     Returns:
-        predicted_onehot_labels: The predicted labels (onehot)
-    """
-    predicted_onehot_labels = []
-    scores = np.ndarray.tolist(scores)
-    for score in scores:
-        onehot_labels_list = [0] * len(score)
-        max_num_index_list = list(map(score.index, heapq.nlargest(top_num, score)))
-        for i in max_num_index_list:
-            onehot_labels_list[i] = 1
-        predicted_onehot_labels.append(onehot_labels_list)
+        predicted_onehot_labels: The predicted labels (onehot), int [batch_size, num_classes]
+    """
+    scores = np.asarray(scores)
+    predicted_onehot_labels = np.zeros(scores.shape, dtype=np.int32)
+    np.put_along_axis(predicted_onehot_labels, ld.top_classes(scores, top_num), 1, axis=1)
     return predicted_onehot_labels
 
 
@@ -215,24 +216,8 @@ def get_label_threshold(scores, threshold=0.5):
         predicted_labels: The predicted labels
         predicted_scores: The predicted scores
     """
-    predicted_labels = []
-    predicted_scores = []
-    scores = np.ndarray.tolist(scores)
-    for score in scores:
-        count = 0
-        index_list = []
-        score_list = []
-        for index, predict_score in enumerate(score):
-            if predict_score >= threshold:
-                index_list.append(index)
-                score_list.append(predict_score)
-                count += 1
-        if count == 0:
-            index_list.append(score.index(max(score)))
-            score_list.append(max(score))
-        predicted_labels.append(index_list)
-        predicted_scores.append(score_list)
-    return predicted_labels, predicted_scores
+    predicted_labels, predicted_scores = ld.predicted_indices(scores, ld.decode_threshold(scores, threshold))
+    return [labels.tolist() for labels in predicted_labels], [values.tolist() for values in predicted_scores]
 
 
 def get_label_topk(scores, top_num=1):
@@ -243,20 +228,11 @@ def get_label_topk(scores, top_num=1):
         scores: The all classes predicted scores provided by network
         top_num: The max topK number (default: 5)
     Returns:
-        The predicted labels
-    """
-    predicted_labels = []
-    predicted_scores = []
-    scores = np.ndarray.tolist(scores)
-    for score in scores:
-        score_list = []
-        index_list = np.argsort(score)[-top_num:]
-        index_list = index_list[::-1]
-        for index in index_list:
-            score_list.append(score[index])
-        predicted_labels.append(np.ndarray.tolist(index_list))
-        predicted_scores.append(score_list)
-    return predicted_labels, predicted_scores
+        The predicted labels, by decreasing score
+        The predicted scores
+    """
+    top = ld.top_classes(scores, top_num)
+    return top.tolist(), np.take_along_axis(np.asarray(scores), top, axis=1).tolist()
 
 
 def create_metadata_file(word2vec_file, output_file):
@@ -272,9 +248,8 @@ def create_metadata_file(word2vec_file, output_file):
     if not os.path.isfile(word2vec_file):
         raise IOError("[Error] The word2vec file doesn't exist.")
 
-    BERT_path_root = "./data/chinese-roberta-wwm-ext-large"
-    tokenizer = BertTokenizer.from_pretrained(BERT_path_root)
-    model = BertModel.from_pretrained(BERT_path_root)
+    tokenizer = lr.get_tokenizer(BERT_PATH_ROOT)
+    model = lr.get_bert_model(BERT_PATH_ROOT)
     EXAMPLE_SENTENCE = "你好，我的名字是吳曉光"
     encodes = tokenizer.encode(EXAMPLE_SENTENCE, add_special_tokens=True)
     print(encodes)
@@ -292,12 +267,47 @@ def create_metadata_file(word2vec_file, output_file):
                 fout.write(word[0] + '\n')
 
 
-def load_word2vec_matrix(word2vec_file):
+def export_word2vec_matrix(matrix_file=EMBEDDING_MATRIX_FILE):
+    """
+    Export the BERT input embedding table as a float32 .npy file (row i is the vector of token id i).
+    It only needs to run once, later runs memory-map the file instead of loading the BERT model.
+
+    Args:
+        matrix_file: The output .npy file
+    Returns:
+        The shape of the exported matrix
+    Raises:
+        IOError: If the output file is not a .npy file
+    """
+    if not matrix_file.endswith('.npy'):
+        raise IOError("[Error] The embedding matrix file is not a npy file.")
+
+    tokenizer = lr.get_tokenizer(BERT_PATH_ROOT)
+    bert = lr.get_bert_model(BERT_PATH_ROOT)
+    vocab_size = len(tokenizer.get_vocab())  ## 21128 (vocab.txt size)
+    with lr.lazy_import('torch').no_grad():
+        embedding_matrix = bert.get_input_embeddings().weight[:vocab_size].numpy().astype(np.float32)
+
+    matrix_dir = os.path.dirname(matrix_file)
+    if matrix_dir and not os.path.exists(matrix_dir):
+        os.makedirs(matrix_dir, exist_ok=True)
+    tmp_file = "{0}.{1}.tmp.npy".format(matrix_file[:-len('.npy')], os.getpid())
+    np.save(tmp_file, embedding_matrix)
+    os.replace(tmp_file, matrix_file)
+    return embedding_matrix.shape
+
+
+def load_word2vec_matrix(word2vec_file, matrix_file=EMBEDDING_MATRIX_FILE, vocab_map=None):
     """
     Return the word2vec model matrix.
+    The matrix is memory-mapped read-only from the exported .npy file, so processes on the same box
+    share its pages. The file is exported first if it doesn't exist yet.
+    With a vocab map (see build_vocab_map), only its rows are returned, in the order of the new ids.
 
     Args:
         word2vec_file: The word2vec file
+        matrix_file: The exported embedding matrix .npy file
+        vocab_map: The token ids kept by the vocab pruning (default: None, the whole vocab)
     Returns:
         The word2vec model matrix
     Raises:
@@ -317,290 +327,486 @@ def load_word2vec_matrix(word2vec_file):
     # return vocab_size, embedding_size, embedding_matrix
 
     # BERT
-    BERT_path_root = "./data/chinese-roberta-wwm-ext-large"
-    tokenizer = BertTokenizer.from_pretrained(BERT_path_root)
-    bert = BertModel.from_pretrained(BERT_path_root)
-    token_embedding = {token: bert.get_input_embeddings()(torch.tensor(id))  for token, id in tokenizer.get_vocab().items()}
-    vocab_size = len(token_embedding) ## 21128 (vocab.txt size)
-
-    embedding_size = len(token_embedding['[CLS]'])
-    embedding_matrix = np.zeros([vocab_size, embedding_size])
-    for token, id in tokenizer.get_vocab().items():
-        embedding_matrix[id] = token_embedding[token].detach().numpy()
+    if not os.path.isfile(matrix_file):
+        export_word2vec_matrix(matrix_file)
+    embedding_matrix = np.load(matrix_file, mmap_mode='r')
+    if vocab_map is not None:
+        embedding_matrix = np.ascontiguousarray(embedding_matrix[vocab_map])
+    vocab_size, embedding_size = embedding_matrix.shape
 
     return vocab_size, embedding_size, embedding_matrix ##  EMBEDDING_SIZE:  1024(hidden layer)
 
 
-def bert_encode(data,maximum_length) :
-    input_ids = []
-    attention_masks = []
+def bert_encode(data, maximum_length):
+    """
+    Sentence-level WordPiece encoding of the data.
+
+    Args:
+        data: <list> The sentences
+        maximum_length: The padded length
+    Returns:
+        The int32 input ids and attention masks, both [len(data), maximum_length]
+    """
+    return tk.get_token_indexer(BERT_PATH_ROOT).encode(data, maximum_length)
+
 
-    for i in range(len(data)):
-        encoded = tokenizer.encode_plus(
-            data[i],
-            add_special_tokens=True,
-            max_length=maximum_length,
-            pad_to_max_length=True,
-            return_attention_mask=True,
-        )
-        input_ids.append(encoded['input_ids'])
-        attention_masks.append(encoded['attention_mask'])
-    return np.array(input_ids),np.array(attention_masks)
+# The json keys of the labels of each hierarchy level
+LEVEL_LABEL_KEYS = ['section', 'subsection', 'group', 'subgroup']
 
 
-def data_word2vec(input_file, num_classes_list, total_classes, word2vec_model):
+class _RaggedArray(object):
     """
-    Create the research data tokenindex based on the word2vec model file.
-    Return the class Data(includes the data tokenindex and data labels).
+    Rows of variable length stored as one flat buffer plus int64 offsets.
+    Row i is values[offsets[i]:offsets[i + 1]].
+    """
+    __slots__ = ('values', 'offsets')
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, rows, dtype=np.int32):
+        lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.fromiter((item for row in rows for item in row), dtype=dtype, count=offsets[-1])
+        return cls(values, offsets)
+
+    @classmethod
+    def concatenate(cls, parts):
+        values = np.concatenate([part.values for part in parts])
+        offsets = [parts[0].offsets[:1]]
+        shift = 0
+        for part in parts:
+            offsets.append(part.offsets[1:] + shift)
+            shift += part.offsets[-1]
+        return cls(values, np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for start, end in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist()):
+            yield self.values[start:end]
+
+    def __getitem__(self, index):
+        """
+        An int gives a view of the row, a contiguous slice gives a zero-copy _RaggedArray,
+        an index array gathers the rows into a new _RaggedArray.
+        """
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("row index out of range")
+            return self.values[self.offsets[index]:self.offsets[index + 1]]
+        if isinstance(index, slice) and index.step in (None, 1):
+            start, stop, _ = index.indices(len(self))
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop + 1]
+            return _RaggedArray(self.values[offsets[0]:offsets[-1]], offsets - offsets[0])
+        index = np.arange(len(self))[index] if isinstance(index, slice) else np.asarray(index)
+        starts = self.offsets[index]
+        lengths = self.offsets[index + 1] - starts
+        offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return _RaggedArray(self.values[positions], offsets)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
+class _SparseLabels(object):
+    """Multi-hot labels stored as the label indices of each record, densified per batch on demand."""
+    __slots__ = ('indices', 'num_classes')
+
+    def __init__(self, indices, num_classes):
+        self.indices = indices
+        self.num_classes = num_classes
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.dense([index])[0]
+        return _SparseLabels(self.indices[index], self.num_classes)
+
+    def dense(self, rows=None, dtype=np.float32):
+        """
+        Args:
+            rows: The record indices (default: None, all records)
+            dtype: The dtype of the onehot matrix (default: float32)
+        Returns:
+            The onehot matrix [len(rows), num_classes]
+        """
+        indices = self.indices if rows is None else self.indices[np.asarray(rows)]
+        onehot = np.zeros((len(indices), self.num_classes), dtype=dtype)
+        onehot[np.repeat(np.arange(len(indices)), indices.lengths), indices.values] = 1
+        return onehot
+
+
+class _Data(object):
+    """
+    The research data (includes the data tokenindex and data labels), stored by column:
+    token ids in flat int32 buffers with offsets, labels as sparse label indices per hierarchy level.
+    """
+    __slots__ = ('_id_list', '_title_tokenindex', '_abstract_tokenindex', '_abstract_content_list',
+                 '_labels', '_level_labels', '_total_classes', '_num_classes_list')
+
+    def __init__(self, id_list, title_tokenindex, abstract_tokenindex, abstract_content_list,
+                 labels, level_labels, num_classes_list, total_classes):
+        self._id_list = id_list
+        self._title_tokenindex = title_tokenindex
+        self._abstract_tokenindex = abstract_tokenindex
+        self._abstract_content_list = abstract_content_list
+        self._labels = labels
+        self._level_labels = level_labels
+        self._num_classes_list = list(num_classes_list)
+        self._total_classes = total_classes
+
+    @classmethod
+    def concatenate(cls, parts):
+        return cls([i for part in parts for i in part._id_list],
+                   _RaggedArray.concatenate([part._title_tokenindex for part in parts]),
+                   _RaggedArray.concatenate([part._abstract_tokenindex for part in parts]),
+                   [i for part in parts for i in part._abstract_content_list],
+                   _RaggedArray.concatenate([part._labels for part in parts]),
+                   [_RaggedArray.concatenate([part._level_labels[level] for part in parts])
+                    for level in range(len(parts[0]._level_labels))],
+                   parts[0]._num_classes_list, parts[0]._total_classes)
+
+    def remap(self, id_table):
+        """
+        Returns:
+            The same data with every token id i replaced by id_table[i]
+        """
+        return _Data(self._id_list,
+                     _RaggedArray(id_table[self._title_tokenindex.values], self._title_tokenindex.offsets),
+                     _RaggedArray(id_table[self._abstract_tokenindex.values], self._abstract_tokenindex.offsets),
+                     self._abstract_content_list, self._labels, self._level_labels,
+                     self._num_classes_list, self._total_classes)
+
+    @property
+    def number(self):
+        return len(self._id_list)
+
+    @property
+    def patent_id(self):
+        return self._id_list
+
+    @property
+    def title_tokenindex(self):
+        return self._title_tokenindex
+
+    @property
+    def abstract_tokenindex(self):
+        return self._abstract_tokenindex
+
+    @property
+    def abstract_content(self):
+        return self._abstract_content_list
+
+    @property
+    def labels(self):
+        return self._labels
+
+    @property
+    def onehot_labels_tuple(self):
+        """The tuple of the onehot labels of each hierarchy level."""
+        return tuple(_SparseLabels(level_labels, num_classes)
+                     for level_labels, num_classes in zip(self._level_labels, self._num_classes_list))
+
+    @property
+    def onehot_labels(self):
+        return _SparseLabels(self._labels, self._total_classes)
+
+
+def _records_word2vec(lines, num_classes_list, total_classes, indexer, tokenize_mode='char'):
+    """
+    Create the tokenindex and labels of the research data lines.
+    The titles and abstracts are collected first and tokenized in one batch by the TokenIndexer.
 
     Args:
-        input_file: The research data
+        lines: The iterable of the json lines
         num_classes_list: <list> The number of classes
         total_classes: The total number of classes
-        word2vec_model: The word2vec model file
+        indexer: The TokenIndexer
+        tokenize_mode: 'char' or 'wordpiece' (default: 'char')
     Returns:
-        The Class _Data() (includes the data tokenindex and data labels)
-    Raises:
-        IOError: If the input file is not the .json file
+        The Class _Data() of the lines
     """
     # w2v
     # vocab = dict([(k, v.index) for (k, v) in word2vec_model.wv.vocab.items()])
 
-    # #　# BERT
-    BERT_path_root = "./data/chinese-roberta-wwm-ext-large"
-    tokenizer = BertTokenizer.from_pretrained(BERT_path_root)
-    bert = BertModel.from_pretrained(BERT_path_root)
-    # token_embedding = {token: bert.get_input_embeddings()(torch.tensor(id))  for token, id in tokenizer.get_vocab().items()}
-    vocab = dict([(token, id) for token, id in tokenizer.get_vocab().items()])
-
-    # original 
-    def _token_to_index(content): ## change the vocab part 
-        result = []
-        for item in content:
-            # 1
-            word2id = tokenizer.convert_tokens_to_ids(item)
-            ## OR 2
-            # word2id = vocab.get(item)
-            if word2id is None:
-                word2id = 0
-            result.append(word2id)
-        return result
-
-    # def _token_to_index(content): ## change the vocab part 
-    #     result = []
-    #     # for item in content:
-    #     marked_text = "[CLS] " + "".join(content) + " [SEP]"
-    #     tokenized_text = tokenizer.tokenize(marked_text)
-    #     word2id = tokenizer.convert_tokens_to_ids(tokenized_text)
-    #     # word2id = vocab.get(item)
-    #     # print(word2id)
-    #     if word2id is None:
-    #         word2id = 0
-    #     result.append(word2id)
-    #     return result
-
-    # def _token_to_index(content): ## BERT sentence option
-    #     input_ids = []
-    #     attention_masks = []
-    #     for i in range(len(data)):
-    #         encoded = tokenizer.encode_plus(
-    #             data[i],
-    #             add_special_tokens=True,
-    #             max_length=128,
-    #             pad_to_max_length=True,
-    #             return_attention_mask=True,
-    #         )
-        
-    #         input_ids.append(encoded['input_ids'])
-    #         attention_masks.append(encoded['attention_mask'])
-
-    #     return np.array(input_ids)
-
-
-    def _create_onehot_labels(labels_index, num_labels): ## no effect 
-        label = [0] * num_labels
-        for item in labels_index:
-            label[int(item)] = 1
-        return label
+    id_list = []
+    title_content_list = []
+    abstract_token_list = []
+    abstract_content_list = []
+    labels_list = []
+    level_labels_list = [[] for _ in num_classes_list]
+
+    for eachline in lines:
+        data = json.loads(eachline)
+        patent_id = data['id']
+        title_content = data['title']
+        abstract_content = data['abstract']
+        ## expeirment
+        # bert_sentence =[] ## single words option   =>  bugged
+        #  
+        bert_sentence ="" ## sentence option
+        for words in abstract_content:
+            bert_sentence+=words
+        abstract_content_list.append(bert_sentence)
+
+        # section, subsection, group (and subgroup for the 4-level configs)
+        for level_labels, key in zip(level_labels_list, LEVEL_LABEL_KEYS):
+            level_labels.append(data[key])
+        total_labels = data['labels']
+
+        id_list.append(patent_id)
+        title_content_list.append(title_content)
+        abstract_token_list.append(abstract_content)
+        labels_list.append(total_labels)
+
+    title_tokenindex = _RaggedArray(*indexer.index(title_content_list, tokenize_mode))
+    abstract_tokenindex = _RaggedArray(*indexer.index(abstract_token_list, tokenize_mode))
+
+    return _Data(id_list, title_tokenindex, abstract_tokenindex, abstract_content_list,
+                 _RaggedArray.from_lists(labels_list),
+                 [_RaggedArray.from_lists(level_labels) for level_labels in level_labels_list],
+                 num_classes_list, total_classes)
+
+
+def _jsonl_shards(input_file, num_shards):
+    """
+    Split the json lines file into byte ranges which start and end on line boundaries.
+
+    Args:
+        input_file: The research data
+        num_shards: The number of shards wanted
+    Returns:
+        <list> The (start, end) byte offsets of each non-empty shard, in file order
+    """
+    file_size = os.path.getsize(input_file)
+    boundaries = [0]
+    with open(input_file, 'rb') as fin:
+        for i in range(1, num_shards):
+            fin.seek(max(file_size * i // num_shards, boundaries[-1]))
+            fin.readline()  # Move to the start of the next line
+            boundaries.append(min(fin.tell(), file_size))
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+
+def _read_shard_lines(input_file, start, end):
+    with open(input_file, 'rb') as fin:
+        fin.seek(start)
+        while fin.tell() < end:
+            line = fin.readline()
+            if not line:
+                break
+            if line.strip():
+                yield line.decode('utf-8')
+
+
+def _shard_word2vec(shard):
+    """
+    Worker of the sharded ingestion, the tokenizer is built once per worker process.
+
+    Args:
+        shard: The tuple (input_file, start, end, num_classes_list, total_classes, tokenize_mode)
+    Returns:
+        The Class _Data() of the shard
+    """
+    input_file, start, end, num_classes_list, total_classes, tokenize_mode = shard
+    indexer = tk.get_token_indexer(BERT_PATH_ROOT)
+    return _records_word2vec(_read_shard_lines(input_file, start, end), num_classes_list, total_classes,
+                             indexer, tokenize_mode)
+
 
+def data_word2vec(input_file, num_classes_list, total_classes, indexer, num_workers=1, tokenize_mode='char'):
+    """
+    Create the research data tokenindex based on the tokenizer vocab.
+    Return the class Data(includes the data tokenindex and data labels).
+    With num_workers > 1 the file is split into byte-range shards which are parsed by a process pool,
+    the shards are merged back in file order so the records keep their original order.
+
+    Args:
+        input_file: The research data
+        num_classes_list: <list> The number of classes
+        total_classes: The total number of classes
+        indexer: The TokenIndexer (used to be the word2vec model)
+        num_workers: The number of parsing processes (default: 1)
+        tokenize_mode: 'char' or 'wordpiece' (default: 'char')
+    Returns:
+        The Class _Data() (includes the data tokenindex and data labels)
+    Raises:
+        IOError: If the input file is not the .json file, or there are more levels than LEVEL_LABEL_KEYS
+    """
     if not input_file.endswith('.json'):
         raise IOError("[Error] The research data is not a json file. "
                       "Please preprocess the research data into the json file.")
-    with open(input_file,encoding='utf-8') as fin:
-        id_list = []
-        title_index_list = []
-        abstract_index_list = []
-        abstract_content_list = []
-        labels_list = []
-        onehot_labels_list = []
-        onehot_labels_tuple_list = []
-        total_line = 0
-
-        bert_content_list = []
-
-        for eachline in fin:
-            data = json.loads(eachline)
-            patent_id = data['id']
-            title_content = data['title']
-            abstract_content = data['abstract']
-            ## expeirment
-            # bert_sentence =[] ## single words option   =>  bugged
-            #  
-            bert_sentence ="" ## sentence option
-            for words in abstract_content:
-                bert_sentence+=words
-            abstract_content_list.append(bert_sentence)
-
-            first_labels = data['section']
-            second_labels = data['subsection']
-            third_labels = data['group']
-            #fourth_labels = data['subgroup']
-            total_labels = data['labels']
-
-            id_list.append(patent_id)
-            title_index_list.append(_token_to_index(title_content))
-
-            abstract_index_list.append(_token_to_index(abstract_content))
-            abstract_content_list.append(abstract_content)
-            # abstract_index_list.append(_token_to_index(bert_content_list))
-            # abstract_content_list.append(bert_content_list)
-
-            labels_list.append(total_labels)
-            # labels_tuple = (_create_onehot_labels(first_labels, num_classes_list[0]),
-            #                 _create_onehot_labels(second_labels, num_classes_list[1]),
-            #                 _create_onehot_labels(third_labels, num_classes_list[2]))
-            #                 _create_onehot_labels(fourth_labels, num_classes_list[3]))
-            labels_tuple = (_create_onehot_labels(first_labels, num_classes_list[0]),
-                            _create_onehot_labels(second_labels, num_classes_list[1]),
-                            _create_onehot_labels(third_labels, num_classes_list[2]))
-
-        
-           
-            onehot_labels_tuple_list.append(labels_tuple)
-            onehot_labels_list.append(_create_onehot_labels(total_labels, total_classes))
-            total_line += 1
-
-    class _Data:
-        def __init__(self):
-            pass
-
-        @property
-        def number(self):
-            return total_line
-
-        @property
-        def patent_id(self):
-            return id_list
-
-        @property
-        def title_tokenindex(self):
-            return title_index_list
-
-        @property
-        def abstract_tokenindex(self):
-            return abstract_index_list
-
-        @property
-        def abstract_content(self):
-            return abstract_content_list
-
-        @property
-        def labels(self):
-            return labels_list
-
-        @property
-        def onehot_labels_tuple(self):
-            return onehot_labels_tuple_list
-
-        @property
-        def onehot_labels(self):
-            return onehot_labels_list
-
-    return _Data()
-
-
-def data_augmented(data, drop_rate=1.0):
-    """
-    Data augment.
-
-    Args:
-        data: The Class _Data()
-        drop_rate: The drop rate
+    if len(num_classes_list) > len(LEVEL_LABEL_KEYS):
+        raise IOError("[Error] The research data has the labels of {0} levels ({1}), "
+                      "but num_classes_list has {2} levels.".format(len(LEVEL_LABEL_KEYS),
+                                                                    ', '.join(LEVEL_LABEL_KEYS),
+                                                                    len(num_classes_list)))
+
+    if num_workers <= 1:
+        with open(input_file, encoding='utf-8') as fin:
+            return _records_word2vec(fin, num_classes_list, total_classes, indexer, tokenize_mode)
+
+    # Several shards per worker keep the pool busy when the record lengths are uneven
+    shards = [(input_file, start, end, list(num_classes_list), total_classes, tokenize_mode)
+              for start, end in _jsonl_shards(input_file, num_workers * 4)]
+    with multiprocessing.Pool(processes=num_workers) as pool:
+        # imap keeps the shard order, so the records keep their order in the file
+        parts = list(pool.imap(_shard_word2vec, shards))
+    return _Data.concatenate(parts)
+
+
+def augment_batch(x_batch, rng, aug_prob=0.5, drop_rate=0.1):
+    """
+    Data augment, on one padded batch.
+    Each document (of at least 2 tokens) is augmented with probability aug_prob: its tokens are randomly
+    shuffled and a drop_rate fraction of them is randomly dropped (at least one token is kept).
+    The augmented documents replace the originals in the batch, so nothing is stored besides the batch.
+
+    Args:
+        x_batch: The padded batch, [batch_size, seq_len] (post padding with 0)
+        rng: The np.random.RandomState
+        aug_prob: The probability that a document is augmented (default: 0.5)
+        drop_rate: The fraction of the tokens dropped from an augmented document (default: 0.1)
     Returns:
-        The Class _AugData()
-    """
-    aug_num = data.number
-    aug_patent_id = data.patent_id
-    aug_title_tokenindex = data.title_tokenindex
-    aug_abstract_tokenindex = data.abstract_tokenindex
-    aug_labels = data.labels
-    aug_onehot_labels = data.onehot_labels
-    aug_onehot_labels_tuple = data.onehot_labels_tuple
-
-    for i in range(len(data.aug_abstract_tokenindex)):
-        data_record = data.tokenindex[i]
-        if len(data_record) == 1:  # 句子长度为 1，则不进行增广
-            continue
-        elif len(data_record) == 2:  # 句子长度为 2，则交换两个词的顺序
-            data_record[0], data_record[1] = data_record[1], data_record[0]
-            aug_patent_id.append(data.patent_id[i])
-            aug_title_tokenindex.append(data.title_tokenindex[i])
-            aug_abstract_tokenindex.append(data_record)
-            aug_labels.append(data.labels[i])
-            aug_onehot_labels.append(data.onehot_labels[i])
-            aug_onehot_labels_tuple.append(data.onehot_labels_tuple[i])
-            aug_num += 1
-        else:
-            data_record = np.array(data_record)
-            for num in range(len(data_record) // 10):  # 打乱词的次数，次数即生成样本的个数；次数根据句子长度而定
-                # random shuffle & random drop
-                data_shuffled = np.random.permutation(np.arange(int(len(data_record) * drop_rate)))
-                new_data_record = data_record[data_shuffled]
+        The augmented batch, of the same shape
+    """
+    batch_size, seq_len = x_batch.shape
+    lengths = np.count_nonzero(x_batch, axis=1)
+    augmented = (rng.random_sample(batch_size) < aug_prob) & (lengths > 1)
+    if not augmented.any():
+        return x_batch
+
+    keep_lengths = np.where(augmented, np.maximum((lengths * (1.0 - drop_rate)).astype(np.int64), 1), lengths)
+    positions = np.arange(seq_len)
+    # Random sort keys for the tokens of the augmented documents, the positions themselves for the others.
+    # The padding sorts last, so argsort gives a shuffle of each document's own tokens.
+    keys = np.where(augmented[:, None], rng.random_sample((batch_size, seq_len)), positions[None, :])
+    keys[positions[None, :] >= lengths[:, None]] = np.inf
+    order = np.argsort(keys, axis=1, kind='stable')
+    x_augmented = np.take_along_axis(x_batch, order, axis=1)
+    # Dropping the last tokens of a random permutation is a random drop
+    x_augmented[positions[None, :] >= keep_lengths[:, None]] = 0
+    return x_augmented
+
+
+def _file_md5(input_file, chunk_size=1 << 20):
+    """
+    Compute the md5 hex digest of a file without reading it into memory at once.
 
-                aug_patent_id.append(data.patent_id[i])
-                aug_title_tokenindex.append(data.title_tokenindex[i])
-                aug_abstract_tokenindex.append(list(new_data_record))
-                aug_labels.append(data.labels[i])
-                aug_onehot_labels.append(data.onehot_labels[i])
-                aug_onehot_labels_tuple.append(data.onehot_labels_tuple[i])
-                aug_num += 1
+    Args:
+        input_file: The file path
+        chunk_size: The size of each read chunk
+    Returns:
+        The md5 hex digest
+    """
+    md5 = hashlib.md5()
+    with open(input_file, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
 
-    class _AugData:
-        def __init__(self):
-            pass
 
-        @property
-        def number(self):
-            return aug_num
+def get_data_cache_file(data_file, num_classes_list, total_classes, cache_dir, tokenize_mode='char'):
+    """
+    Get the token-index cache file path of the research data.
+    The cache key combines the data file hash, the tokenizer vocab hash and the label layout,
+    so any change of them leads to a new cache file.
+
+    Args:
+        data_file: The research data
+        num_classes_list: <list> The number of classes
+        total_classes: The total number of classes
+        cache_dir: The cache directory
+        tokenize_mode: 'char' or 'wordpiece' (default: 'char')
+    Returns:
+        The cache file path
+    """
+    name = os.path.splitext(os.path.basename(data_file))[0]
+    return os.path.join(cache_dir, "{0}-v{1}-{2}.pkl".format(
+        name, DATA_CACHE_VERSION, data_cache_key(data_file, num_classes_list, total_classes, tokenize_mode)))
 
-        @property
-        def patent_id(self):
-            return aug_patent_id
 
-        @property
-        def title_tokenindex(self):
-            return aug_title_tokenindex
+def data_cache_key(data_file, num_classes_list, total_classes, tokenize_mode='char'):
+    """
+    The hash of everything the token indices and the labels of the research data depend on:
+    the data file, the tokenizer vocab, the label layout and the tokenize mode.
 
-        @property
-        def abstract_tokenindex(self):
-            return aug_abstract_tokenindex
+    Args:
+        data_file: The research data
+        num_classes_list: <list> The number of classes
+        total_classes: The total number of classes
+        tokenize_mode: 'char' or 'wordpiece' (default: 'char')
+    Returns:
+        The hex digest of the key
+    """
+    key = hashlib.md5()
+    key.update(_file_md5(data_file).encode('utf-8'))
+    key.update(_file_md5(os.path.join(BERT_PATH_ROOT, 'vocab.txt')).encode('utf-8'))
+    key.update(json.dumps([int(i) for i in num_classes_list] + [int(total_classes)]).encode('utf-8'))
+    key.update(tokenize_mode.encode('utf-8'))
+    return key.hexdigest()
 
-        @property
-        def labels(self):
-            return aug_labels
 
-        @property
-        def onehot_labels(self):
-            return aug_onehot_labels
+def load_data_cache(cache_file):
+    """
+    Load the cached research data.
 
-        @property
-        def onehot_labels_tuple(self):
-            return aug_onehot_labels_tuple
+    Args:
+        cache_file: The cache file path
+    Returns:
+        The class _Data(), or None if the cache is missing or stale
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as fin:
+            cache = pickle.load(fin)
+    except (EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    if cache.get('version') != DATA_CACHE_VERSION:
+        return None
+    return cache['data']
+
+
+def save_data_cache(cache_file, data):
+    """
+    Save the research data into the cache file.
+    The file is written to a temporary path first and then renamed, so concurrent readers
+    never see a partially written cache.
 
-    return _AugData()
+    Args:
+        cache_file: The cache file path
+        data: The class _Data()
+    """
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = "{0}.{1}.tmp".format(cache_file, os.getpid())
+    with open(tmp_file, 'wb') as fout:
+        pickle.dump({'version': DATA_CACHE_VERSION, 'data': data}, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
 
 
-def load_data_and_labels(data_file, num_classes_list, total_classes, word2vec_file, data_aug_flag):
+def load_data_and_labels(data_file, num_classes_list, total_classes, word2vec_file, cache_dir=None,
+                         num_workers=1, tokenize_mode='char'):
     """
     Load research data from files, splits the data into words and generates labels.
     Return split sentences, labels and the max sentence length of the research data.
@@ -610,7 +816,9 @@ def load_data_and_labels(data_file, num_classes_list, total_classes, word2vec_fi
         num_classes_list: <list> The number of classes
         total_classes: The total number of classes
         word2vec_file: The word2vec file
-        data_aug_flag: The flag of data augmented
+        cache_dir: The token-index cache directory (default: None, no cache)
+        num_workers: The number of processes parsing the data file (default: 1)
+        tokenize_mode: 'char' or 'wordpiece' (default: 'char')
     Returns:
         The class _Data()
     Raises:
@@ -619,26 +827,206 @@ def load_data_and_labels(data_file, num_classes_list, total_classes, word2vec_fi
     # Load word2vec file
     if not os.path.isfile(word2vec_file):
         raise IOError("[Error] The word2vec file doesn't exist. ")
-    
-    BERT_path_root = "./data/chinese-roberta-wwm-ext-large"
-    # tokenizer = BertTokenizer.from_pretrained(BERT_path_root)
-    model = BertModel.from_pretrained(BERT_path_root)
-    # encodes = tokenizer.encode(EXAMPLE_SENTENCE, add_special_tokens=True)
 
-    # #model = Word2Vec.load(word2vec_file)
-    # model = word2vec.Word2Vec.load(word2vec_file)
+    data = None
+    if cache_dir:
+        cache_file = get_data_cache_file(data_file, num_classes_list, total_classes, cache_dir, tokenize_mode)
+        data = load_data_cache(cache_file)
+
+    if data is None:
+        indexer = tk.get_token_indexer(BERT_PATH_ROOT)
+        # encodes = tokenizer.encode(EXAMPLE_SENTENCE, add_special_tokens=True)
 
-    # Load data from files and split by words
-    data = data_word2vec(data_file, num_classes_list, total_classes, model)
-    if data_aug_flag:
-        data = data_augmented(data)
+        # #model = Word2Vec.load(word2vec_file)
+        # model = word2vec.Word2Vec.load(word2vec_file)
+
+        # Load data from files and split by words
+        data = data_word2vec(data_file, num_classes_list, total_classes, indexer,
+                             num_workers=num_workers, tokenize_mode=tokenize_mode)
+        if cache_dir:
+            save_data_cache(cache_file, data)
 
     # plot_seq_len(data_file, data)
 
     return data
 
 
-def pad_data(data, pad_seq_len):
+def build_vocab_map(data):
+    """
+    Vocab pruning: keep only the token ids which appear in the data, plus the special tokens of the tokenizer.
+    The kept ids stay in their BERT order, so [PAD] (id 0) stays id 0.
+
+    Args:
+        data: The research data (the training data)
+    Returns:
+        vocab_map: The int32 kept token ids, vocab_map[new id] = BERT id
+    """
+    tokenizer = lr.get_tokenizer(BERT_PATH_ROOT)
+    observed = np.zeros(len(tokenizer.get_vocab()), dtype=bool)
+    observed[data.title_tokenindex.values] = True
+    observed[data.abstract_tokenindex.values] = True
+    observed[tokenizer.all_special_ids] = True
+    return np.flatnonzero(observed).astype(np.int32)
+
+
+def remap_data(data, vocab_map):
+    """
+    Replace the BERT token ids of the data by the ids of the pruned vocab,
+    the ids which were pruned away become [UNK].
+
+    Args:
+        data: The research data
+        vocab_map: The kept token ids (see build_vocab_map)
+    Returns:
+        The class _Data()
+    """
+    tokenizer = lr.get_tokenizer(BERT_PATH_ROOT)
+    id_table = np.full(len(tokenizer.get_vocab()), np.searchsorted(vocab_map, tokenizer.unk_token_id),
+                       dtype=np.int32)
+    id_table[vocab_map] = np.arange(len(vocab_map), dtype=np.int32)
+    return data.remap(id_table)
+
+
+def save_vocab_map(model_dir, vocab_map):
+    """
+    Save the vocab map with the run, the test and visualization scripts apply the same map.
+
+    Args:
+        model_dir: The run directory (runs/<timestamp>)
+        vocab_map: The kept token ids
+    """
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir, exist_ok=True)
+    np.save(os.path.join(model_dir, VOCAB_MAP_FILE), vocab_map)
+
+
+def load_vocab_map(model_dir):
+    """
+    Args:
+        model_dir: The run directory (runs/<timestamp>)
+    Returns:
+        The kept token ids of the run, None if the run was trained on the whole vocab
+    """
+    vocab_map_file = os.path.join(model_dir, VOCAB_MAP_FILE)
+    if not os.path.isfile(vocab_map_file):
+        return None
+    return np.load(vocab_map_file)
+
+
+def build_hierarchy(data, chunk_size=4096):
+    """
+    Derive the label hierarchy from the data: the child class c of level i + 1 belongs to the parent class p
+    of level i if some record has both p and c.
+
+    Args:
+        data: The research data (the training data)
+        chunk_size: The number of records counted per dense product (default: 4096)
+    Returns:
+        <list> The bool matrices [num_classes_list[i], num_classes_list[i + 1]] of each pair of levels
+    """
+    levels = data.onehot_labels_tuple
+    hierarchy = []
+    for parents, children in zip(levels[:-1], levels[1:]):
+        counts = np.zeros((parents.num_classes, children.num_classes), dtype=np.float64)
+        for start in range(0, data.number, chunk_size):
+            rows = np.arange(start, min(start + chunk_size, data.number))
+            counts += parents.dense(rows).T.dot(children.dense(rows))
+        hierarchy.append(counts > 0)
+    return hierarchy
+
+
+def stratified_subset(labels_tuple, subset_size, seed=None):
+    """
+    A fixed subset of the records which keeps the label distribution of each hierarchy level
+    (iterative stratification): the classes of all the levels are taken from the rarest, each one gets
+    its share of subset_size / number records, drawn among the records it has that are not in yet,
+    first among those whose other classes are still under their share. The subset is then filled up
+    the same way from all the records left.
+
+    Args:
+        labels_tuple: The tuple of the data labels of each hierarchy level (_SparseLabels)
+        subset_size: The number of records of the subset
+        seed: The seed of the draws (default: None)
+    Returns:
+        The record indices of the subset, increasing
+    """
+    data_size = len(labels_tuple[0])
+    if subset_size >= data_size:
+        return np.arange(data_size)
+    rng = np.random.RandomState(seed)
+    fraction = subset_size / data_size
+
+    # The records of each class of all the levels (the classes of level i are offset by the classes before it),
+    # the class counts and their target counts in the subset
+    record_labels = [(labels.indices, offset) for labels, offset in
+                     zip(labels_tuple, np.cumsum([0] + [labels.num_classes for labels in labels_tuple[:-1]]))]
+    class_records, counts = [], []
+    for labels in labels_tuple:
+        rows = np.repeat(np.arange(data_size), labels.indices.lengths)
+        level_counts = np.bincount(labels.indices.values, minlength=labels.num_classes)
+        class_records.extend(np.split(rows[np.argsort(labels.indices.values, kind='stable')],
+                                      np.cumsum(level_counts)[:-1]))
+        counts.append(level_counts)
+    counts = np.concatenate(counts)
+    targets = np.rint(counts * fraction).astype(np.int64)
+    selected_counts = np.zeros_like(counts)
+    selected = np.zeros(data_size, dtype=bool)
+
+    def _draw(candidates, size):
+        # The candidates with a class already at its share come last
+        full = np.zeros(len(candidates), dtype=bool)
+        for indices, offset in record_labels:
+            rows = indices[candidates]
+            at_target = selected_counts[rows.values + offset] >= targets[rows.values + offset]
+            full |= np.bincount(np.repeat(np.arange(len(candidates)), rows.lengths), weights=at_target,
+                                minlength=len(candidates)) > 0
+        order = rng.permutation(len(candidates))
+        drawn = candidates[order[np.argsort(full[order], kind='stable')][:size]]
+        selected[drawn] = True
+        for indices, offset in record_labels:
+            np.add.at(selected_counts, indices[drawn].values + offset, 1)
+        return len(drawn)
+
+    num_selected = 0
+    for label in np.argsort(counts, kind='stable'):
+        need = min(targets[label] - selected_counts[label], subset_size - num_selected)
+        if need > 0:
+            candidates = class_records[label][~selected[class_records[label]]]
+            num_selected += _draw(candidates, need)
+    if num_selected < subset_size:
+        _draw(np.flatnonzero(~selected), subset_size - num_selected)
+    return np.flatnonzero(selected)
+
+
+def save_hierarchy(model_dir, hierarchy):
+    """
+    Save the label hierarchy with the run.
+
+    Args:
+        model_dir: The run directory (runs/<timestamp>)
+        hierarchy: <list> The parent -> child bool matrices
+    """
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir, exist_ok=True)
+    np.savez(os.path.join(model_dir, HIERARCHY_FILE),
+             **{"level_{0}".format(level): matrix for level, matrix in enumerate(hierarchy)})
+
+
+def load_hierarchy(model_dir):
+    """
+    Args:
+        model_dir: The run directory (runs/<timestamp>)
+    Returns:
+        <list> The parent -> child bool matrices of the run, None if the run has no hierarchy file
+    """
+    hierarchy_file = os.path.join(model_dir, HIERARCHY_FILE)
+    if not os.path.isfile(hierarchy_file):
+        return None
+    with np.load(hierarchy_file) as hierarchy:
+        return [hierarchy["level_{0}".format(level)] for level in range(len(hierarchy.files))]
+
+
+def pad_data(data, pad_seq_len, dynamic=False):
     """
     Padding each sentence of research data according to the max sentence length.
     Return the padded data and data labels.
@@ -646,41 +1034,162 @@ def pad_data(data, pad_seq_len):
     Args:
         data: The research data
         pad_seq_len: The max sentence length of research data
+        dynamic: Leave the data unpadded, to be padded per batch by batch_sampler (default: False)
     Returns:
-        pad_seq: The padded data
-        labels: The data labels
+        pad_seq: The padded data, int32 [data.number, pad_seq_len] (the unpadded tokenindex if dynamic)
+        labels: The data labels (sparse, densified per batch)
+        labels_tuple: The tuple of the data labels of each hierarchy level
     """
-    abstract_pad_seq = pad_sequences(data.abstract_tokenindex, maxlen=pad_seq_len, value=0.)
+    abstract_tokenindex = data.abstract_tokenindex
+    if dynamic:
+        abstract_pad_seq = abstract_tokenindex
+    else:
+        abstract_pad_seq = tk.pad_ragged(abstract_tokenindex.values, abstract_tokenindex.offsets, pad_seq_len,
+                                         value=0)
     onehot_labels_list = data.onehot_labels
     onehot_labels_list_tuple = data.onehot_labels_tuple
     return abstract_pad_seq, onehot_labels_list, onehot_labels_list_tuple
 
 
-def batch_iter(data, batch_size, num_epochs, shuffle=True):
+def _prefetch(generator, prefetch_size):
     """
-    含有 yield 说明不是一个普通函数，是一个 Generator.
-    函数效果：对 data，一共分成 num_epochs 个阶段（epoch），在每个 epoch 内，如果 shuffle=True，就将 data 重新洗牌，
-    批量生成 (yield) 一批一批的重洗过的 data，每批大小是 batch_size，一共生成 int(len(data)/batch_size)+1 批。
+    Run the generator on a background thread, keeping up to prefetch_size items ready.
 
     Args:
-        data: The data
+        generator: The generator
+        prefetch_size: The max number of items waiting in the queue
+    Returns:
+        A generator of the same items
+    """
+    if prefetch_size <= 0:
+        yield from generator
+        return
+
+    items = queue.Queue(maxsize=prefetch_size)
+    stop = threading.Event()
+    end = object()
+
+    def _produce():
+        try:
+            for item in generator:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put((end, None))
+        except Exception as e:
+            items.put((end, e))
+
+    producer = threading.Thread(target=_produce, name="batch-prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # The consumer may stop early (e.g. break), let the producer exit
+        stop.set()
+
+
+def _bucketed_batches(lengths, batch_size, bucket_size, shuffle, rng):
+    """
+    Split one epoch into batches of documents of similar length.
+    The (shuffled) documents are taken bucket_size batches at a time and sorted by length inside each pool,
+    then the order of the batches is shuffled, so the batches stay random but have little padding.
+
+    Args:
+        lengths: The document lengths
+        batch_size: The size of the data batch
+        bucket_size: The number of batches pooled and sorted together
+        shuffle: Shuffle or not
+        rng: The np.random.RandomState
+    Returns:
+        <list> The index array of each batch
+    """
+    data_size = len(lengths)
+    indices = rng.permutation(data_size) if shuffle else np.arange(data_size)
+    pool_size = batch_size * bucket_size
+    batches = []
+    for pool_start in range(0, data_size, pool_size):
+        pool = indices[pool_start:pool_start + pool_size]
+        pool = pool[np.argsort(lengths[pool], kind='stable')]
+        batches.extend(pool[start:start + batch_size] for start in range(0, len(pool), batch_size))
+    if shuffle:
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+    return batches
+
+
+def batch_sampler(x, y, y_tuple, batch_size, num_epochs, shuffle=True, prefetch_size=2, seed=None,
+                  pad_seq_len=None, bucket_size=0, aug_prob=0.0, aug_drop_rate=0.1, pad_multiple=1):
+    """
+    Generate the batches of the research data.
+    Only the index permutation is shuffled, each batch is gathered into contiguous typed arrays
+    (int32 x, float32 onehot labels) on a background thread which keeps the next batches ready.
+    When x is the unpadded tokenindex (_RaggedArray), each batch is padded to its own longest document
+    (at most pad_seq_len), and bucket_size > 0 groups documents of similar length into the same batches.
+    pad_multiple > 1 rounds that length up to a multiple, so there are fewer distinct batch shapes
+    (XLA compiles one program per shape).
+    aug_prob > 0 augments the batches on the fly (see augment_batch), on the same background thread.
+
+    Args:
+        x: The padded data, int32 [data_size, pad_seq_len], or the unpadded data tokenindex
+        y: The data labels (_SparseLabels)
+        y_tuple: The tuple of the data labels of each hierarchy level
         batch_size: The size of the data batch
         num_epochs: The number of epochs
         shuffle: Shuffle or not (default: True)
+        prefetch_size: The number of batches prepared ahead (default: 2, 0 for no background thread)
+        seed: The seed of the shuffle (default: None)
+        pad_seq_len: The max padded length of the unpadded data (default: None, no truncation)
+        bucket_size: The number of batches sorted by length together, 0 for no bucketing (default: 0)
+        aug_prob: The probability that a document is augmented, 0 for no augmentation (default: 0.0)
+        aug_drop_rate: The fraction of the tokens dropped from an augmented document (default: 0.1)
+        pad_multiple: The padded length of the unpadded data is rounded up to a multiple of it (default: 1)
     Returns:
-        A batch iterator for data set
+        A batch iterator of (batch_indices, x_batch, y_batch, y_batch_tuple)
     """
-    data = np.array(data)
-    data_size = len(data)
+    data_size = len(x)
     num_batches_per_epoch = int((data_size - 1) / batch_size) + 1
-    for epoch in range(num_epochs):
-        # Shuffle the data at each epoch
-        if shuffle:
-            shuffle_indices = np.random.permutation(np.arange(data_size))
-            shuffled_data = data[shuffle_indices]
+    rng = np.random.RandomState(seed)
+    # A stream of its own, so the batch order does not depend on the augmentation
+    aug_rng = np.random.RandomState(None if seed is None else seed + 1)
+    dynamic_padding = isinstance(x, _RaggedArray)
+    if dynamic_padding:
+        lengths = x.lengths if pad_seq_len is None else np.minimum(x.lengths, pad_seq_len)
+
+    def _gather_x(batch_indices):
+        if not dynamic_padding:
+            x_batch = x[batch_indices]
         else:
-            shuffled_data = data
-        for batch_num in range(num_batches_per_epoch):
-            start_index = batch_num * batch_size
-            end_index = min((batch_num + 1) * batch_size, data_size)
-            yield shuffled_data[start_index:end_index]
+            batch = x[batch_indices]
+            batch_len = max(int(lengths[batch_indices].max()), 1)
+            if pad_multiple > 1:
+                batch_len = -(-batch_len // pad_multiple) * pad_multiple
+                if pad_seq_len is not None:
+                    batch_len = min(batch_len, pad_seq_len)
+            x_batch = tk.pad_ragged(batch.values, batch.offsets, batch_len, value=0)
+        if aug_prob > 0:
+            x_batch = augment_batch(x_batch, aug_rng, aug_prob, aug_drop_rate)
+        return x_batch
+
+    def _batches():
+        for epoch in range(num_epochs):
+            if dynamic_padding and bucket_size > 0:
+                epoch_batches = _bucketed_batches(lengths, batch_size, bucket_size, shuffle, rng)
+            else:
+                indices = rng.permutation(data_size) if shuffle else np.arange(data_size)
+                epoch_batches = (indices[batch_num * batch_size:min((batch_num + 1) * batch_size, data_size)]
+                                 for batch_num in range(num_batches_per_epoch))
+            for batch_indices in epoch_batches:
+                yield (batch_indices, _gather_x(batch_indices), y.dense(batch_indices),
+                       tuple(level.dense(batch_indices) for level in y_tuple))
+
+    return _prefetch(_batches(), prefetch_size)
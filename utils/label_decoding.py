@@ -0,0 +1,98 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import numpy as np
+
+
+def top_classes(scores, top_num):
+    """
+    The top_num best classes of each document by decreasing score, from one partition of the whole batch.
+    Equal scores are taken in the class order (the lower class first), also at the top_num-th place.
+
+    Args:
+        scores: The predicted scores, [batch_size, num_classes]
+        top_num: The number of classes
+    Returns:
+        The classes, int [batch_size, min(top_num, num_classes)]
+    """
+    scores = np.asarray(scores)
+    batch_size, num_classes = scores.shape
+    top_num = min(top_num, num_classes)
+    if top_num == num_classes:
+        return np.argsort(-scores, axis=1, kind='stable')
+    # The top_num-th best score of each document, the classes above it are in, the classes at it fill
+    # the places left
+    kth_score = -np.partition(-scores, top_num - 1, axis=1)[:, top_num - 1:top_num]
+    above = scores > kth_score
+    at = scores == kth_score
+    places_left = top_num - above.sum(axis=1, keepdims=True)
+    selected = above | (at & (np.cumsum(at, axis=1) <= places_left))
+    candidates = np.nonzero(selected)[1].reshape(batch_size, top_num)
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def decode_threshold(scores, threshold=0.5):
+    """
+    The classes whose score reaches the threshold, the best class for the documents without any.
+
+    Args:
+        scores: The predicted scores, [batch_size, num_classes]
+        threshold: The threshold (default: 0.5)
+    Returns:
+        The predicted classes, bool [batch_size, num_classes]
+    """
+    scores = np.asarray(scores)
+    predicted = scores >= threshold
+    empty = np.flatnonzero(~predicted.any(axis=1))
+    predicted[empty, scores[empty].argmax(axis=1)] = True
+    return predicted
+
+
+def decode_topk(scores, top_num=1):
+    """
+    The top-1 to top-top_num predictions at once.
+
+    Args:
+        scores: The predicted scores, [batch_size, num_classes]
+        top_num: The max topK number (default: 1)
+    Returns:
+        The predicted classes of each k in 1..top_num, bool [top_num, batch_size, num_classes]
+    """
+    scores = np.asarray(scores)
+    top = top_classes(scores, top_num)
+    # The rank of each class, top_num for the classes out of the top
+    ranks = np.full(scores.shape, top_num, dtype=np.int64)
+    np.put_along_axis(ranks, top, np.arange(top.shape[1])[np.newaxis, :], axis=1)
+    return ranks[np.newaxis, :, :] < np.arange(1, top_num + 1)[:, np.newaxis, np.newaxis]
+
+
+def decode_predictions(scores, threshold=0.5, top_num=1):
+    """
+    The threshold and the top-1 to top-top_num predictions of a batch.
+
+    Args:
+        scores: The predicted scores, [batch_size, num_classes]
+        threshold: The threshold (default: 0.5)
+        top_num: The max topK number (default: 1)
+    Returns:
+        threshold_predicted: bool [batch_size, num_classes], see decode_threshold
+        topk_predicted: bool [top_num, batch_size, num_classes], see decode_topk
+    """
+    return decode_threshold(scores, threshold), decode_topk(scores, top_num)
+
+
+def predicted_indices(scores, predicted):
+    """
+    The predicted classes and their scores as one array per document.
+
+    Args:
+        scores: The predicted scores, [batch_size, num_classes]
+        predicted: The predicted classes, bool [batch_size, num_classes]
+    Returns:
+        predicted_labels: <list> The int arrays of the predicted classes of each document, increasing
+        predicted_scores: <list> The arrays of their scores
+    """
+    rows, columns = np.nonzero(predicted)
+    splits = np.cumsum(predicted.sum(axis=1))[:-1]
+    return np.split(columns, splits), np.split(np.asarray(scores)[rows, columns], splits)
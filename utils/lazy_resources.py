@@ -0,0 +1,97 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import importlib
+import threading
+
+_modules = {}
+_resources = {}
+_lock = threading.RLock()
+
+
+def lazy_import(name):
+    """
+    Import the module the first time it is asked for.
+    Heavy dependencies (torch, transformers, tflearn...) go through here so that importing
+    utils.data_helpers stays cheap for the jobs that never use them.
+
+    Args:
+        name: The module name (e.g. 'transformers')
+    Returns:
+        The module
+    """
+    module = _modules.get(name)
+    if module is None:
+        with _lock:
+            module = _modules.get(name)
+            if module is None:
+                module = importlib.import_module(name)
+                _modules[name] = module
+    return module
+
+
+def get_resource(key, builder):
+    """
+    Build the resource once per process and return the same object afterwards.
+
+    Args:
+        key: The resource key
+        builder: The function without arguments that builds the resource
+    Returns:
+        The resource
+    """
+    resource = _resources.get(key)
+    if resource is None:
+        with _lock:
+            resource = _resources.get(key)
+            if resource is None:
+                resource = builder()
+                _resources[key] = resource
+    return resource
+
+
+def get_tokenizer(bert_path):
+    """
+    Get the BertTokenizer of the BERT model path (built at most once per process).
+
+    Args:
+        bert_path: The BERT model path
+    Returns:
+        The BertTokenizer
+    """
+    return get_resource(('tokenizer', bert_path),
+                        lambda: lazy_import('transformers').BertTokenizer.from_pretrained(bert_path))
+
+
+def get_bert_model(bert_path):
+    """
+    Get the BertModel of the BERT model path (built at most once per process).
+
+    Args:
+        bert_path: The BERT model path
+    Returns:
+        The BertModel
+    """
+    return get_resource(('bert', bert_path),
+                        lambda: lazy_import('transformers').BertModel.from_pretrained(bert_path))
+
+
+def get_fast_tokenizer(bert_path):
+    """
+    Get the BertTokenizerFast of the BERT model path (built at most once per process).
+
+    Args:
+        bert_path: The BERT model path
+    Returns:
+        The BertTokenizerFast
+    """
+    return get_resource(('fast_tokenizer', bert_path),
+                        lambda: lazy_import('transformers').BertTokenizerFast.from_pretrained(bert_path))
+
+
+def loaded_resources():
+    """
+    Returns:
+        The names of the lazily imported modules and the keys of the built resources
+    """
+    return sorted(_modules), sorted(_resources, key=str)
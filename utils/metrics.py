@@ -0,0 +1,128 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import numpy as np
+
+from utils import label_decoding as ld
+from utils import lazy_resources as lr
+
+
+def _safe_divide(numerator, denominator):
+    """The counts ratio, 0 where the denominator count is 0 (as sklearn with zero_division=0)."""
+    return np.where(denominator > 0, numerator / np.maximum(denominator, 1), 0.0)
+
+
+class StreamingMetrics(object):
+    """
+    Micro-averaged metrics of multi-label predictions, accumulated batch by batch in constant memory:
+    the TP/FP/FN counts of the threshold and of the top-1 to topK predictions, and the score histograms
+    of the positive and the negative labels, from which AUC and AUPRC are computed.
+    The histograms treat the scores of a bin as tied, with num_bins bins over [0, 1] the AUC and AUPRC
+    are within the score mass of a bin of the exact values. exact=True keeps every label and score
+    to compute them exactly with sklearn instead (memory grows with the data).
+    """
+
+    def __init__(self, threshold=0.5, top_num=0, num_bins=10000, exact=False):
+        """
+        Args:
+            threshold: The threshold of the threshold predictions (default: 0.5)
+            top_num: The max topK number, 0 for the threshold predictions only (default: 0)
+            num_bins: The number of bins of the score histograms (default: 10000)
+            exact: Keep the labels and scores for the exact AUC and AUPRC (default: False)
+        """
+        self.threshold = threshold
+        self.top_num = top_num
+        self.num_bins = num_bins
+        self.exact = exact
+        self.counts_ts = np.zeros(3, dtype=np.int64)  # TP, FP, FN
+        self.counts_tk = np.zeros((top_num, 3), dtype=np.int64)
+        self.positive_histogram = np.zeros(num_bins, dtype=np.int64)
+        self.negative_histogram = np.zeros(num_bins, dtype=np.int64)
+        self._labels = []
+        self._scores = []
+
+    @staticmethod
+    def _counts(predicted, labels):
+        """
+        Returns:
+            The TP, FP and FN counts over the last two axes of predicted
+        """
+        true_positives = np.count_nonzero(predicted & labels, axis=(-2, -1))
+        return np.stack([true_positives,
+                         np.count_nonzero(predicted, axis=(-2, -1)) - true_positives,
+                         np.count_nonzero(labels) - true_positives], axis=-1)
+
+    def update(self, labels, scores):
+        """
+        Add a batch.
+
+        Args:
+            labels: The onehot labels, [batch_size, num_classes]
+            scores: The predicted scores, [batch_size, num_classes]
+        """
+        labels = np.asarray(labels) > 0.5
+        scores = np.asarray(scores)
+        self.counts_ts += self._counts(ld.decode_threshold(scores, self.threshold), labels)
+        if self.top_num:
+            self.counts_tk += self._counts(ld.decode_topk(scores, self.top_num), labels[np.newaxis])
+
+        bins = np.clip((scores * self.num_bins).astype(np.int64), 0, self.num_bins - 1)
+        self.positive_histogram += np.bincount(bins[labels], minlength=self.num_bins)
+        self.negative_histogram += np.bincount(bins[~labels], minlength=self.num_bins)
+        if self.exact:
+            self._labels.append(labels.ravel())
+            self._scores.append(scores.ravel().astype(np.float32))
+
+    @staticmethod
+    def _precision_recall_f1(counts):
+        true_positives, false_positives, false_negatives = counts[..., 0], counts[..., 1], counts[..., 2]
+        precision = _safe_divide(true_positives, true_positives + false_positives)
+        recall = _safe_divide(true_positives, true_positives + false_negatives)
+        f1 = _safe_divide(2 * true_positives, 2 * true_positives + false_positives + false_negatives)
+        return precision, recall, f1
+
+    def _histogram_auc_auprc(self):
+        """
+        The ROC and the precision-recall curves over the bin edges, from the highest scores down.
+        The AUC is the trapezoidal area (the scores of a bin tied), the AUPRC the average precision
+        sum((R_n - R_n-1) * P_n), both as sklearn computes them on tied scores.
+        """
+        true_positives = np.cumsum(self.positive_histogram[::-1])
+        false_positives = np.cumsum(self.negative_histogram[::-1])
+        num_positives, num_negatives = true_positives[-1], false_positives[-1]
+        if num_positives == 0:
+            return float('nan'), float('nan')
+        if num_negatives == 0:
+            return float('nan'), 1.0
+        tpr = np.concatenate([[0.0], true_positives / num_positives])
+        fpr = np.concatenate([[0.0], false_positives / num_negatives])
+        auc = float(np.sum((fpr[1:] - fpr[:-1]) * (tpr[1:] + tpr[:-1]) / 2.0))
+        predicted_positives = true_positives + false_positives
+        precision = _safe_divide(true_positives, predicted_positives)
+        auprc = float(np.sum((tpr[1:] - tpr[:-1]) * precision))
+        return auc, auprc
+
+    def _exact_auc_auprc(self):
+        sklearn_metrics = lr.lazy_import('sklearn.metrics')
+        labels, scores = np.concatenate(self._labels), np.concatenate(self._scores)
+        if not labels.any():
+            return float('nan'), float('nan')
+        if labels.all():
+            return float('nan'), 1.0
+        return (float(sklearn_metrics.roc_auc_score(y_true=labels, y_score=scores)),
+                float(sklearn_metrics.average_precision_score(y_true=labels, y_score=scores)))
+
+    def result(self):
+        """
+        Returns:
+            <dict> The precision, recall and F1 of the threshold predictions, their lists for the top-1 to topK
+            predictions (precision_tk, recall_tk, f1_tk), the AUC and the AUPRC
+        """
+        precision, recall, f1 = self._precision_recall_f1(self.counts_ts)
+        precision_tk, recall_tk, f1_tk = self._precision_recall_f1(self.counts_tk)
+        auc, auprc = self._exact_auc_auprc() if self.exact else self._histogram_auc_auprc()
+        return {
+            'precision': float(precision), 'recall': float(recall), 'f1': float(f1),
+            'precision_tk': precision_tk.tolist(), 'recall_tk': recall_tk.tolist(), 'f1_tk': f1_tk.tolist(),
+            'auc': auc, 'auprc': auprc
+        }
@@ -1,5 +1,36 @@
+import os
+import sys
+import json
 import argparse
 
+# The parameters autotune_harnn.py tunes
+TUNED_PARAMETERS = ['intra_op_threads', 'inter_op_threads', 'batch_size']
+
+
+def _apply_tuned_config(parser, args):
+    """
+    Take the parameters of the tuned config (written by autotune_harnn.py) which were left at their default.
+    train_harnn.py takes the "train" section of the config, the other scripts the "inference" section.
+    A config tuned on a machine with another number of cores is ignored.
+    The batch size changes the training itself, it is only taken with --tuned-batch-size.
+    The overrides are kept in args.tuned_overrides ({name: (default, tuned value)}), dh.tab_printer logs them.
+    """
+    args.tuned_overrides = {}
+    if not args.tuned_config or not os.path.isfile(args.tuned_config):
+        return
+    with open(args.tuned_config) as fin:
+        tuned_config = json.load(fin)
+    if tuned_config.get('cpu_count') != os.cpu_count():
+        return
+    section = 'train' if os.path.basename(sys.argv[0]).startswith('train') else 'inference'
+    for name, value in tuned_config.get(section, {}).items():
+        if name not in TUNED_PARAMETERS or (name == 'batch_size' and not args.tuned_batch_size):
+            continue
+        default = parser.get_default(name)
+        if getattr(args, name) == default and value != default:
+            setattr(args, name, value)
+            args.tuned_overrides[name] = (default, value)
+
 
 def parameter_parser():
     """
@@ -58,9 +89,34 @@ def parameter_parser():
                         nargs="?",
                         default="./data/BERT/BERT_embedding.model",
                         help="BERT file for embedding characters")
+
+    parser.add_argument("--embedding-matrix-file",
+                        nargs="?",
+                        default="./data/chinese-roberta-wwm-ext-large/embedding_matrix.npy",
+                        help="Exported float32 BERT embedding matrix, memory-mapped at startup.")
+
+    parser.add_argument("--data-cache-dir",
+                        nargs="?",
+                        default="./data/cache",
+                        help="Directory of the tokenized data cache, empty to disable it. (default: ./data/cache)")
+
+    parser.add_argument("--num-workers",
+                        type=int,
+                        default=1,
+                        help="Number of processes parsing the data file in byte-range shards. (default: 1)")
+
+    parser.add_argument("--tokenize-mode",
+                        choices=["char", "wordpiece"],
+                        default="char",
+                        help="Map each character to its vocab id, or WordPiece-tokenize the sentence. (default: char)")
                 
 
     # Model Hyperparameters
+    parser.add_argument("--prune-vocab",
+                        action="store_true",
+                        help="Keep only the tokens of the training data (and the special tokens) in the vocab, "
+                             "the map is saved with the run. (default: False)")
+
     parser.add_argument("--pad-seq-len",
                         type=int,
                         default=150,
@@ -69,13 +125,20 @@ def parameter_parser():
     parser.add_argument("--embedding-type",
                         type=int,
                         default=1,
-                        help="The embedding type. (default: 1)")
+                        help="The embedding type, 0: frozen pretrained, 1: trainable pretrained, "
+                             "2: frozen pretrained with a learned projection to embedding-dim, "
+                             "3: frozen pretrained with a learned low-rank delta. (default: 1)")
 
     parser.add_argument("--embedding-dim",
                         type=int,
                         default=100,
                         help="Dimensionality of character embedding. (default: 100)")
 
+    parser.add_argument("--embedding-rank",
+                        type=int,
+                        default=8,
+                        help="Rank of the learned delta of the embedding type 3. (default: 8)")
+
     parser.add_argument("--lstm-dim",
                         type=int,
                         default=256,
@@ -86,6 +149,13 @@ def parameter_parser():
                         default=1,
                         help="Number of LSTM layers. (default: 1)")
 
+    parser.add_argument("--lstm-backend",
+                        type=str,
+                        default="dynamic",
+                        choices=["dynamic", "fused"],
+                        help="LSTM implementation, 'dynamic' (LSTMCell in a while-loop) or 'fused' "
+                             "(fused block LSTM kernels). (default: dynamic)")
+
     parser.add_argument("--attention-dim",
                         type=int,
                         default=200,
@@ -117,9 +187,11 @@ def parameter_parser():
                         help="Each number of labels in hierarchical structure. (depends on the task)")
     '''
     parser.add_argument("--num-classes-list",
-                        type=list,
+                        type=int,
+                        nargs="+",
                         default=[3, 6, 14],
-                        help="Each number of labels in hierarchical structure. (depends on the task)")
+                        help="Each number of labels in hierarchical structure, one level each, the model has as "
+                             "many levels as numbers (e.g. 3 6 14 or 9 128 661 8364). (depends on the task)")
 
     parser.add_argument("--total-classes",
                         type=int,
@@ -136,6 +208,54 @@ def parameter_parser():
                         default=0.46,
                         help="Threshold for prediction classes. (default: 0.5)")
 
+    parser.add_argument("--metrics-bins",
+                        type=int,
+                        default=10000,
+                        help="Number of score histogram bins of the streaming AUC and AUPRC. (default: 10000)")
+
+    parser.add_argument("--exact-metrics",
+                        action="store_true",
+                        help="Keep every label and score to compute the exact AUC and AUPRC with sklearn, "
+                             "memory grows with the evaluated set. (default: False)")
+
+    parser.add_argument("--sampled-loss",
+                        action="store_true",
+                        help="Train the last level (its output layer and its attention) and the global head on the "
+                             "positives of the batch, num-sampled sampled classes and the sibling classes only. "
+                             "(default: False)")
+
+    parser.add_argument("--num-sampled",
+                        type=int,
+                        default=64,
+                        help="Number of classes sampled per batch for the sampled loss. (default: 64)")
+
+    parser.add_argument("--gated-inference",
+                        action="store_true",
+                        help="Test with parent-gated inference: the classes of the levels after the first are only "
+                             "computed for the children of the parents whose score reaches gate-threshold. "
+                             "(default: False)")
+
+    parser.add_argument("--gate-threshold",
+                        type=float,
+                        default=0.2,
+                        help="Parent score threshold of the parent-gated inference. (default: 0.2)")
+
+    parser.add_argument("--gate-check",
+                        action="store_true",
+                        help="With gated-inference, also score the test set with the dense model of the same "
+                             "checkpoint and report the score deviation and the metrics of both. (default: False)")
+
+    parser.add_argument("--calibration-batches",
+                        type=int,
+                        default=20,
+                        help="Number of validation batches of the int8 quantization calibration. (default: 20)")
+
+    parser.add_argument("--max-score-deviation",
+                        type=float,
+                        default=0.01,
+                        help="Weights whose int8 quantization moves a score more than this stay in fp32. "
+                             "(default: 0.01)")
+
     # Training Parameters
     parser.add_argument("--epochs",
                         type=int,
@@ -147,6 +267,70 @@ def parameter_parser():
                         default=32,
                         help="Batch Size. (default: 32)")
 
+    parser.add_argument("--prefetch-batches",
+                        type=int,
+                        default=2,
+                        help="Number of batches prepared ahead on a background thread. (default: 2)")
+
+    parser.add_argument("--bucket-size",
+                        type=int,
+                        default=0,
+                        help="Pad each batch to its longest document and group documents of similar length, "
+                             "pooling this many batches; 0 pads everything to pad-seq-len. (default: 0)")
+
+    parser.add_argument("--pad-multiple",
+                        type=int,
+                        default=1,
+                        help="Round the per-batch padded length up to a multiple of this, fewer distinct batch "
+                             "shapes for XLA to compile. (default: 1)")
+
+    parser.add_argument("--data-aug-prob",
+                        type=float,
+                        default=0.0,
+                        help="Probability that a training document is shuffled and randomly dropped on the fly, "
+                             "0 for no data augmentation. (default: 0.0)")
+
+    parser.add_argument("--data-aug-drop-rate",
+                        type=float,
+                        default=0.1,
+                        help="Fraction of the tokens dropped from an augmented document. (default: 0.1)")
+
+    parser.add_argument("--seed",
+                        type=int,
+                        default=None,
+                        help="Seed of the batch shuffling and the data augmentation. (default: None)")
+
+    parser.add_argument("--use-tfrecord",
+                        action="store_true",
+                        help="Train from a TFRecord file through a tf.data pipeline instead of feed_dict.")
+
+    parser.add_argument("--tfrecord-dir",
+                        nargs="?",
+                        default="./data/tfrecord",
+                        help="Directory of the TFRecord files written from the padded data. (default: ./data/tfrecord)")
+
+    parser.add_argument("--shuffle-buffer",
+                        type=int,
+                        default=10000,
+                        help="Shuffle buffer size of the tf.data pipeline. (default: 10000)")
+
+    parser.add_argument("--profile-steps",
+                        type=int,
+                        default=0,
+                        help="Write a step timeline (chrome trace) every how many steps, 0 to disable. (default: 0)")
+
+    parser.add_argument("--summary-steps",
+                        type=int,
+                        default=1,
+                        help="Write the scalar summaries (loss, gradient norm, learning rate) every how many steps, "
+                             "0 to disable. (default: 1)")
+
+    parser.add_argument("--histogram-steps",
+                        type=int,
+                        default=100,
+                        help="Write the gradient histograms and sparsities every how many steps, "
+                             "0 to disable. (default: 100)")
+
     parser.add_argument("--learning-rate",
                         type=float,
                         default=0.001, 
@@ -167,6 +351,18 @@ def parameter_parser():
                         default=50,
                         help="Evaluate model on val set after how many steps. (default: 50)")
 
+    parser.add_argument("--async-eval",
+                        action="store_true",
+                        help="Evaluate a snapshot of the weights in a background session while training goes on, "
+                             "the best checkpoints are saved from the snapshots. (default: False)")
+
+    parser.add_argument("--val-subset-size",
+                        type=int,
+                        default=0,
+                        help="Evaluate a fixed stratified subset of this many validation documents every "
+                             "evaluate-steps, the full validation set only at the end of each epoch and when "
+                             "the subset AUPRC improves, 0 to always evaluate the full set. (default: 0)")
+
     parser.add_argument("--norm-ratio",
                         type=float,
                         default=1.25,
@@ -203,4 +399,68 @@ def parameter_parser():
                         default=True,
                         help="Allow gpu options growth. (default: True)")
 
-    return parser.parse_args()
\ No newline at end of file
+    parser.add_argument("--intra-op-threads",
+                        type=int,
+                        default=0,
+                        help="Threads of the pool which runs one op (matmul, LSTM...), "
+                             "0 lets TensorFlow use one per core. (default: 0)")
+
+    parser.add_argument("--inter-op-threads",
+                        type=int,
+                        default=0,
+                        help="Threads of the pool which runs independent ops, "
+                             "0 lets TensorFlow use one per core. (default: 0)")
+
+    parser.add_argument("--cpu-affinity",
+                        nargs="?",
+                        default=None,
+                        help="Pin the process to these cores, e.g. '0-7,16-23' (Linux only). (default: None)")
+
+    parser.add_argument("--xla-jit",
+                        action="store_true",
+                        help="Compile the graph with XLA auto-clustering (JIT), the small element-wise ops "
+                             "are fused into fewer kernels. (default: False)")
+
+    parser.add_argument("--xla-tolerance",
+                        type=float,
+                        default=1e-4,
+                        help="Max absolute difference between the XLA and the plain graph allowed "
+                             "by benchmark_xla.py. (default: 1e-4)")
+
+    parser.add_argument("--benchmark-steps",
+                        type=int,
+                        default=20,
+                        help="Timed steps per measurement of benchmark_xla.py. (default: 20)")
+
+    parser.add_argument("--tuned-config",
+                        nargs="?",
+                        default="./tuned_config.json",
+                        help="Config written by autotune_harnn.py, its thread counts replace the "
+                             "parameters left at their default. (default: ./tuned_config.json)")
+
+    parser.add_argument("--tuned-batch-size",
+                        action="store_true",
+                        help="Also take the batch size of --tuned-config when --batch-size is left at its "
+                             "default. (default: False)")
+
+    parser.add_argument("--autotune-threads",
+                        type=int,
+                        nargs="*",
+                        default=None,
+                        help="Thread counts tried by autotune_harnn.py, for both pools. "
+                             "(default: the powers of 2 up to the number of cores)")
+
+    parser.add_argument("--autotune-batch-sizes",
+                        type=int,
+                        nargs="*",
+                        default=[32, 64, 128, 256],
+                        help="Batch sizes tried by autotune_harnn.py. (default: 32 64 128 256)")
+
+    parser.add_argument("--autotune-steps",
+                        type=int,
+                        default=10,
+                        help="Timed steps per configuration of autotune_harnn.py. (default: 10)")
+
+    args = parser.parse_args()
+    _apply_tuned_config(parser, args)
+    return args
\ No newline at end of file
@@ -0,0 +1,101 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import os
+import tensorflow as tf
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Parse a list of CPU cores.
+
+    Args:
+        cpu_list: The cores, ranges and single ids separated by commas, e.g. "0-7,16,18-19"
+    Returns:
+        <set> The core ids
+    Raises:
+        IOError: If the list can't be parsed
+    """
+    cpus = set()
+    try:
+        for part in cpu_list.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            if '-' in part:
+                start, end = part.split('-')
+                cpus.update(range(int(start), int(end) + 1))
+            else:
+                cpus.add(int(part))
+    except ValueError:
+        raise IOError("[Error] The CPU list '{0}' is not like '0-7,16'.".format(cpu_list))
+    if not cpus:
+        raise IOError("[Error] The CPU list '{0}' is empty.".format(cpu_list))
+    return cpus
+
+
+def set_cpu_affinity(cpu_list):
+    """
+    Pin the process to the cores of cpu_list.
+    The threads created afterwards (the TensorFlow thread pools of the first session) inherit the affinity,
+    so this has to run before the first session is created.
+
+    Args:
+        cpu_list: The cores, see parse_cpu_list
+    Raises:
+        IOError: If the platform doesn't support CPU affinity
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        raise IOError("[Error] CPU affinity is not supported on this platform.")
+    os.sched_setaffinity(0, parse_cpu_list(cpu_list))
+
+
+def available_cpus():
+    """
+    Returns:
+        The number of cores the process may run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def enable_xla_jit(session_conf):
+    """
+    XLA auto-clustering: the compilable ops of the graph are grouped into clusters, each compiled into
+    fused kernels. TF1 only auto-clusters on CPU with --tf_xla_cpu_global_jit in TF_XLA_FLAGS,
+    which is read once, when the first session of the process optimizes a graph.
+
+    Args:
+        session_conf: The tf.ConfigProto
+    """
+    xla_flags = os.environ.get('TF_XLA_FLAGS', '')
+    if '--tf_xla_cpu_global_jit' not in xla_flags:
+        os.environ['TF_XLA_FLAGS'] = (xla_flags + ' --tf_xla_cpu_global_jit').strip()
+    session_conf.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+
+
+def create_session_config(args, intra_op_threads=None, inter_op_threads=None, xla_jit=None):
+    """
+    The session config of the scripts: placement, GPU memory growth, thread pools, core pinning and XLA.
+    0 threads lets TensorFlow use one thread per core, which oversubscribes the node when several jobs share it.
+
+    Args:
+        args: The parameters of param_parser
+        intra_op_threads: The threads of the pool which runs one op, overrides args.intra_op_threads
+        inter_op_threads: The threads of the pool which runs independent ops, overrides args.inter_op_threads
+        xla_jit: Compile with XLA, overrides args.xla_jit
+    Returns:
+        The tf.ConfigProto
+    """
+    if args.cpu_affinity:
+        set_cpu_affinity(args.cpu_affinity)
+    session_conf = tf.ConfigProto(
+        allow_soft_placement=args.allow_soft_placement,
+        log_device_placement=args.log_device_placement,
+        intra_op_parallelism_threads=args.intra_op_threads if intra_op_threads is None else intra_op_threads,
+        inter_op_parallelism_threads=args.inter_op_threads if inter_op_threads is None else inter_op_threads)
+    session_conf.gpu_options.allow_growth = args.gpu_options_allow_growth
+    if args.xla_jit if xla_jit is None else xla_jit:
+        enable_xla_jit(session_conf)
+    return session_conf
@@ -0,0 +1,83 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import queue
+import threading
+import tensorflow as tf
+
+
+class AsyncSummaryWriter(object):
+    """
+    A tf.summary.FileWriter written from a background thread.
+    The training loop only puts the serialized summaries into a bounded queue, the thread parses them into events
+    and writes them, so TensorBoard logging stays off the step. When the queue is full (the disk can't keep up),
+    add_summary waits for a free slot instead of dropping events.
+    """
+
+    def __init__(self, logdir, graph=None, max_queue=64, flush_secs=120):
+        """
+        Args:
+            logdir: The directory of the event file
+            graph: The graph to write, also in the background (default: None)
+            max_queue: The number of pending summaries before add_summary blocks (default: 64)
+            flush_secs: How often the event file is flushed to disk (default: 120)
+        """
+        self._writer = tf.summary.FileWriter(logdir, flush_secs=flush_secs)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="summary-writer")
+        self._thread.daemon = True
+        self._thread.start()
+        if graph is not None:
+            self._put(self._writer.add_graph, graph)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                method, method_args = item
+                method(*method_args)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            raise IOError("[Error] The summary writer failed: {0}".format(self._error))
+
+    def _put(self, method, *method_args):
+        self._check()
+        self._queue.put((method, method_args))
+
+    def add_summary(self, summary, global_step=None):
+        """
+        Args:
+            summary: The serialized Summary protocol buffer (the result of a summary op)
+            global_step: The step of the summary
+        """
+        self._put(self._writer.add_summary, summary, global_step)
+
+    def add_run_metadata(self, run_metadata, tag, global_step=None):
+        """
+        Args:
+            run_metadata: The RunMetadata of a traced step
+            tag: The tag of the step
+            global_step: The step
+        """
+        self._put(self._writer.add_run_metadata, run_metadata, tag, global_step)
+
+    def flush(self):
+        """Wait for the pending summaries and flush the event file."""
+        self._queue.join()
+        self._writer.flush()
+        self._check()
+
+    def close(self):
+        """Write the pending summaries and close the event file."""
+        self._queue.put(None)
+        self._thread.join()
+        self._writer.close()
+        self._check()
@@ -0,0 +1,130 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import os
+import hashlib
+import numpy as np
+import tensorflow as tf
+
+from utils import data_helpers as dh
+
+# Bump whenever the layout of the TFRecord examples changes, so that stale files are rewritten.
+TFRECORD_VERSION = 2
+
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[int(i) for i in values]))
+
+
+def get_tfrecord_file(data_file, pad_seq_len, tfrecord_dir, num_classes_list, total_classes,
+                      tokenize_mode='char', vocab_map=None):
+    """
+    Get the TFRecord file path of the padded research data.
+    The name is keyed like the data cache (see data_helpers.data_cache_key), plus the padding length,
+    the vocab map and TFRECORD_VERSION.
+
+    Args:
+        data_file: The research data
+        pad_seq_len: The padding sequence length
+        tfrecord_dir: The TFRecord directory
+        num_classes_list: <list> The number of classes
+        total_classes: The total number of classes
+        tokenize_mode: 'char' or 'wordpiece' (default: 'char')
+        vocab_map: The kept token ids of the pruned vocab (default: None)
+    Returns:
+        The TFRecord file path
+    """
+    name = "{0}-v{1}-{2}-{3}".format(os.path.splitext(os.path.basename(data_file))[0], TFRECORD_VERSION,
+                                     pad_seq_len,
+                                     dh.data_cache_key(data_file, num_classes_list, total_classes, tokenize_mode))
+    if vocab_map is not None:
+        # The token ids depend on the vocab map
+        name += "-" + hashlib.md5(np.ascontiguousarray(vocab_map).tobytes()).hexdigest()[:8]
+    return os.path.join(tfrecord_dir, name + ".tfrecord")
+
+
+def write_tfrecord(output_file, x, y, y_tuple, pad_seq_len):
+    """
+    Write the output of pad_data into a TFRecord file, one tf.train.Example per record.
+    The token ids are stored without their padding (truncated to pad_seq_len), and the labels as
+    label indices, the input pipeline pads each batch and rebuilds the onehot vectors.
+
+    Args:
+        output_file: The TFRecord file path
+        x: The padded data or the unpadded data tokenindex
+        y: The data labels
+        y_tuple: The tuple of the data labels of each hierarchy level
+        pad_seq_len: The padding sequence length
+    """
+    output_dir = os.path.dirname(output_file)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+    tmp_file = "{0}.{1}.tmp".format(output_file, os.getpid())
+    with tf.io.TFRecordWriter(tmp_file) as writer:
+        for i in range(len(x)):
+            row = x[i][:pad_seq_len]
+            row = row[:np.count_nonzero(row)]  # Padding is at the end, and id 0 ([PAD]) never appears in text
+            feature = {
+                'x': _int64_feature(row),
+                'labels': _int64_feature(y.indices[i])
+            }
+            for level, level_labels in enumerate(y_tuple):
+                feature['labels_{0}'.format(level)] = _int64_feature(level_labels.indices[i])
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
+            writer.write(example.SerializeToString())
+    os.replace(tmp_file, output_file)
+
+
+def make_dataset(tfrecord_file, pad_seq_len, num_classes_list, total_classes, batch_size, num_epochs,
+                 shuffle=True, shuffle_buffer=10000, num_parallel_calls=4, prefetch_size=2):
+    """
+    The tf.data pipeline of the TFRecord file: shuffle buffer, batching, parallel parsing and prefetch.
+    Each batch is padded to its own longest document only, and holds the documents of one epoch only.
+
+    Args:
+        tfrecord_file: The TFRecord file path
+        pad_seq_len: The padding sequence length
+        num_classes_list: <list> The number of classes
+        total_classes: The total number of classes
+        batch_size: The size of the data batch
+        num_epochs: The number of epochs
+        shuffle: Shuffle or not (default: True)
+        shuffle_buffer: The size of the shuffle buffer (default: 10000)
+        num_parallel_calls: The number of parallel parsing calls (default: 4)
+        prefetch_size: The number of batches prepared ahead (default: 2)
+    Returns:
+        The dataset of (x_batch, y_batch, y_batch_tuple)
+    """
+    features = {
+        'x': tf.io.VarLenFeature(tf.int64),
+        'labels': tf.io.VarLenFeature(tf.int64)
+    }
+    for level in range(len(num_classes_list)):
+        features['labels_{0}'.format(level)] = tf.io.VarLenFeature(tf.int64)
+
+    def _parse(serialized):
+        # Parse the whole batch at once, the label indices become onehot matrices with to_indicator
+        parsed = tf.io.parse_example(serialized, features)
+        x = tf.cast(tf.sparse.to_dense(parsed['x']), tf.int32)[:, :pad_seq_len]
+        y = tf.cast(tf.sparse.to_indicator(parsed['labels'], total_classes), tf.float32)
+        y_tuple = tuple(tf.cast(tf.sparse.to_indicator(parsed['labels_{0}'.format(level)], num_classes), tf.float32)
+                        for level, num_classes in enumerate(num_classes_list))
+        return x, y, y_tuple
+
+    dataset = tf.data.TFRecordDataset(tfrecord_file)
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+    # Batch before repeat, so each epoch ends with its own last (smaller) batch and has
+    # ceil(num_examples / batch_size) batches like dh.batch_sampler, no batch crosses two epochs
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.repeat(num_epochs)
+    dataset = dataset.map(_parse, num_parallel_calls=num_parallel_calls)
+    return dataset.prefetch(prefetch_size)
+
+
+def make_input_tensors(dataset):
+    """
+    Returns:
+        The (x, y, y_tuple) tensors of a one-shot iterator of the dataset, given to TextHARNN as input_tensors
+    """
+    return tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
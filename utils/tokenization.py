@@ -0,0 +1,168 @@
+# -*- coding:utf-8 -*-
+__author__ = 'Randolph'
+
+import itertools
+import numpy as np
+
+from utils import lazy_resources as lr
+
+TOKENIZE_MODES = ('char', 'wordpiece')
+
+
+class TokenIndexer(object):
+    """
+    Maps a whole batch of documents to BERT vocab ids in one pass.
+
+    'char' mode looks every character up in the vocab (what tokenizer.convert_tokens_to_ids did per
+    character), through a code point -> id table built once from the vocab.
+    'wordpiece' mode runs the fast (Rust) BertTokenizer on the whole sentence, with [CLS]/[SEP].
+    Both return a flat int32 id buffer plus int64 offsets, document i being ids[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, bert_path):
+        self.bert_path = bert_path
+        tokenizer = lr.get_tokenizer(bert_path)
+        self.vocab = tokenizer.get_vocab()
+        self.unk_id = self.vocab.get(tokenizer.unk_token, 0)
+        self.pad_id = self.vocab.get(tokenizer.pad_token, 0)
+
+        # The last slot of the table catches every code point which is not a single-char token
+        max_code_point = max(ord(token) for token in self.vocab if len(token) == 1)
+        self._char_table = np.full(max_code_point + 2, self.unk_id, dtype=np.int32)
+        for token, index in self.vocab.items():
+            if len(token) == 1:
+                self._char_table[ord(token)] = index
+
+    def _texts(self, documents):
+        """
+        Documents are either strings or lists of tokens, single-char token lists are joined into strings.
+        The other token lists (e.g. segmented words) are looked up token by token like before.
+        """
+        texts, word_ids = [], {}
+        for i, document in enumerate(documents):
+            if isinstance(document, str):
+                texts.append(document)
+            elif all(len(token) == 1 for token in document):
+                texts.append(''.join(document))
+            else:
+                texts.append('')
+                word_ids[i] = np.array([self.vocab.get(token, self.unk_id) for token in document], dtype=np.int32)
+        return texts, word_ids
+
+    def char_ids(self, documents):
+        """
+        Map each character of each document to its vocab id.
+
+        Args:
+            documents: <list> The documents (strings or lists of tokens)
+        Returns:
+            ids: The flat int32 ids
+            offsets: The int64 offsets, of length len(documents) + 1
+        """
+        texts, word_ids = self._texts(documents)
+        lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+        code_points = np.frombuffer(''.join(texts).encode('utf-32-le'), dtype=np.uint32)
+        ids = self._char_table[np.minimum(code_points, len(self._char_table) - 1)]
+
+        if word_ids:
+            for i, document_ids in word_ids.items():
+                lengths[i] = len(document_ids)
+            offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            merged = np.empty(offsets[-1], dtype=np.int32)
+            char_offset = 0
+            for i, text in enumerate(texts):
+                if i in word_ids:
+                    merged[offsets[i]:offsets[i + 1]] = word_ids[i]
+                else:
+                    merged[offsets[i]:offsets[i + 1]] = ids[char_offset:char_offset + len(text)]
+                    char_offset += len(text)
+            return merged, offsets
+
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return ids, offsets
+
+    def wordpiece_ids(self, documents, add_special_tokens=True):
+        """
+        Tokenize each document as one sentence with the WordPiece tokenizer.
+
+        Args:
+            documents: <list> The documents (strings or lists of tokens)
+            add_special_tokens: Add [CLS] and [SEP] or not (default: True)
+        Returns:
+            ids: The flat int32 ids
+            offsets: The int64 offsets, of length len(documents) + 1
+        """
+        texts = [document if isinstance(document, str) else ''.join(document) for document in documents]
+        encoded = lr.get_fast_tokenizer(self.bert_path)(texts, add_special_tokens=add_special_tokens,
+                                                        return_attention_mask=False,
+                                                        return_token_type_ids=False)['input_ids']
+        lengths = np.fromiter((len(i) for i in encoded), dtype=np.int64, count=len(encoded))
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        ids = np.fromiter(itertools.chain.from_iterable(encoded), dtype=np.int32, count=offsets[-1])
+        return ids, offsets
+
+    def index(self, documents, mode='char'):
+        """
+        Args:
+            documents: <list> The documents
+            mode: 'char' or 'wordpiece' (default: 'char')
+        Returns:
+            The flat int32 ids and the int64 offsets
+        Raises:
+            ValueError: If the mode is unknown
+        """
+        if mode == 'char':
+            return self.char_ids(documents)
+        if mode == 'wordpiece':
+            return self.wordpiece_ids(documents)
+        raise ValueError("[Error] Unknown tokenize mode {0}, it should be one of {1}.".format(mode, TOKENIZE_MODES))
+
+    def encode(self, documents, maximum_length):
+        """
+        Sentence-level WordPiece encoding padded to the maximum length, with [CLS]/[SEP] and attention masks.
+
+        Args:
+            documents: <list> The documents
+            maximum_length: The padded length
+        Returns:
+            input_ids: [len(documents), maximum_length] int32
+            attention_masks: [len(documents), maximum_length] int32
+        """
+        texts = [document if isinstance(document, str) else ''.join(document) for document in documents]
+        encoded = lr.get_fast_tokenizer(self.bert_path)(texts, add_special_tokens=True, max_length=maximum_length,
+                                                        padding='max_length', truncation=True,
+                                                        return_attention_mask=True, return_token_type_ids=False,
+                                                        return_tensors='np')
+        return encoded['input_ids'].astype(np.int32), encoded['attention_mask'].astype(np.int32)
+
+
+def pad_ragged(ids, offsets, pad_seq_len, value=0):
+    """
+    Pad or truncate every document to pad_seq_len at the end (same as tflearn pad_sequences defaults).
+
+    Args:
+        ids: The flat ids
+        offsets: The offsets
+        pad_seq_len: The padded length
+        value: The padding id (default: 0)
+    Returns:
+        [number of documents, pad_seq_len] int32
+    """
+    offsets = np.asarray(offsets)
+    lengths = np.minimum(np.diff(offsets), pad_seq_len)
+    positions = np.arange(pad_seq_len)
+    mask = positions[None, :] < lengths[:, None]
+    padded = np.full((len(lengths), pad_seq_len), value, dtype=np.int32)
+    if len(ids):
+        padded[mask] = ids[(offsets[:-1, None] + positions[None, :])[mask]]
+    return padded
+
+
+def get_token_indexer(bert_path):
+    """
+    Get the TokenIndexer of the BERT model path (built at most once per process).
+    """
+    return lr.get_resource(('token_indexer', bert_path), lambda: TokenIndexer(bert_path))